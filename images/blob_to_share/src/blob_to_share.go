@@ -3,6 +3,8 @@ package main
 import (
 	"bytes"
 	"context"
+	"encoding/base64"
+	"encoding/json"
 	"fmt"
 	"log"
 	"net/url"
@@ -32,6 +34,42 @@ func contains(slice []string, toFind string) bool {
 	return false
 }
 
+// Download a blob's contents
+func downloadBlob(ctx *context.Context, blobCredential *azblob.SharedKeyCredential, blobUrl string) []byte {
+	blobClient, err := azblob.NewBlockBlobClientWithSharedKey(blobUrl, blobCredential, nil)
+	if err != nil {
+		log.Fatal(err)
+	}
+
+	get, err := blobClient.Download(*ctx, nil)
+	if err != nil {
+		log.Fatal(err)
+	}
+
+	downloadedData := &bytes.Buffer{}
+	reader := get.Body(nil)
+	_, err = downloadedData.ReadFrom(reader)
+	if err != nil {
+		log.Fatal(err)
+	}
+	err = reader.Close()
+	if err != nil {
+		log.Fatal(err)
+	}
+	return downloadedData.Bytes()
+}
+
+// Whether the file in the share already has this content, from the MD5 hash
+// recorded when it was uploaded
+func shareFileMatches(ctx *context.Context, fileURL *azfile.FileURL, md5Hash []byte) bool {
+	properties, err := fileURL.GetProperties(*ctx)
+	if err != nil {
+		// File must not exist
+		return false
+	}
+	return bytes.Equal(properties.ContentMD5(), md5Hash)
+}
+
 func checkAndCreateFolder(ctx *context.Context, azFilePipeline *pipeline.Pipeline, baseUrl string, folderPath string) {
 	directoryParsedURL, _ := url.Parse(baseUrl + "/" + folderPath)
 	fmt.Printf("    Checking directory '%s' exists . . . \n", folderPath)
@@ -109,6 +147,7 @@ func main() {
 	// Get the credentials for this account
 	accountName, accountKey := findEnvVar("ACCOUNT_NAME"), findEnvVar("ACCOUNT_KEY")
 	containerName, shareName := findEnvVar("CONTAINER_NAME"), findEnvVar("SHARE_NAME")
+	manifestName := findEnvVar("MANIFEST_NAME")
 
 	blobCredential, err := azblob.NewSharedKeyCredential(accountName, accountKey)
 	if err != nil {
@@ -123,92 +162,70 @@ func main() {
 	blobBaseUrl := fmt.Sprintf("https://%s.blob.core.windows.net/", accountName)
 	fileBaseUrl := fmt.Sprintf("https://%s.file.core.windows.net/", accountName)
 
-	serviceClient, err := azblob.NewServiceClientWithSharedKey(blobBaseUrl, blobCredential, nil)
-	if err != nil {
-		log.Fatal("Invalid credentials with error: " + err.Error())
-	}
 	shareBaseUrl := fileBaseUrl + shareName
 
-	// List the blobs in the container
-	fmt.Println("Listing the blobs in the container:")
-	containerClient := serviceClient.NewContainerClient(containerName)
-	pager := containerClient.ListBlobsFlat(nil)
-
 	ctx := context.Background()
 
-	// List of all the blobs to upload
-	allBlobs := []string{}
+	// The manifest lists each file with the base64 MD5 hash of its content.
+	// Only files whose hash differs from the share's copy are uploaded
+	fmt.Printf("Reading the manifest '%s':\n", manifestName)
+	manifest := map[string]string{}
+	err = json.Unmarshal(downloadBlob(&ctx, blobCredential, blobBaseUrl+containerName+"/"+manifestName), &manifest)
+	if err != nil {
+		log.Fatal("Invalid manifest with error: " + err.Error())
+	}
 
-	// For each page
-	for pager.NextPage(ctx) {
-		resp := pager.PageResponse()
+	// List of all the files that should be in the share
+	allBlobs := []string{}
 
-		// For each blob on the page
-		for _, v := range resp.ContainerListBlobFlatSegmentResult.Segment.BlobItems {
-			fmt.Println("  - " + *v.Name)
-			allBlobs = append(allBlobs, *v.Name)
+	for blobName, encodedHash := range manifest {
+		allBlobs = append(allBlobs, blobName)
 
-			blobClient, err := azblob.NewBlockBlobClientWithSharedKey(blobBaseUrl+containerName+"/"+*v.Name, blobCredential, nil)
-			if err != nil {
-				log.Fatal(err)
-			}
+		md5Hash, err := base64.StdEncoding.DecodeString(encodedHash)
+		if err != nil {
+			log.Fatal(fmt.Sprintf("Invalid hash for %s: %s", blobName, err.Error()))
+		}
 
-			// Download the blob
-			get, err := blobClient.Download(ctx, nil)
-			if err != nil {
-				log.Fatal(err)
-			}
+		u, _ := url.Parse(fmt.Sprintf(fileBaseUrl + shareName + "/" + blobName))
+		fileURL := azfile.NewFileURL(*u, azFilePipeline)
 
-			downloadedData := &bytes.Buffer{}
-			reader := get.Body(nil)
-			numBytes, err := downloadedData.ReadFrom(reader)
-			if err != nil {
-				log.Fatal(err)
-			}
-			err = reader.Close()
-			if err != nil {
-				log.Fatal(err)
-			}
+		fmt.Printf("  - %s . . . ", blobName)
+		if shareFileMatches(&ctx, &fileURL, md5Hash) {
+			fmt.Print("unchanged\n")
+			continue
+		}
+		fmt.Print("changed\n")
 
-			// Check that the folder exists
-			splitPath := strings.Split(*v.Name, "/")
-			numParts := len(splitPath)
-			if numParts > 1 {
+		downloadedData := downloadBlob(&ctx, blobCredential, blobBaseUrl+containerName+"/"+blobName)
 
-				// Need to create these folders
-				for idx := 1; idx < numParts; idx++ {
-					folderPath := strings.Join(splitPath[:idx], "/")
+		// Check that the folder exists
+		splitPath := strings.Split(blobName, "/")
+		numParts := len(splitPath)
+		if numParts > 1 {
 
-					checkAndCreateFolder(&ctx, &azFilePipeline, shareBaseUrl, folderPath)
-				}
-			}
+			// Need to create these folders
+			for idx := 1; idx < numParts; idx++ {
+				folderPath := strings.Join(splitPath[:idx], "/")
 
-			// Upload to the file share
-			u, _ := url.Parse(fmt.Sprintf(fileBaseUrl + shareName + "/" + *v.Name))
-
-			fileURL := azfile.NewFileURL(*u, azFilePipeline)
-
-			// Trigger parallel upload with Parallelism set to 3. Note if there is an Azure file
-			// with same name exists, UploadBufferToAzureFile will overwrite the existing Azure file with new content,
-			// and set specified azfile.FileHTTPHeaders and Metadata.
-			err = azfile.UploadBufferToAzureFile(ctx, downloadedData.Bytes(), fileURL,
-				azfile.UploadToAzureFileOptions{
-					Parallelism: 3,
-					FileHTTPHeaders: azfile.FileHTTPHeaders{
-						CacheControl: "no-transform",
-					},
-					Metadata: azfile.Metadata{},
-					// If Progress is non-nil, this function is called periodically as bytes are uploaded.
-					Progress: func(bytesTransferred int64) {
-						fmt.Printf("    Uploaded %d of %d bytes.\n", bytesTransferred, numBytes)
-					},
-				})
-			if err != nil {
-				log.Fatal(err)
+				checkAndCreateFolder(&ctx, &azFilePipeline, shareBaseUrl, folderPath)
 			}
-
 		}
 
+		// Note if there is an Azure file with same name exists, UploadBufferToAzureFile will overwrite the existing
+		// Azure file with new content. The hash is recorded so the next run can skip the file if it's unchanged
+		err = azfile.UploadBufferToAzureFile(ctx, downloadedData, fileURL,
+			azfile.UploadToAzureFileOptions{
+				Parallelism: 3,
+				FileHTTPHeaders: azfile.FileHTTPHeaders{
+					CacheControl: "no-transform",
+					ContentMD5:   md5Hash,
+				},
+				Metadata: azfile.Metadata{},
+			})
+		if err != nil {
+			log.Fatal(err)
+		}
+		fmt.Printf("    Uploaded %d bytes.\n", len(downloadedData))
 	}
 
 	// Remove any files in the share that are not in the blob container
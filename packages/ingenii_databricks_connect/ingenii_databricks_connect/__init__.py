@@ -1,21 +1,30 @@
 # Set spark configuration: https://docs.microsoft.com/en-us/azure/databricks/dev-tools/databricks-connect#aad-tokens
-from json import loads
-from os import environ
 from pyspark.sql import SparkSession
-from subprocess import run
 
-def get_spark_context():
-    # Command to run the Azure CLI
-    command = "az account get-access-token --resource 2ff814a6-3304-4ab8-85cb-cd0e6f879c1d"
-    if "DATABRICKS_SUBSCRIPTION_ID" in environ:
-        command += " --subscription " + environ["DATABRICKS_SUBSCRIPTION_ID"]
+from .credentials import DatabricksTokenProvider
 
-    # Run and decode the result
-    result = run(command.split(" "), capture_output=True)
-    result_json = loads(result.stdout.decode())
+# Shared by every session in this process, so the token is reused
+token_provider = DatabricksTokenProvider()
 
-    # Get and set the spark object with the AAD token
+
+def get_spark_context(keep_authenticated=True):
+    """
+    Get the Spark session, authenticated with an AAD token
+
+    Parameters
+    ----------
+    keep_authenticated : bool, optional
+        Whether to refresh the token in the background before it expires, so
+        long-running sessions stay authenticated, by default True
+
+    Returns
+    -------
+    SparkSession
+        The session, connected to your Databricks cluster
+    """
     spark = SparkSession.builder.getOrCreate()
-    spark.conf.set("spark.databricks.service.token", result_json["accessToken"])
-    
-    return spark
\ No newline at end of file
+    token_provider.set_token(spark)
+    if keep_authenticated:
+        token_provider.keep_authenticated(spark)
+
+    return spark
@@ -0,0 +1,159 @@
+# AAD tokens for Databricks Connect: https://docs.microsoft.com/en-us/azure/databricks/dev-tools/databricks-connect#aad-tokens
+from json import loads
+from os import environ, path
+from subprocess import run
+from threading import Event, Lock, Thread
+from time import time
+
+import msal
+
+# The Azure Databricks application, and the Azure CLI's own client ID, whose
+# login the tokens are taken from
+DATABRICKS_RESOURCE_ID = "2ff814a6-3304-4ab8-85cb-cd0e6f879c1d"
+AZURE_CLI_CLIENT_ID = "04b07795-8ddb-461a-bbee-02f9e1bf7b46"
+
+
+class DatabricksTokenProvider:
+    """
+    Provides AAD tokens for Databricks, from the login made with `az login`.
+
+    Tokens are acquired in this process with MSAL, from the Azure CLI's token
+    cache, rather than by running the Azure CLI. Each token is kept until
+    shortly before it expires, and can be refreshed in the background to keep
+    long-running Spark sessions authenticated. If the CLI's cache can't be
+    used, this falls back to running `az account get-access-token`.
+
+    Parameters
+    ----------
+    azure_config_dir : str, optional
+        The Azure CLI's configuration folder, by default ~/.azure
+    refresh_margin : int, optional
+        Seconds before a token expires to replace it, by default 300
+    """
+
+    def __init__(self, azure_config_dir=None, refresh_margin=300):
+        self.azure_config_dir = azure_config_dir or environ.get(
+            "AZURE_CONFIG_DIR", path.join(environ["HOME"], ".azure"))
+        self.refresh_margin = refresh_margin
+        self.subscription_id = environ.get("DATABRICKS_SUBSCRIPTION_ID")
+
+        self._lock = Lock()
+        self._token, self._expires_on = None, 0
+        self._refresher, self._stop_refreshing = None, Event()
+
+    def _get_cli_account(self):
+        """ The tenant and user name of the Azure CLI's login for the subscription """
+        with open(path.join(self.azure_config_dir, "azureProfile.json"), encoding="utf-8-sig") as profile_file:
+            subscriptions = loads(profile_file.read())["subscriptions"]
+
+        for subscription in subscriptions:
+            if self.subscription_id:
+                if subscription["id"] == self.subscription_id:
+                    break
+            elif subscription.get("isDefault"):
+                break
+        else:
+            raise Exception(
+                "No Azure CLI login found for the subscription. Run `az login` in a terminal")
+
+        return subscription["tenantId"], subscription["user"]["name"]
+
+    def _acquire_from_cache(self):
+        """ Acquire a token with MSAL, from the Azure CLI's token cache """
+        tenant_id, user_name = self._get_cli_account()
+
+        # Only read: the CLI manages and locks its own cache file
+        token_cache = msal.SerializableTokenCache()
+        with open(path.join(self.azure_config_dir, "msal_token_cache.json")) as cache_file:
+            token_cache.deserialize(cache_file.read())
+
+        app = msal.PublicClientApplication(
+            AZURE_CLI_CLIENT_ID,
+            authority=f"https://login.microsoftonline.com/{tenant_id}",
+            token_cache=token_cache,
+        )
+        accounts = app.get_accounts(username=user_name)
+        if not accounts:
+            raise Exception(f"No cached Azure CLI login for {user_name}")
+
+        result = app.acquire_token_silent([f"{DATABRICKS_RESOURCE_ID}/.default"], account=accounts[0])
+        if not result or "access_token" not in result:
+            raise Exception("Unable to acquire a token from the Azure CLI's cache: " + str(
+                (result or {}).get("error_description", "no token returned")))
+
+        return result["access_token"], time() + int(result["expires_in"])
+
+    def _acquire_from_cli(self):
+        """ Acquire a token by running the Azure CLI """
+        command = ["az", "account", "get-access-token", "--resource", DATABRICKS_RESOURCE_ID]
+        if self.subscription_id:
+            command += ["--subscription", self.subscription_id]
+
+        result = run(command, capture_output=True)
+        if result.returncode:
+            raise Exception("Unable to get an access token from the Azure CLI: " + result.stderr.decode())
+        result_json = loads(result.stdout.decode())
+
+        # 'expires_on' is a POSIX timestamp in newer versions of the CLI
+        if "expires_on" in result_json:
+            expires_on = int(result_json["expires_on"])
+        else:
+            expires_on = time() + 3000
+        return result_json["accessToken"], expires_on
+
+    def get_token(self):
+        """
+        Get a Databricks AAD token, reusing the current one until it's within
+        the refresh margin of expiring
+
+        Returns
+        -------
+        str
+            The access token
+        """
+        with self._lock:
+            if self._token and time() < self._expires_on - self.refresh_margin:
+                return self._token
+
+            try:
+                self._token, self._expires_on = self._acquire_from_cache()
+            except Exception:
+                self._token, self._expires_on = self._acquire_from_cli()
+
+            return self._token
+
+    def set_token(self, spark):
+        """ Set a current token on the Spark session """
+        spark.conf.set("spark.databricks.service.token", self.get_token())
+
+    def keep_authenticated(self, spark):
+        """
+        Refresh the Spark session's token in the background, before each token
+        expires. Only one refresher runs per provider
+
+        Parameters
+        ----------
+        spark : SparkSession
+            The session to keep authenticated
+        """
+        if self._refresher and self._refresher.is_alive():
+            return
+
+        def refresh():
+            while True:
+                wait = max(self._expires_on - self.refresh_margin - time(), 0) + 1
+                if self._stop_refreshing.wait(wait):
+                    return
+                try:
+                    self.set_token(spark)
+                except Exception as error:
+                    print(f"Unable to refresh the Databricks token, retrying in a minute: {error}")
+                    self._stop_refreshing.wait(60)
+
+        self._stop_refreshing.clear()
+        self._refresher = Thread(target=refresh, name="databricks-token-refresher", daemon=True)
+        self._refresher.start()
+
+    def stop_refreshing(self):
+        """ Stop refreshing the token in the background """
+        self._stop_refreshing.set()
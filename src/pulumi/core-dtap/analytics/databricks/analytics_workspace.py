@@ -18,6 +18,8 @@ from ingenii_azure_data_platform.utils import (
     lock_resource,
 )
 
+from analytics.databricks.hive_metastore import create_hive_metastore_spark_conf, \
+    hive_metastore_config
 from logs import log_analytics_workspace
 from management import resource_groups
 from management.user_groups import user_groups
@@ -205,6 +207,15 @@ secret_scope = databricks.SecretScope(
     opts=ResourceOptions(provider=databricks_provider),
 )
 
+# ----------------------------------------------------------------------------------------------------------------------
+# ANALYTICS DATABRICKS WORKSPACE -> HIVE METASTORE
+# ----------------------------------------------------------------------------------------------------------------------
+
+# Clusters use the metastore shared with the other workspace
+hive_metastore_spark_conf = create_hive_metastore_spark_conf(
+    workspace_name, secret_scope, databricks_provider
+) if hive_metastore_config.get("enabled") else {}
+
 # ----------------------------------------------------------------------------------------------------------------------
 # ANALYTICS DATABRICKS WORKSPACE -> INSTANCE POOLS
 # ----------------------------------------------------------------------------------------------------------------------
@@ -306,6 +317,7 @@ for ref_key, cluster_config in workspace_config.get("clusters", {}).items():
             "spark.databricks.delta.preview.enabled": "true",
         }
         custom_tags = {"ResourceClass": "Serverless", **cluster_default_tags}
+    cluster_defaults["spark_conf"].update(hive_metastore_spark_conf)
 
     clusters[ref_key] = create_cluster(
         databricks_provider=databricks_provider,
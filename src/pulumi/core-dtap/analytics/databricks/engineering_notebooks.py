@@ -4,7 +4,8 @@ import pulumi_databricks as databricks
 
 from ingenii_azure_data_platform.utils import generate_resource_name
 
-from analytics.databricks.engineering_workspace import databricks_provider
+from analytics.databricks.engineering_workspace import databricks_provider, \
+    job_cluster, job_cluster_libraries, propagation_config, workspace_config
 from project_config import platform_config
 
 folder_path = "/Shared/Ingenii Engineering"
@@ -18,21 +19,98 @@ ingenii_engineering_directory = databricks.Directory(
     opts=ResourceOptions(provider=databricks_provider),
 )
 
+notebooks = {}
 notebooks_root ="analytics/databricks/notebooks/engineering"
 for file_name in listdir(notebooks_root):
     if not file_name.endswith(".py"):
         continue
-    databricks.Notebook(
+    # Not .strip('.py'), which would also remove a leading 'p' or 'y'
+    notebook_name = file_name[:-len(".py")]
+    notebooks[notebook_name] = databricks.Notebook(
         resource_name=generate_resource_name(
             resource_type="databricks_notebook",
-            resource_name=f"ingenii_engineering_{file_name.strip('.py')}",
+            resource_name=f"ingenii_engineering_{notebook_name}",
             platform_config=platform_config,
         ),
         language="PYTHON",
-        path=f"{folder_path}/{file_name.strip('.py')}",
+        path=f"{folder_path}/{notebook_name}",
         source=f"{notebooks_root}/{file_name}",
         opts=ResourceOptions(
             depends_on=[ingenii_engineering_directory],
             provider=databricks_provider,
         ),
     )
+
+# ----------------------------------------------------------------------------------------------------------------------
+# ENGINEERING DATABRICKS WORKSPACE -> JOBS -> PROPAGATE SOURCES
+# ----------------------------------------------------------------------------------------------------------------------
+
+def minutes_to_cron(n_mins, setting_name):
+    """ Take the number of minutes and return a Quartz cron expression running that often """
+    # Cron steps restart every hour and every day, so other values would give uneven gaps between runs
+    if n_mins < 60 and 60 % n_mins == 0:
+        return f"0 0/{n_mins} * * * ?"
+    if n_mins >= 60 and n_mins % 60 == 0 and 24 % (n_mins // 60) == 0:
+        return f"0 0 0/{n_mins // 60} * * ?"
+    raise Exception(
+        f"'{setting_name}' is {n_mins}, but needs to divide an hour (e.g. 5, 15 or 30), "
+        f"or be a whole number of hours that divides a day (e.g. 60, 120 or 360)"
+    )
+
+# The data_pipeline notebook only marks tables as changed, and this job
+# propagates them. Only one run at a time, so propagations never overlap
+if propagation_config.get("mode", "immediate") == "scheduled":
+    debounce_minutes = propagation_config.get("debounce_minutes", 15)
+    databricks.Job(
+        resource_name=generate_resource_name(
+            resource_type="databricks_job",
+            resource_name="engineering_propagate_sources",
+            platform_config=platform_config,
+        ),
+        name="Propagate sources",
+        new_cluster=job_cluster,
+        libraries=job_cluster_libraries,
+        max_concurrent_runs=1,
+        notebook_task=databricks.JobNotebookTaskArgs(
+            notebook_path=notebooks["propagate_sources"].path,
+            base_parameters={
+                "debounce_minutes": str(debounce_minutes),
+                "max_delay_minutes": str(
+                    propagation_config.get("max_delay_minutes", 60)),
+            },
+        ),
+        schedule=databricks.JobScheduleArgs(
+            quartz_cron_expression=minutes_to_cron(debounce_minutes, "propagation.debounce_minutes"),
+            timezone_id="UTC",
+        ),
+        opts=ResourceOptions(provider=databricks_provider),
+    )
+
+# ----------------------------------------------------------------------------------------------------------------------
+# ENGINEERING DATABRICKS WORKSPACE -> JOBS -> UPDATE IMPORT FILE SUMMARY
+# ----------------------------------------------------------------------------------------------------------------------
+
+# Keeps the dashboard summary and the adaptive ingestion timeouts up to date,
+# rather than updating them after every file
+import_file_summary_config = workspace_config.get("import_file_summary", {})
+databricks.Job(
+    resource_name=generate_resource_name(
+        resource_type="databricks_job",
+        resource_name="engineering_update_import_file_summary",
+        platform_config=platform_config,
+    ),
+    name="Update import file summary",
+    new_cluster=job_cluster,
+    libraries=job_cluster_libraries,
+    max_concurrent_runs=1,
+    notebook_task=databricks.JobNotebookTaskArgs(
+        notebook_path=notebooks["update_import_file_summary"].path,
+    ),
+    schedule=databricks.JobScheduleArgs(
+        quartz_cron_expression=minutes_to_cron(
+            import_file_summary_config.get("every_minutes", 15),
+            "import_file_summary.every_minutes"),
+        timezone_id="UTC",
+    ),
+    opts=ResourceOptions(provider=databricks_provider),
+)
@@ -18,6 +18,8 @@ from ingenii_azure_data_platform.utils import (
     lock_resource,
 )
 
+from analytics.databricks.hive_metastore import create_hive_metastore_spark_conf, \
+    hive_metastore_config
 from logs import log_analytics_workspace
 from management import resource_groups
 from management.user_groups import user_groups
@@ -32,6 +34,7 @@ workspace_config = platform_config["analytics_services"]["databricks"]["workspac
     workspace_short_name
 ]
 workspace_firewall_config = workspace_config.get("network", {}).get("firewall", {})
+propagation_config = workspace_config.get("propagation", {})
 shared_workspace_config = shared_platform_config["analytics_services"]["databricks"][
     "workspaces"
 ][workspace_short_name]
@@ -239,6 +242,15 @@ datafactory_token = databricks.Token(
     opts=ResourceOptions(provider=databricks_provider),
 )
 
+# ----------------------------------------------------------------------------------------------------------------------
+# ENGINEERING DATABRICKS WORKSPACE -> HIVE METASTORE
+# ----------------------------------------------------------------------------------------------------------------------
+
+# Clusters use the metastore shared with the other workspace
+hive_metastore_spark_conf = create_hive_metastore_spark_conf(
+    workspace_name, secret_scope, databricks_provider
+) if hive_metastore_config.get("enabled") else {}
+
 # ----------------------------------------------------------------------------------------------------------------------
 # ENGINEERING DATABRICKS WORKSPACE -> INSTANCE POOLS
 # ----------------------------------------------------------------------------------------------------------------------
@@ -494,6 +506,9 @@ for ref_key, cluster_config in workspace_config.get("clusters", {}).items():
                 "DBT_TOKEN_NAME": dbt_token_name,
                 "DBT_ROOT_FOLDER": "/dbfs/mnt/dbt",
                 "DBT_LOGS_FOLDER": "/dbfs/mnt/dbt-logs",
+                "DBT_SCHEMA_CACHE_FOLDER": "/local_disk0/tmp/dbt_schema_cache",
+                "PROPAGATION_MODE": propagation_config.get("mode", "immediate"),
+                "PROPAGATION_QUEUE_PATH": "/mnt/orchestration/propagation_queue",
             }
         )
 
@@ -515,6 +530,7 @@ for ref_key, cluster_config in workspace_config.get("clusters", {}).items():
             "spark.databricks.delta.preview.enabled": "true",
         }
         custom_tags = {"ResourceClass": "Serverless", **cluster_default_tags}
+    cluster_defaults["spark_conf"].update(hive_metastore_spark_conf)
 
     clusters[ref_key] = create_cluster(
         databricks_provider=databricks_provider,
@@ -526,6 +542,55 @@ for ref_key, cluster_config in workspace_config.get("clusters", {}).items():
         depends_on=[pre_processing_blob] + list(storage_mounts.values()),
         instance_pools=instance_pools,
     )
+    if ref_key == "default":
+        default_cluster_settings = (cluster_config, cluster_defaults)
+
+# ----------------------------------------------------------------------------------------------------------------------
+# ENGINEERING DATABRICKS WORKSPACE -> CLUSTERS -> JOB CLUSTER
+# ----------------------------------------------------------------------------------------------------------------------
+
+# Scheduled jobs each start a single node cluster with the default cluster's
+# runtime, libraries and environment, which terminates when the run ends. On
+# the default cluster, a frequent schedule would keep it from terminating
+default_cluster_config, default_cluster_defaults = default_cluster_settings
+job_cluster = databricks.JobNewClusterArgs(
+    cluster_log_conf=databricks.JobNewClusterClusterLogConfArgs(
+        dbfs=databricks.JobNewClusterClusterLogConfDbfsArgs(
+            destination="dbfs:/mnt/cluster_logs"
+        )
+    ),
+    custom_tags={"ResourceClass": "SingleNode", **cluster_default_tags},
+    docker_image=databricks.JobNewClusterDockerImageArgs(
+        url=default_cluster_config["docker_image_url"]
+    ) if default_cluster_config.get("docker_image_url") else None,
+    instance_pool_id=instance_pools[default_cluster_config["instance_pool_ref_key"]].id
+    if default_cluster_config.get("instance_pool_ref_key") else None,
+    node_type_id=None if default_cluster_config.get("instance_pool_ref_key")
+    else default_cluster_config.get("node_type_id"),
+    num_workers=0,
+    spark_conf={
+        "spark.databricks.cluster.profile": "singleNode",
+        "spark.master": "local[*]",
+        "spark.databricks.delta.preview.enabled": "true",
+        **hive_metastore_spark_conf,
+    },
+    # dbt still runs models on the default cluster, through its name
+    spark_env_vars={
+        **default_cluster_defaults["spark_env_vars"],
+        **default_cluster_config.get("spark_env_vars", {}),
+    },
+    spark_version=default_cluster_config["spark_version"],
+)
+job_cluster_libraries = [
+    databricks.JobLibraryArgs(whl=whl) for whl in set(
+        default_cluster_config.get("libraries", {}).get("whl", []) +
+        default_cluster_defaults["libraries"]["whl"]
+    )
+] + [
+    databricks.JobLibraryArgs(pypi=databricks.JobLibraryPypiArgs(
+        package=lib.get("package"), repo=lib.get("repo")))
+    for lib in default_cluster_config.get("libraries", {}).get("pypi", [])
+]
 
 # ----------------------------------------------------------------------------------------------------------------------
 # ENGINEERING DATABRICKS WORKSPACE -> CLUSTERS -> PERMISSIONS
@@ -0,0 +1,161 @@
+import pulumi_azure_native as azure_native
+import pulumi_databricks as databricks
+import pulumi_random
+
+from pulumi import Output, ResourceOptions
+
+from ingenii_azure_data_platform.utils import generate_resource_name, lock_resource
+
+from management import resource_groups
+from network import dns, private_endpoints
+from project_config import platform_config, platform_outputs
+from security import credentials_store
+
+# An external Hive metastore shared by both workspaces, so tables created in
+# the engineering workspace are immediately available in the analytics one
+hive_metastore_config = platform_config["analytics_services"]["databricks"].get(
+    "hive_metastore", {}
+)
+
+# ----------------------------------------------------------------------------------------------------------------------
+# HIVE METASTORE -> SQL SERVER
+# ----------------------------------------------------------------------------------------------------------------------
+
+if hive_metastore_config.get("enabled"):
+    outputs = platform_outputs["analytics"]["databricks"]["hive_metastore"] = {}
+
+    server_name = generate_resource_name(
+        resource_type="sql_server",
+        resource_name="metastore",
+        platform_config=platform_config,
+    )
+    admin_username = hive_metastore_config.get("admin_username", "metastoreadmin")
+    database_name = hive_metastore_config.get("database_name", "hive_metastore")
+
+    admin_password = pulumi_random.RandomPassword(
+        resource_name=generate_resource_name(
+            resource_type="random_password",
+            resource_name="hive-metastore",
+            platform_config=platform_config,
+        ),
+        length=32,
+        min_lower=1,
+        min_numeric=1,
+        min_special=1,
+        min_upper=1,
+        # Kept out of the JDBC connection string syntax
+        override_special="!#$%*-_=+",
+    ).result
+
+    # Save admin creds in the credentials store
+    azure_native.keyvault.Secret(
+        resource_name=f"{server_name}-admin-creds",
+        secret_name=f"{server_name}-admin-creds",
+        properties=azure_native.keyvault.SecretPropertiesArgs(
+            value=admin_password.apply(
+                lambda password: f"username: {admin_username}, password: {password}"
+            )
+        ),
+        resource_group_name=resource_groups["security"].name,
+        vault_name=credentials_store.key_vault.name,
+    )
+
+    # Only reachable through the private endpoint
+    server = azure_native.sql.Server(
+        resource_name=server_name,
+        server_name=server_name,
+        administrator_login=admin_username,
+        administrator_login_password=admin_password,
+        location=platform_config.region.long_name,
+        resource_group_name=resource_groups["data"].name,
+        public_network_access=azure_native.sql.ServerPublicNetworkAccess.DISABLED,
+        minimal_tls_version=hive_metastore_config.get("minimal_tls_version", "1.2"),
+        tags=platform_config.tags,
+        opts=ResourceOptions(
+            ignore_changes=["administrators"],
+            protect=platform_config.resource_protection,
+        ),
+    )
+    if platform_config.resource_protection:
+        lock_resource(server_name, server.id)
+
+    database = azure_native.sql.Database(
+        resource_name=f"{server_name}-{database_name}",
+        database_name=database_name,
+        location=platform_config.region.long_name,
+        resource_group_name=resource_groups["data"].name,
+        server_name=server.name,
+        sku=azure_native.sql.SkuArgs(
+            capacity=hive_metastore_config.get("database_sku_capacity", 2),
+            family=hive_metastore_config.get("database_sku_family", "Gen5"),
+            name=hive_metastore_config.get("database_sku_name", "GP_S_Gen5_2"),
+        ),
+        tags=platform_config.tags,
+        opts=ResourceOptions(protect=platform_config.resource_protection),
+    )
+
+    private_endpoints.create_dtap_private_endpoint(
+        name="for-hive-metastore",
+        resource_id=server.id,
+        group_ids=["sqlServer"],
+        logs_metrics_config=hive_metastore_config.get("network", {}).get(
+            "private_endpoint", {}
+        ),
+        private_dns_zone_id=dns.sql_server_private_dns_zone.id,
+    )
+
+    outputs["server_name"] = server.name
+    outputs["database_name"] = database.name
+
+    jdbc_url = Output.concat(
+        "jdbc:sqlserver://", server.name, ".database.windows.net:1433;",
+        "database=", database.name, ";encrypt=true;trustServerCertificate=false;",
+        "hostNameInCertificate=*.database.windows.net;loginTimeout=30;",
+    )
+
+
+def create_hive_metastore_spark_conf(
+    workspace_name: str, secret_scope: databricks.SecretScope,
+    databricks_provider: databricks.Provider,
+) -> dict:
+    """
+    Add the metastore credentials to a workspace's secret scope, and return
+    the Spark configuration for clusters to use the shared metastore
+    """
+
+    username_secret = databricks.Secret(
+        resource_name=f"{workspace_name}-hive-metastore-username",
+        scope=secret_scope.id,
+        string_value=admin_username,
+        key="hive-metastore-username",
+        opts=ResourceOptions(provider=databricks_provider),
+    )
+    password_secret = databricks.Secret(
+        resource_name=f"{workspace_name}-hive-metastore-password",
+        scope=secret_scope.id,
+        string_value=admin_password,
+        key="hive-metastore-password",
+        opts=ResourceOptions(provider=databricks_provider),
+    )
+
+    return {
+        "spark.sql.hive.metastore.version": hive_metastore_config.get(
+            "version", "2.3.9"
+        ),
+        "spark.sql.hive.metastore.jars": hive_metastore_config.get(
+            "jars", "builtin"
+        ),
+        "spark.hadoop.javax.jdo.option.ConnectionURL": jdbc_url,
+        "spark.hadoop.javax.jdo.option.ConnectionDriverName":
+            "com.microsoft.sqlserver.jdbc.SQLServerDriver",
+        "spark.hadoop.javax.jdo.option.ConnectionUserName": Output.concat(
+            "{{secrets/", secret_scope.name, "/", username_secret.key, "}}"
+        ),
+        "spark.hadoop.javax.jdo.option.ConnectionPassword": Output.concat(
+            "{{secrets/", secret_scope.name, "/", password_secret.key, "}}"
+        ),
+        # Lets the first cluster to start create the metastore tables
+        "spark.hadoop.datanucleus.autoCreateSchema": "true",
+        "spark.hadoop.datanucleus.fixedDatastore": "false",
+        "spark.hadoop.hive.metastore.schema.verification": "false",
+    }
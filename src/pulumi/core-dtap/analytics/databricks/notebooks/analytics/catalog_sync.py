@@ -0,0 +1,289 @@
+# Databricks notebook source
+
+# MAGIC %md
+# MAGIC ### Catalog syncing functions
+# MAGIC Used by other notebooks in this folder through `%run ./catalog_sync`.
+# MAGIC The catalog is read once, storage is listed concurrently, and the missing schemas and tables are worked out in memory before any statements are run.
+# MAGIC After a successful sync, the table folders seen in each schema folder are recorded in a checkpoint table, so the next sync only needs to check the catalog for the schemas whose tables have changed since.
+# MAGIC Folder modification times aren't used, as on ADLS mounts they can be 0, or not change when a table folder is added.
+
+# COMMAND ----------
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from delta.tables import DeltaTable
+from pyspark.sql.functions import col
+
+# Upper bound on concurrent listings and statements
+max_workers = 16
+
+# Held in the utilities container, as it's the one this workspace can write to
+checkpoint_path = "/mnt/utilities/catalog_sync/checkpoint"
+checkpoint_schema = \
+    "container STRING, schema STRING, tables ARRAY<STRING>, " \
+    "date_synced TIMESTAMP"
+
+# COMMAND ----------
+
+
+def run_concurrently(function, arguments: list) -> list:
+    """
+    Call the function once for each argument, with at most max_workers calls
+    running at a time
+
+    Parameters
+    ----------
+    function : Callable
+        Function taking a single argument
+    arguments : list
+        The arguments to call the function with
+
+    Returns
+    -------
+    list
+        The results, in the same order as the arguments
+    """
+
+    if not arguments:
+        return []
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(arguments))) as executor:
+        return list(executor.map(function, arguments))
+
+
+def list_schema_folders(container: str) -> list:
+    """
+    Find the schema folders in a mounted container, laid out as
+    /mnt/<container>/<schema>/<table>
+
+    Parameters
+    ----------
+    container : str
+        The name of the container mount, e.g. 'models'
+
+    Returns
+    -------
+    list
+        The schema names
+    """
+
+    return [
+        folder.name.strip("/").lower()
+        for folder in dbutils.fs.ls(f"/mnt/{container}")
+        if folder.name.endswith("/")
+    ]
+
+
+def list_folder_tables(container: str, schemas: list) -> dict:
+    """
+    Find the table folders in some schema folders of a mounted container
+
+    Parameters
+    ----------
+    container : str
+        The name of the container mount, e.g. 'models'
+    schemas : list
+        The schema folders to list
+
+    Returns
+    -------
+    dict
+        Schema name to a dict of table name to table location
+    """
+
+    def list_schema(schema):
+        return {
+            folder.name.strip("/").lower():
+                f"/mnt/{container}/{schema}/{folder.name.strip('/').lower()}"
+            for folder in dbutils.fs.ls(f"/mnt/{container}/{schema}")
+            if folder.name.endswith("/")
+        }
+
+    return dict(zip(schemas, run_concurrently(list_schema, schemas)))
+
+
+def get_changed_schemas(container: str, folder_tables: dict) -> list:
+    """
+    Compare the table folders with the checkpoint of the last successful sync
+
+    Parameters
+    ----------
+    container : str
+        The name of the container mount, e.g. 'models'
+    folder_tables : dict
+        The output of list_folder_tables, covering every schema folder
+
+    Returns
+    -------
+    list
+        Schemas that are new, or whose table folders have changed, since the
+        last successful sync
+    """
+
+    if not DeltaTable.isDeltaTable(spark, checkpoint_path):
+        return list(folder_tables)
+
+    synced_tables = {
+        row.schema: set(row.tables)
+        for row in spark.read.format("delta").load(checkpoint_path)
+        .where(col("container") == container)
+        .select("schema", "tables").collect()
+    }
+    return [
+        schema for schema, tables in folder_tables.items()
+        if synced_tables.get(schema) != set(tables)
+    ]
+
+
+def save_checkpoint(container: str, folder_tables: dict) -> None:
+    """
+    Record the table folders that have been synced. Only call this once the
+    tables have all been registered
+
+    Parameters
+    ----------
+    container : str
+        The name of the container mount, e.g. 'models'
+    folder_tables : dict
+        The output of list_folder_tables, covering every schema folder
+    """
+
+    synced = spark.createDataFrame([
+        (container, schema, sorted(tables), datetime.utcnow())
+        for schema, tables in folder_tables.items()
+    ], checkpoint_schema)
+
+    if not DeltaTable.isDeltaTable(spark, checkpoint_path):
+        synced.write.format("delta").save(checkpoint_path)
+        return
+
+    checkpoint = DeltaTable.forPath(spark, checkpoint_path)
+    checkpoint.alias("checkpoint").merge(
+        synced.alias("synced"),
+        "checkpoint.container = synced.container "
+        "AND checkpoint.schema = synced.schema"
+    ).whenMatchedUpdateAll().whenNotMatchedInsertAll().execute()
+
+    # Forget schema folders that no longer exist
+    checkpoint.delete(
+        (col("container") == container)
+        & ~col("schema").isin(list(folder_tables))
+    )
+
+
+def get_known_tables(schemas: list) -> dict:
+    """
+    Find the tables the workspace already knows about
+
+    Parameters
+    ----------
+    schemas : list
+        The schemas to check
+
+    Returns
+    -------
+    dict
+        Schema name to a set of table names. Schemas that don't exist are
+        not included
+    """
+
+    known_schemas = {
+        database.databaseName.lower()
+        for database in spark.sql("SHOW DATABASES").collect()
+    }
+    existing_schemas = [
+        schema for schema in set(schemas) if schema in known_schemas
+    ]
+
+    def list_tables(schema):
+        return {
+            table.tableName.lower()
+            for table in spark.sql(f"SHOW TABLES FROM {schema}").collect()
+            if not table.isTemporary
+        }
+
+    return dict(zip(
+        existing_schemas, run_concurrently(list_tables, existing_schemas)))
+
+
+def register_tables(desired_tables: dict) -> dict:
+    """
+    Create any schemas and tables that the workspace doesn't already know
+    about
+
+    Parameters
+    ----------
+    desired_tables : dict
+        Schema name to a dict of table name to table location
+
+    Returns
+    -------
+    dict
+        Summary of the created schemas and tables, and any failures
+    """
+
+    known_tables = get_known_tables(list(desired_tables))
+
+    new_schemas = sorted(
+        schema for schema in desired_tables if schema not in known_tables)
+    new_tables = sorted(
+        (schema, table, location)
+        for schema, tables in desired_tables.items()
+        for table, location in tables.items()
+        if table not in known_tables.get(schema, set())
+    )
+
+    def run_statement(statement):
+        try:
+            spark.sql(statement)
+        except Exception as error:
+            return f"{statement}: {error}"
+
+    schema_failures = run_concurrently(run_statement, [
+        f"CREATE DATABASE IF NOT EXISTS {schema}" for schema in new_schemas
+    ])
+    table_failures = run_concurrently(run_statement, [
+        f"CREATE TABLE IF NOT EXISTS {schema}.{table} "
+        f"USING DELTA LOCATION '{location}'"
+        for schema, table, location in new_tables
+    ])
+
+    return {
+        "schemas": [
+            schema
+            for schema, failure in zip(new_schemas, schema_failures)
+            if not failure
+        ],
+        "tables": [
+            f"{schema}.{table}"
+            for (schema, table, _), failure in zip(new_tables, table_failures)
+            if not failure
+        ],
+        "failures": [
+            failure for failure in schema_failures + table_failures if failure
+        ],
+    }
+
+
+def print_summary(summary: dict) -> None:
+    """
+    Print what register_tables changed, and raise if anything failed
+
+    Parameters
+    ----------
+    summary : dict
+        The output of register_tables
+    """
+
+    print(f"Schemas created: {len(summary['schemas'])}")
+    for schema in summary["schemas"]:
+        print(f"    - {schema}")
+    print(f"Tables created: {len(summary['tables'])}")
+    for table in summary["tables"]:
+        print(f"    - {table}")
+
+    if summary["failures"]:
+        raise Exception("\n".join(
+            [f"{len(summary['failures'])} statements failed:"]
+            + summary["failures"]
+        ))
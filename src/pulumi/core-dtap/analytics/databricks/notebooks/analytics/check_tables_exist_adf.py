@@ -3,29 +3,76 @@
 # MAGIC %md
 # MAGIC ### To be used by Azure Data Factory only.
 # MAGIC If you want to sync the tables, use the `mount_tables` notebook in this folder
+# MAGIC Every new schema folder found by Data Factory is checked in this one run. If `auto_register` is `true`, any missing schemas and tables are created instead of failing the run.
 
 # COMMAND ----------
 
 from json import loads
 
-# E.g. "/mnt/source/schema1|{\"name\":\"table1\",\"type\":\"Folder\"}"
-schema_path, tables = dbutils.widgets.get("table_details").split("|")
+# COMMAND ----------
 
-schema = schema_path.split("/")[-1]
-spark.sql(f"CREATE SCHEMA IF NOT EXISTS {schema}")
+# MAGIC %run ./catalog_sync
 
-# Tables that the Analytics workspace already knows about
-known_tables = [table.tableName for table in spark.sql(f"SHOW TABLES FROM {schema}").collect()]
+# COMMAND ----------
+
+# E.g. '["/mnt/source/schema1|{\"name\":\"table1\",\"type\":\"Folder\"}", ...]'
+# A single "<schema path>|<tables>" entry is also accepted
+dbutils.widgets.text("table_details", "")
+table_details = dbutils.widgets.get("table_details")
+
+# Data Factory saves the details to a file instead, as they can be longer than a
+# notebook parameter can be
+dbutils.widgets.text("table_details_path", "")
+table_details_path = dbutils.widgets.get("table_details_path")
+if table_details_path:
+    with open(f"/dbfs{table_details_path}") as table_details_file:
+        table_details = table_details_file.read()
+    # Only needed by this run
+    dbutils.fs.rm(table_details_path)
+
+entries = loads(table_details) if table_details.startswith("[") \
+    else [table_details] if table_details else []
+
+# Create any missing tables, rather than failing
+dbutils.widgets.text("auto_register", "false")
+auto_register = dbutils.widgets.get("auto_register").lower() == "true"
 
-# Tables that ADF has told us about
-folder_tables = [loads(table_json_raw)["name"] for table_json_raw in tables.split(";")]
+# Tables that ADF has told us about, by schema
+desired_tables = {}
+for entry in entries:
+    schema_path, tables = entry.split("|")
+    schema = schema_path.split("/")[-1].lower()
+    for table_json_raw in tables.split(";"):
+        table = loads(table_json_raw)["name"]
+        desired_tables.setdefault(schema, {})[table.lower()] = \
+            f"{schema_path}/{table}"
+
+if not desired_tables:
+    dbutils.notebook.exit("No new table folders to check")
+
+# COMMAND ----------
+
+if auto_register:
+    print_summary(register_tables(desired_tables))
+    dbutils.notebook.exit("All tables registered")
+
+# Tables that the Analytics workspace already knows about
+known_tables = get_known_tables(list(desired_tables))
 
 # Any new tables
-new_tables = [table for table in folder_tables if table not in known_tables]
+new_tables = {
+    schema: sorted(
+        table for table in tables if table not in known_tables.get(schema, set()))
+    for schema, tables in desired_tables.items()
+}
+new_tables = {schema: tables for schema, tables in new_tables.items() if tables}
 if new_tables:
     raise Exception(" ".join([
             f"New tables not in the Analytics workspace!",
-            f"Schema: {schema}, tables: {str(sorted(new_tables))}.",
+            "; ".join(
+                f"Schema: {schema}, tables: {str(tables)}"
+                for schema, tables in sorted(new_tables.items())
+            ) + ".",
             "Run the notebook at /Shared/Ingenii Engineering/mount_tables to make these available in the Analytics workspace"
         ])
     )
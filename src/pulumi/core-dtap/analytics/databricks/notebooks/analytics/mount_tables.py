@@ -3,7 +3,7 @@
 # MAGIC %md
 # MAGIC ### Create tables for any new data
 # MAGIC To be run whenever new tables are created in the engineering workspace and are needed here
-# MAGIC This is always safe to run
+# MAGIC This is always safe to run. Only model and snapshot schemas whose table folders have changed since the last successful run are checked against the catalog; set `full_sync` to `true` to check everything
 
 # COMMAND ----------
 
@@ -13,55 +13,37 @@
 
 # COMMAND ----------
 
-from pyspark.sql.functions import col
+# MAGIC %run ./catalog_sync
 
-# Add all known source tables. Avoid any individual tables
-known_databases = [db.databaseName for db in spark.sql(f"SHOW DATABASES").collect()]
-known_sources = spark.table("orchestration.import_file").select("source").distinct().collect()
-
-for source in known_sources:
-    if source.source.lower() not in known_databases:
-        spark.sql(f"CREATE DATABASE {source.source}")
+# COMMAND ----------
 
-    known_tables = spark.table("orchestration.import_file").where(col("source") == source.source).select("table").distinct().collect()
-    mounted_tables = [table.tableName for table in spark.sql(f"SHOW TABLES FROM {source.source}").collect()]
-    for known_table in known_tables:
-        if known_table.table.lower() not in mounted_tables:
-            print(f"Adding table {source.source}.{known_table.table}")
-            spark.sql(f"CREATE TABLE {source.source}.{known_table.table} USING DELTA LOCATION '/mnt/source/{source.source}/{known_table.table}'")
+dbutils.widgets.dropdown("full_sync", "false", ["false", "true"])
+full_sync = dbutils.widgets.get("full_sync") == "true"
 
 # COMMAND ----------
 
-# Add any model tables
-known_databases = [db.databaseName for db in spark.sql(f"SHOW DATABASES").collect()]
+# All known source tables, from a single pass over the orchestration table. Avoid any individual tables
+desired_tables = {}
+for row in spark.table("orchestration.import_file").select("source", "table").distinct().collect():
+    desired_tables.setdefault(row.source.lower(), {})[row.table.lower()] = \
+        f"/mnt/source/{row.source}/{row.table}"
 
-for schema in dbutils.fs.ls("/mnt/models"):
-  schema = schema.name.strip("/").lower()
-  if schema not in known_databases:
-    spark.sql(f"CREATE DATABASE {schema}")
+# Any model and snapshot tables in schema folders that have changed
+folder_tables = {}
+for container in ("models", "snapshots"):
+    folder_tables[container] = \
+        list_folder_tables(container, list_schema_folders(container))
+    changed_schemas = list(folder_tables[container]) if full_sync \
+        else get_changed_schemas(container, folder_tables[container])
 
-  known_tables = [table.tableName for table in spark.sql(f"SHOW TABLES FROM {schema}").collect()]
-  for table in dbutils.fs.ls(f"/mnt/models/{schema}"):
-    table = table.name.strip("/").lower()
-    if table not in known_tables:
-      print(f"Adding model {schema}.{table}")
-      spark.sql(f"CREATE TABLE {schema}.{table} USING DELTA LOCATION '/mnt/models/{schema}/{table}'")
+    for schema in changed_schemas:
+        for table, location in folder_tables[container][schema].items():
+            desired_tables.setdefault(schema, {}).setdefault(table, location)
 
 # COMMAND ----------
 
-# Add any snapshot tables
-known_databases = [db.databaseName for db in spark.sql(f"SHOW DATABASES").collect()]
-
-for schema in dbutils.fs.ls("/mnt/snapshots"):
-  schema = schema.name.strip("/").lower()
-  if schema not in known_databases:
-    spark.sql(f"CREATE DATABASE {schema}")
+print_summary(register_tables(desired_tables))
 
-  known_tables = [table.tableName for table in spark.sql(f"SHOW TABLES FROM {schema}").collect()]
-  for table in dbutils.fs.ls(f"/mnt/snapshots/{schema}"):
-    table = table.name.strip("/").lower()
-    if table not in known_tables:
-      print(f"Adding snapshot {schema}.{table}")
-      spark.sql(f"CREATE TABLE {schema}.{table} USING DELTA LOCATION '/mnt/snapshots/{schema}/{table}'")
-
-# COMMAND ----------
+# Everything is registered, so the next run can skip these folders
+for container in folder_tables:
+    save_checkpoint(container, folder_tables[container])
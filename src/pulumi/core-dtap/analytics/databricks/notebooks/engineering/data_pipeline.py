@@ -1,11 +1,10 @@
 # Databricks notebook source
 
+from datetime import datetime
 from os import environ
 from py4j.protocol import Py4JJavaError
 from typing import Union
 
-from ingenii_data_engineering.dbt_schema import get_project_config, get_source
-
 from ingenii_databricks.enums import Stage
 from ingenii_databricks.pipeline import add_to_source_table, archive_file, \
     create_file_table, move_rows_to_review, prepare_individual_table_yml, \
@@ -13,7 +12,15 @@ from ingenii_databricks.pipeline import add_to_source_table, archive_file, \
     revert_individual_table_yml, test_file_table
 from ingenii_databricks.orchestration import ImportFileEntry
 from ingenii_databricks.validation import check_parameters, \
-    check_source_schema, compare_schema_and_table
+    compare_schema_and_table
+
+# COMMAND ----------
+
+# MAGIC %run ./dbt_schema_cache
+
+# COMMAND ----------
+
+# MAGIC %run ./source_table_merge
 
 # COMMAND ----------
 
@@ -64,10 +71,9 @@ databricks_dbt_token = None
 
 # COMMAND ----------
 
-source_details = get_source(dbt_root_folder, source)
-
-# Check that the schema for this particular source is acceptable
-check_source_schema(source_details)
+# Check that the schema for this particular source is acceptable. Cached
+# until the dbt project changes
+source_details = get_cached_source(dbt_root_folder, source)
 
 if table_name not in source_details["tables"]:
     raise Exception(
@@ -146,7 +152,10 @@ if import_entry.is_stage(Stage.STAGED):
 
 # Append / Merge into main table
 if import_entry.is_stage(Stage.CLEANED):
-    add_to_source_table(spark, import_entry, table_schema)
+    if table_schema.get("pruning"):
+        add_to_pruned_source_table(spark, import_entry, table_schema)
+    else:
+        add_to_source_table(spark, import_entry, table_schema)
     import_entry.update_status(Stage.INSERTED)
 
 # COMMAND ----------
@@ -172,12 +181,21 @@ if final_stage != Stage.COMPLETED:
 # COMMAND ----------
 
 # Propagate this source data to downstream models and snapshots
-if databricks_dbt_token is None:
-    databricks_dbt_token = \
-        dbutils.secrets.get(scope=environ["DBT_TOKEN_SCOPE"],
-                            key=environ["DBT_TOKEN_NAME"])
-
-project_name = get_project_config(dbt_root_folder)["name"]
-propagate_source_data(
-    databricks_dbt_token, project_name,
-    import_entry.source, import_entry.table)
+if environ.get("PROPAGATION_MODE", "immediate") == "scheduled":
+    # Mark the table as changed. The propagate_sources job picks these up
+    # and runs a single propagation for each burst of files
+    spark.createDataFrame(
+        [(import_entry.source, import_entry.table, datetime.utcnow())],
+        "source STRING, table STRING, date_marked TIMESTAMP"
+    ).write.format("delta").mode("append") \
+        .save(environ["PROPAGATION_QUEUE_PATH"])
+else:
+    if databricks_dbt_token is None:
+        databricks_dbt_token = \
+            dbutils.secrets.get(scope=environ["DBT_TOKEN_SCOPE"],
+                                key=environ["DBT_TOKEN_NAME"])
+
+    project_name = get_cached_project_config(dbt_root_folder)["name"]
+    propagate_source_data(
+        databricks_dbt_token, project_name,
+        import_entry.source, import_entry.table)
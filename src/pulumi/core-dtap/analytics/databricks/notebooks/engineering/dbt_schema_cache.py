@@ -0,0 +1,209 @@
+# Databricks notebook source
+
+# MAGIC %md
+# MAGIC ### Cached dbt project configuration and source schemas
+# MAGIC Used by other notebooks in this folder through `%run ./dbt_schema_cache`.
+# MAGIC Parsing the dbt YAML files over the `/dbfs` mount is slow for large projects, so the parsed and validated results are kept on the cluster's local disk for the life of the cluster.
+# MAGIC Each entry records the path and modification time of the YAML files it was created from, so a lookup only checks those files, and any change to them is picked up on the next run.
+
+# COMMAND ----------
+
+from hashlib import md5
+from os import environ, getpid, makedirs, path, rename, stat, walk
+from pickle import dump, load
+from yaml import safe_load
+
+from ingenii_data_engineering.dbt_schema import get_project_config, get_source
+from ingenii_databricks.validation import check_source_schema
+
+dbt_schema_cache_folder = environ.get(
+    "DBT_SCHEMA_CACHE_FOLDER", "/local_disk0/tmp/dbt_schema_cache")
+
+# Folders dbt generates, which never hold project or schema YAML
+dbt_generated_folders = ("dbt_modules", "dbt_packages", "logs", "target")
+
+# In-memory copies, for repeated lookups within the same run
+dbt_schema_cache = {}
+
+# COMMAND ----------
+
+
+def get_file_modification_times(file_paths: list) -> dict:
+    """
+    Get the modification time of each file, or None if it no longer exists
+
+    Parameters
+    ----------
+    file_paths : list
+        The paths of the files
+
+    Returns
+    -------
+    dict
+        The modification time of each file, keyed by file path
+    """
+
+    modification_times = {}
+    for file_path in file_paths:
+        try:
+            modification_times[file_path] = stat(file_path).st_mtime
+        except FileNotFoundError:
+            modification_times[file_path] = None
+    return modification_times
+
+
+def find_source_files(dbt_root_folder: str, source: str) -> list:
+    """
+    Find the YAML files in the dbt project that define a source. Only used
+    when there is no valid cache entry for the source
+
+    Parameters
+    ----------
+    dbt_root_folder : str
+        The root folder of the dbt project
+    source : str
+        The name of the source
+
+    Returns
+    -------
+    list
+        The paths of the YAML files that define the source
+    """
+
+    source_files = []
+    for folder, sub_folders, file_names in walk(dbt_root_folder):
+        if folder == dbt_root_folder:
+            sub_folders[:] = [
+                sub_folder for sub_folder in sub_folders
+                if sub_folder not in dbt_generated_folders
+            ]
+        for file_name in file_names:
+            if not file_name.endswith((".yml", ".yaml")):
+                continue
+            file_path = path.join(folder, file_name)
+            try:
+                with open(file_path) as yaml_file:
+                    contents = safe_load(yaml_file)
+            except Exception:
+                # Not a file dbt could read the source from
+                continue
+            if not isinstance(contents, dict):
+                continue
+            if any(
+                isinstance(source_entry, dict)
+                and source_entry.get("name") == source
+                for source_entry in contents.get("sources") or []
+            ):
+                source_files.append(file_path)
+
+    return source_files
+
+
+def get_cached(key: str, find_files, create_value):
+    """
+    Return the value from the cache, or create it and add it to the cache if
+    any of the files it was created from have changed since it was cached
+
+    Parameters
+    ----------
+    key : str
+        The name of the cache entry
+    find_files : Callable
+        Function with no arguments that returns the paths of the files the
+        value is created from
+    create_value : Callable
+        Function with no arguments that creates the value from the dbt project
+
+    Returns
+    -------
+    Any
+        The value, either from the cache or newly created
+    """
+
+    cache_key = md5(key.encode()).hexdigest()
+
+    def is_current(entry):
+        return entry["files"] and \
+            get_file_modification_times(entry["files"]) == entry["files"]
+
+    if cache_key in dbt_schema_cache and is_current(dbt_schema_cache[cache_key]):
+        return dbt_schema_cache[cache_key]["value"]
+
+    cache_file = f"{dbt_schema_cache_folder}/{cache_key}.pickle"
+    if path.exists(cache_file):
+        try:
+            with open(cache_file, "rb") as cache_file_handle:
+                entry = load(cache_file_handle)
+            if is_current(entry):
+                dbt_schema_cache[cache_key] = entry
+                return entry["value"]
+        except Exception:
+            # A partial or outdated file, so recreate it
+            pass
+
+    # Record the modification times before reading the files, so a change
+    # made while the value is created is picked up by the next lookup
+    files = get_file_modification_times(find_files())
+    entry = {"files": files, "value": create_value()}
+    dbt_schema_cache[cache_key] = entry
+
+    # Write then rename, as other runs on this cluster may read at any time
+    makedirs(dbt_schema_cache_folder, exist_ok=True)
+    temporary_file = f"{cache_file}.{getpid()}"
+    with open(temporary_file, "wb") as cache_file_handle:
+        dump(entry, cache_file_handle)
+    rename(temporary_file, cache_file)
+
+    return entry["value"]
+
+
+def get_cached_project_config(dbt_root_folder: str) -> dict:
+    """
+    Cached version of get_project_config, refreshed when dbt_project.yml
+    changes
+
+    Parameters
+    ----------
+    dbt_root_folder : str
+        The root folder of the dbt project
+
+    Returns
+    -------
+    dict
+        The dbt project configuration
+    """
+
+    return get_cached(
+        f"{dbt_root_folder}|project",
+        lambda: [path.join(dbt_root_folder, "dbt_project.yml")],
+        lambda: get_project_config(dbt_root_folder))
+
+
+def get_cached_source(dbt_root_folder: str, source: str) -> dict:
+    """
+    Cached version of get_source, which has also passed check_source_schema,
+    refreshed when a YAML file defining the source changes. Sources that fail
+    the check are not cached, so the check is run again
+
+    Parameters
+    ----------
+    dbt_root_folder : str
+        The root folder of the dbt project
+    source : str
+        The name of the source
+
+    Returns
+    -------
+    dict
+        The source details, including the schemas of all its tables
+    """
+
+    def create_source_details():
+        source_details = get_source(dbt_root_folder, source)
+        check_source_schema(source_details)
+        return source_details
+
+    return get_cached(
+        f"{dbt_root_folder}|source|{source}",
+        lambda: find_source_files(dbt_root_folder, source),
+        create_source_details)
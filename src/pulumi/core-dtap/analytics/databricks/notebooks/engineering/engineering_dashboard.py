@@ -1,9 +1,81 @@
 # Databricks notebook source
+# MAGIC %run ./import_file_summary
+
+# COMMAND ----------
+
+from datetime import date, timedelta
+from pyspark.sql.functions import col
+
+dbutils.widgets.text("summary_source", "", "Summary source")
+dbutils.widgets.text("summary_days", "30", "Summary days")
+
+# Files, rows, incomplete files and durations for each source, table and day. Only read here, as the summary is kept
+# up to date by the 'Update import file summary' job
+if DeltaTable.isDeltaTable(spark, import_file_summary_path):
+    summary = spark.read.format("delta").load(import_file_summary_path) \
+        .where(col("date") >= date.today() - timedelta(days=int(dbutils.widgets.get("summary_days"))))
+    if dbutils.widgets.get("summary_source"):
+        summary = summary.where(col("source") == dbutils.widgets.get("summary_source"))
+    display(summary.orderBy(col("date").desc(), "source", "table"))
+else:
+    print("The import file summary hasn't been created yet, by the 'Update import file summary' job")
+
+# COMMAND ----------
+
+# Depth and oldest age of the Data Factory ingestion queue, as last read by a drain of the deferred files. The
+# history is in the Log Analytics workspace, through the IngestionQueue function
+import json
+
+try:
+    ingestion_queue = json.loads(dbutils.fs.head("/mnt/orchestration/ingestion_queue.json"))
+    display(spark.createDataFrame(
+        [(ingestion_queue["depth"], ingestion_queue["oldest_age_minutes"], ingestion_queue["date_read"])],
+        "queued_files LONG, oldest_age_minutes LONG, date_read STRING"
+    ))
+except Exception:
+    print("Ingestion queue not read yet. It is read when ingestion backpressure is enabled")
+
+# COMMAND ----------
+
+# Files deferred while the ingestion queue was backed up, waiting for the next drain
+from datetime import datetime
+
+try:
+    source_folders = dbutils.fs.ls("/mnt/orchestration/deferred_files")
+except Exception:
+    source_folders = []  # Nothing has been deferred yet
+
+# Markers are kept in a folder for each source and table
+deferred_files = []
+for source_folder in source_folders:
+    for table_folder in dbutils.fs.ls(source_folder.path):
+        for marker in dbutils.fs.ls(table_folder.path):
+            deferred_files.append((
+                source_folder.name.strip("/"), table_folder.name.strip("/"),
+                datetime.utcfromtimestamp(marker.modificationTime / 1000)
+            ))
+
+if deferred_files:
+    from pyspark.sql.functions import count, current_timestamp, min as spark_min, unix_timestamp
+    display(
+        spark.createDataFrame(deferred_files, "source STRING, table STRING, date_deferred TIMESTAMP")
+        .groupBy("source", "table")
+        .agg(count("*").alias("deferred_files"), spark_min("date_deferred").alias("oldest_deferred"))
+        .withColumn("oldest_age_minutes",
+                    (unix_timestamp(current_timestamp()) - unix_timestamp("oldest_deferred")) / 60)
+        .orderBy(col("deferred_files").desc())
+    )
+else:
+    print("No deferred files")
+
+# COMMAND ----------
+
 from ingenii_databricks.dashboard_utils import create_widgets
 create_widgets(spark, dbutils)
 
 # COMMAND ----------
 
+# Individual import file entries. This reads orchestration.import_file, so use the filters to keep it small
 from ingenii_databricks.dashboard_utils import filtered_import_table
 display(filtered_import_table(spark, dbutils))
 
@@ -28,17 +100,14 @@ display(filtered_import_table(spark, dbutils))
 
 # COMMAND ----------
 
-# Script to ingest incomplete files
-# from pyspark.sql.functions import col
-# incomplete = spark.table("orchestration.import_file").where(col("date_completed").isNull())
-
-# for row in incomplete.collect():
-#   dbutils.notebook.run("/Shared/Ingenii Engineering/data_pipeline", 600, {
-#       "source": row.source,
-#       "table": row.table,
-#       "file_name": row.file_name,
-#       "increment": row.increment
-#   })
+# Script to ingest incomplete files. Tables are run concurrently, with retries, and can be filtered by source, table
+# and arrival date
+# dbutils.notebook.run("/Shared/Ingenii Engineering/reingest_files", 0, {
+#     "source": "",
+#     "table": "",
+#     "date_from": "",
+#     "date_to": "",
+# })
 
 # COMMAND ----------
 
@@ -0,0 +1,186 @@
+# Databricks notebook source
+
+# MAGIC %md
+# MAGIC ### Import file summary
+# MAGIC Used by other notebooks in this folder through `%run ./import_file_summary`.
+# MAGIC Keeps a Delta table with the number of files, rows, incomplete files and durations for each source, table and day, so the engineering dashboard doesn't have to scan `orchestration.import_file`.
+# MAGIC The summary is updated on a schedule by the 'Update import file summary' job. Each update reads the change data feed of `orchestration.import_file` since the version last summarised, and only recalculates the days those changes fall on.
+# MAGIC Each update then writes every table's p99 ingestion time, worked out from the summary table, over the last two weeks to `ingestion_timeouts/timeouts.json` in the orchestration container, which Data Factory reads to set adaptive timeouts.
+
+# COMMAND ----------
+
+import json
+from datetime import date, timedelta
+from math import ceil
+from os import makedirs, path
+
+from delta.tables import DeltaTable
+from pyspark.sql.functions import avg, broadcast, coalesce, col, count, lit, \
+    max as spark_max, min as spark_min, percentile_approx, sum as spark_sum, \
+    to_date, unix_timestamp
+
+import_file_summary_path = "/mnt/orchestration/import_file_summary"
+# Table property of the summary, holding the import_file version it's up to
+summary_version_property = "ingenii.import_file_version"
+ingestion_timeouts_path = "/dbfs/mnt/orchestration/ingestion_timeouts/timeouts.json"
+ingestion_timeouts_days = 14
+
+# COMMAND ----------
+
+
+def summarise(import_file):
+    """ Aggregate import file entries, with a 'date' column, by source, table and day """
+
+    duration = unix_timestamp("date_completed") - unix_timestamp("date_new")
+    return import_file \
+        .groupBy("source", "table", "date") \
+        .agg(
+            count(lit(1)).alias("files"),
+            count("date_completed").alias("files_completed"),
+            (count(lit(1)) - count("date_completed")).alias("files_incomplete"),
+            spark_sum("rows_read").alias("rows_read"),
+            avg(duration).alias("average_seconds"),
+            spark_max(duration).alias("max_seconds"),
+            percentile_approx(duration, 0.99).alias("p99_seconds"),
+        )
+
+
+def get_summarised_version():
+    """ The import_file version the summary is up to, if there is a summary """
+
+    if not DeltaTable.isDeltaTable(spark, import_file_summary_path):
+        return None
+    version = spark.sql(f"DESCRIBE DETAIL delta.`{import_file_summary_path}`") \
+        .first()["properties"].get(summary_version_property)
+    return int(version) if version is not None else None
+
+
+def set_summarised_version(version: int) -> None:
+    spark.sql(
+        f"ALTER TABLE delta.`{import_file_summary_path}` "
+        f"SET TBLPROPERTIES ('{summary_version_property}' = '{version}')"
+    )
+
+
+def merge_summary(summary) -> None:
+    """ Replace the summary of the days in the given summary """
+
+    # Summaries created before the p99 was kept. Altered before loading the
+    # table, so the merge sees the new column
+    summary_columns = \
+        spark.read.format("delta").load(import_file_summary_path).columns
+    if "p99_seconds" not in summary_columns:
+        spark.sql(
+            f"ALTER TABLE delta.`{import_file_summary_path}` "
+            f"ADD COLUMNS (p99_seconds BIGINT AFTER max_seconds)"
+        )
+
+    DeltaTable.forPath(spark, import_file_summary_path).alias("summary") \
+        .merge(
+            summary.alias("changes"),
+            "summary.source = changes.source AND summary.table = changes.table "
+            "AND summary.date = changes.date"
+        ) \
+        .whenMatchedUpdateAll() \
+        .whenNotMatchedInsertAll() \
+        .execute()
+
+
+def update_import_file_summary() -> None:
+    """
+    Recalculate the summary for every source, table and day with an import
+    file entry that has changed since the last update, then write the
+    ingestion timeouts from it. The first update, or one whose changes are
+    no longer available, summarises the whole table
+    """
+
+    # Changes are only recorded once the feed is enabled, by the first update
+    import_file_properties = spark.sql(
+        "DESCRIBE DETAIL orchestration.import_file").first()["properties"]
+    if import_file_properties.get("delta.enableChangeDataFeed") != "true":
+        spark.sql(
+            "ALTER TABLE orchestration.import_file "
+            "SET TBLPROPERTIES (delta.enableChangeDataFeed = true)"
+        )
+
+    current_version = spark.sql(
+        "DESCRIBE HISTORY orchestration.import_file LIMIT 1").first()["version"]
+    summarised_version = get_summarised_version()
+    if summarised_version == current_version:
+        # The two week window still moves on
+        write_ingestion_timeouts()
+        return
+
+    import_file = spark.sql(
+        f"SELECT * FROM orchestration.import_file VERSION AS OF {current_version}"
+    ).withColumn("date", to_date("date_new"))
+
+    if summarised_version is not None:
+        try:
+            affected = spark.read.format("delta") \
+                .option("readChangeFeed", "true") \
+                .option("startingVersion", summarised_version + 1) \
+                .option("endingVersion", current_version) \
+                .table("orchestration.import_file") \
+                .select("source", "table", to_date("date_new").alias("date")) \
+                .distinct() \
+                .cache()
+            earliest_date = affected.agg(spark_min("date")).first()[0]
+        except Exception as error:
+            print(
+                "Unable to read the import file changes, so summarising the "
+                f"whole table: {error}"
+            )
+            summarised_version = None
+
+    if summarised_version is None:
+        summarise(import_file).write.format("delta") \
+            .mode("overwrite") \
+            .option("overwriteSchema", "true") \
+            .save(import_file_summary_path)
+    elif earliest_date is not None:
+        # Filtering on date_new lets Delta skip the files of older entries
+        merge_summary(summarise(
+            import_file
+            .where(col("date_new") >= lit(earliest_date))
+            .join(broadcast(affected), ["source", "table", "date"])
+        ))
+        affected.unpersist()
+
+    set_summarised_version(current_version)
+    write_ingestion_timeouts()
+
+
+def write_ingestion_timeouts() -> None:
+    """
+    Write the highest daily p99 ingestion time of each table over the last
+    two weeks, keyed by the table's raw folder. Days summarised before the
+    p99 was kept use their maximum instead
+    """
+
+    timeouts = {
+        f"raw/{row.source}/{row.table}": ceil(row.p99_seconds)
+        for row in spark.read.format("delta").load(import_file_summary_path)
+        .where(col("date") >= date.today() - timedelta(days=ingestion_timeouts_days))
+        .groupBy("source", "table")
+        .agg(spark_max(coalesce("p99_seconds", "max_seconds")).alias("p99_seconds"))
+        .where(col("p99_seconds").isNotNull())
+        .collect()
+    }
+
+    makedirs(path.dirname(ingestion_timeouts_path), exist_ok=True)
+    with open(ingestion_timeouts_path, "w") as timeouts_file:
+        json.dump(timeouts, timeouts_file)
+
+
+def get_ingestion_timeouts() -> dict:
+    """
+    Read the p99 ingestion time of each table, in seconds. Empty if they
+    haven't been written yet
+    """
+
+    try:
+        with open(ingestion_timeouts_path) as timeouts_file:
+            return json.load(timeouts_file)
+    except FileNotFoundError:
+        return {}
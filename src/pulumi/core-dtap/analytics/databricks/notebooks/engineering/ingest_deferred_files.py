@@ -0,0 +1,145 @@
+# Databricks notebook source
+
+# MAGIC %md
+# MAGIC ### Ingest deferred files
+# MAGIC Run by the Data Factory 'Drain deferred files' trigger, as a run of the ingestion pipeline. When the ingestion queue is backed up, new raw files are deferred by writing a marker with the file's details to a folder for their source and table, rather than queueing another pipeline run. Once a table has markers, its later files are deferred as well.
+# MAGIC This ingests the deferred files for each table as a single batch through the `ingest_file_batch` notebook, in the order they were deferred, with different tables running concurrently. As the ingestion pipeline only has one run at a time, nothing else writes to these tables meanwhile, and no new markers are written. Markers are removed once their file has completed, so failed files, and the files after them, are retried by the next drain.
+
+# COMMAND ----------
+
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+from pyspark.sql.functions import col
+
+# COMMAND ----------
+
+dbutils.widgets.text("deferred_files_path", "/mnt/orchestration/deferred_files", "Deferred files path")
+dbutils.widgets.text("max_workers", "4", "Tables run at once")
+
+deferred_files_path = dbutils.widgets.get("deferred_files_path")
+max_workers = int(dbutils.widgets.get("max_workers"))
+
+# Passed on to each batch
+batch_parameters = {}
+for parameter_name, default in [
+    ("timeout_seconds", "1200"), ("max_retries", "0"), ("backoff_seconds", "30"),
+    ("p99_multiplier", "0"), ("min_timeout_minutes", "5"),
+    ("max_timeout_minutes", "120"),
+]:
+    dbutils.widgets.text(parameter_name, default)
+    batch_parameters[parameter_name] = dbutils.widgets.get(parameter_name)
+
+batch_notebook = "/Shared/Ingenii Engineering/ingest_file_batch"
+
+# COMMAND ----------
+
+# Markers from before they were kept in a folder for each table
+for marker in dbutils.fs.ls(deferred_files_path):
+    if marker.name.endswith(".json"):
+        source, table = json.loads(dbutils.fs.head(marker.path))["filePath"] \
+            .replace("raw/", "").strip("/").split("/")
+        dbutils.fs.mv(marker.path, f"{deferred_files_path}/{source}/{table}/{marker.name}")
+
+# Each table's deferred files, in the order they were deferred, with the
+# markers to remove once ingested
+table_markers = {}
+for source_folder in dbutils.fs.ls(deferred_files_path):
+    for table_folder in dbutils.fs.ls(source_folder.path):
+        markers = sorted(
+            (marker for marker in dbutils.fs.ls(table_folder.path)
+             if marker.name.endswith(".json")),
+            key=lambda marker: (marker.modificationTime, marker.name)
+        )
+        if not markers:
+            # Emptied by an earlier drain. Removed, so the next drain only
+            # starts Databricks when there are files
+            dbutils.fs.rm(table_folder.path, True)
+            continue
+        source, table = \
+            source_folder.name.strip("/"), table_folder.name.strip("/")
+        table_markers[(source, table)] = [
+            (json.loads(dbutils.fs.head(marker.path))["fileName"], marker.path)
+            for marker in markers
+        ]
+    if not dbutils.fs.ls(source_folder.path):
+        dbutils.fs.rm(source_folder.path, True)
+
+if not table_markers:
+    dbutils.notebook.exit("No deferred files")
+
+print(f"Draining {sum(len(markers) for markers in table_markers.values())} "
+      f"deferred files across {len(table_markers)} tables")
+
+# COMMAND ----------
+
+
+def drain_table(source_table: tuple) -> tuple:
+    """
+    Ingest a table's deferred files as one batch, and remove the markers of
+    the files that completed
+
+    Parameters
+    ----------
+    source_table : tuple
+        The source and table names
+
+    Returns
+    -------
+    tuple
+        The source, table, number of deferred files, number completed and
+        any error from the batch
+    """
+
+    source, table = source_table
+    markers = table_markers[source_table]
+    file_names = list(dict.fromkeys(file_name for file_name, _ in markers))
+
+    error = None
+    try:
+        dbutils.notebook.run(batch_notebook, 0, {
+            "source": source,
+            "table": table,
+            "files": json.dumps(file_names),
+            **batch_parameters,
+        })
+    except Exception as run_error:
+        error = str(run_error)
+
+    completed = {
+        row.file_name
+        for row in spark.table("orchestration.import_file")
+        .where(
+            (col("source") == source) & (col("table") == table)
+            & col("file_name").isin(file_names)
+            & col("date_completed").isNotNull()
+        )
+        .select("file_name").collect()
+    }
+    for file_name, marker_path in markers:
+        if file_name in completed:
+            dbutils.fs.rm(marker_path)
+    if len(completed) == len(file_names):
+        dbutils.fs.rm(f"{deferred_files_path}/{source}/{table}", True)
+
+    return source, table, len(file_names), len(completed), error
+
+
+# COMMAND ----------
+
+with ThreadPoolExecutor(
+        max_workers=max(1, min(max_workers, len(table_markers)))) as executor:
+    results = list(executor.map(drain_table, table_markers))
+
+for source, table, n_files, n_completed, error in results:
+    print(f"    - {source}.{table}: {n_completed} of {n_files} completed"
+          + (f" - {error}" if error else ""))
+
+# COMMAND ----------
+
+n_failed = sum(1 for result in results if result[4])
+if n_failed:
+    raise Exception(
+        f"{n_failed} of {len(results)} tables had files that failed. These "
+        f"stay deferred and are retried by the next drain"
+    )
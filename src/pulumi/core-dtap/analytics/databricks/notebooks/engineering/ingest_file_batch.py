@@ -0,0 +1,140 @@
+# Databricks notebook source
+
+# MAGIC %md
+# MAGIC ### Ingest a batch of files
+# MAGIC Entry point for the Data Factory micro-batch pipelines. Each run is given the files that landed in one tumbling window for a single source and table, and runs the `data_pipeline` notebook for each of them on this cluster, so the orchestration overhead is paid once per window rather than once per file.
+# MAGIC Files are ingested one at a time, a window's files in name order and a list given with `files`, such as the deferred files of a drain, in its own order. Files already completed, for example when a window is retried or backfilled, are skipped. Failed files are retried with an exponential backoff. If a file still fails, the later files are skipped and the run fails, so Data Factory retries the window.
+# MAGIC When `p99_multiplier` is set, each file's timeout is that multiple of the table's p99 ingestion time, kept in the import file summary, within the minimum and maximum.
+
+# COMMAND ----------
+
+import json
+from datetime import datetime
+from time import sleep
+
+from pyspark.sql.functions import col
+
+# COMMAND ----------
+
+dbutils.widgets.text("source", "", "Source")
+dbutils.widgets.text("table", "", "Table")
+dbutils.widgets.text("files", "[]", "Files (JSON list)")
+dbutils.widgets.text("files_path", "", "Files (path to a JSON list)")
+dbutils.widgets.text("window_start", "", "Window start")
+dbutils.widgets.text("timeout_seconds", "1200", "Timeout per file (seconds)")
+dbutils.widgets.text("max_retries", "0", "Retries per file")
+dbutils.widgets.text("backoff_seconds", "30", "First retry wait (seconds)")
+dbutils.widgets.text("p99_multiplier", "0", "Timeout as a multiple of p99 (0 to disable)")
+dbutils.widgets.text("min_timeout_minutes", "5", "Minimum timeout (minutes)")
+dbutils.widgets.text("max_timeout_minutes", "120", "Maximum timeout (minutes)")
+
+source = dbutils.widgets.get("source")
+table = dbutils.widgets.get("table")
+window_start = dbutils.widgets.get("window_start")
+timeout_seconds = int(dbutils.widgets.get("timeout_seconds"))
+max_retries = int(dbutils.widgets.get("max_retries"))
+backoff_seconds = int(dbutils.widgets.get("backoff_seconds"))
+p99_multiplier = float(dbutils.widgets.get("p99_multiplier"))
+
+pipeline_notebook = "/Shared/Ingenii Engineering/data_pipeline"
+
+# Data Factory saves the window's files to a file instead, as they can be
+# longer than a notebook parameter can be
+files = dbutils.widgets.get("files")
+files_path = dbutils.widgets.get("files_path")
+if files_path:
+    with open(f"/dbfs{files_path}") as files_file:
+        files = files_file.read()
+    # Only needed by this run. A retried window lists its files again
+    dbutils.fs.rm(files_path)
+
+# E.g. '[{"name":"file1.csv","type":"File"}, ...]' from Data Factory, or a
+# plain list of file names when run by hand
+file_names = [
+    entry["name"] if isinstance(entry, dict) else entry
+    for entry in json.loads(files)
+]
+# Data Factory lists a window's files in no particular order
+if files_path:
+    file_names.sort()
+
+if not source or not table:
+    raise Exception("Both the 'source' and 'table' parameters are required")
+
+if not file_names:
+    dbutils.notebook.exit("No files in this window")
+
+# COMMAND ----------
+
+# MAGIC %run ./import_file_summary
+
+# COMMAND ----------
+
+table_p99_seconds = get_ingestion_timeouts().get(f"raw/{source}/{table}")
+if p99_multiplier and table_p99_seconds:
+    timeout_seconds = 60 * min(
+        max(
+            int(table_p99_seconds * p99_multiplier) // 60 + 1,
+            int(dbutils.widgets.get("min_timeout_minutes"))
+        ),
+        int(dbutils.widgets.get("max_timeout_minutes"))
+    )
+print(f"Timeout per file: {timeout_seconds}s")
+
+# COMMAND ----------
+
+completed = {
+    row.file_name
+    for row in spark.table("orchestration.import_file")
+    .where(
+        (col("source") == source) & (col("table") == table)
+        & col("file_name").isin(file_names)
+        & col("date_completed").isNotNull()
+    )
+    .select("file_name").collect()
+}
+
+# COMMAND ----------
+
+results = []
+failed = False
+for file_name in file_names:
+    if file_name in completed:
+        results.append((file_name, "already completed", 0.0, None))
+        continue
+    if failed:
+        results.append((file_name, "skipped", 0.0, "An earlier file in the batch failed"))
+        continue
+
+    started = datetime.utcnow()
+    for attempt in range(max_retries + 1):
+        if attempt:
+            sleep(backoff_seconds * 2 ** (attempt - 1))
+        try:
+            dbutils.notebook.run(pipeline_notebook, timeout_seconds, {
+                "source": source,
+                "table": table,
+                "file_name": file_name,
+                "increment": "0",
+            })
+            status, error = "completed", None
+            break
+        except Exception as run_error:
+            status, error = "failed", str(run_error)
+    failed = status == "failed"
+    results.append((
+        file_name, status, (datetime.utcnow() - started).total_seconds(), error
+    ))
+
+print(f"Window starting {window_start} for {source}.{table}:")
+for file_name, status, seconds, error in results:
+    print(f"    - {file_name}: {status} ({seconds:.0f}s)"
+          + (f" - {error}" if error else ""))
+
+# COMMAND ----------
+
+if failed:
+    raise Exception(
+        f"{sum(1 for result in results if result[1] == 'failed')} of "
+        f"{len(file_names)} files in the batch failed. See the summary above"
+    )
@@ -0,0 +1,79 @@
+# Databricks notebook source
+
+# MAGIC %md
+# MAGIC ### To be run by the 'Propagate sources' job only.
+# MAGIC When the engineering workspace propagation mode is `scheduled`, the `data_pipeline` notebook marks each table it updates instead of propagating straight away.
+# MAGIC This notebook propagates every marked table once, so a burst of files for the same table only rebuilds the downstream models and snapshots a single time.
+
+# COMMAND ----------
+
+from datetime import datetime, timedelta
+from os import environ
+
+from delta.tables import DeltaTable
+from pyspark.sql.functions import col, max as spark_max, min as spark_min
+
+from ingenii_databricks.pipeline import propagate_source_data
+
+# COMMAND ----------
+
+# MAGIC %run ./dbt_schema_cache
+
+# COMMAND ----------
+
+dbt_root_folder = environ["DBT_ROOT_FOLDER"]
+queue_path = environ["PROPAGATION_QUEUE_PATH"]
+
+# Wait until a table has had no new files for this long...
+debounce_minutes = int(dbutils.widgets.get("debounce_minutes"))
+# ...unless it has been waiting for longer than this
+max_delay_minutes = int(dbutils.widgets.get("max_delay_minutes"))
+
+if not DeltaTable.isDeltaTable(spark, queue_path):
+    dbutils.notebook.exit("No tables have been marked for propagation")
+
+# COMMAND ----------
+
+now = datetime.utcnow()
+due_tables = spark.read.format("delta").load(queue_path) \
+    .groupBy("source", "table") \
+    .agg(spark_min("date_marked").alias("first_marked"),
+         spark_max("date_marked").alias("last_marked")) \
+    .where(
+        (col("last_marked") <= now - timedelta(minutes=debounce_minutes)) |
+        (col("first_marked") <= now - timedelta(minutes=max_delay_minutes))
+    ) \
+    .collect()
+
+if not due_tables:
+    dbutils.notebook.exit("No tables are due for propagation")
+
+# COMMAND ----------
+
+databricks_dbt_token = \
+    dbutils.secrets.get(scope=environ["DBT_TOKEN_SCOPE"],
+                        key=environ["DBT_TOKEN_NAME"])
+project_name = get_cached_project_config(dbt_root_folder)["name"]
+queue_table = DeltaTable.forPath(spark, queue_path)
+
+failures = []
+for due_table in due_tables:
+    print(f"Propagating {due_table.source}.{due_table.table}")
+    try:
+        propagate_source_data(
+            databricks_dbt_token, project_name,
+            due_table.source, due_table.table)
+    except Exception as error:
+        failures.append(f"{due_table.source}.{due_table.table}: {error}")
+        continue
+
+    # Only clear the marks we have covered. Files that landed while the
+    # propagation was running are picked up by the next run
+    queue_table.delete(
+        (col("source") == due_table.source) &
+        (col("table") == due_table.table) &
+        (col("date_marked") <= due_table.last_marked)
+    )
+
+if failures:
+    raise Exception("\n".join(["Propagation failed for:"] + failures))
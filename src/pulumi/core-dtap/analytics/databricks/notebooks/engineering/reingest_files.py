@@ -0,0 +1,168 @@
+# Databricks notebook source
+
+# MAGIC %md
+# MAGIC ### Re-ingest incomplete files
+# MAGIC Runs the `data_pipeline` notebook again for every entry in `orchestration.import_file` that hasn't completed, for example after an outage.
+# MAGIC Entries are grouped by source and table. The files of each table are run one at a time in the order they arrived, so updates are applied in order, while different tables run concurrently.
+# MAGIC Failed runs are retried with a backoff. If a file still fails, the later files for the same table are skipped, and a summary of every entry is shown at the end.
+
+# COMMAND ----------
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from time import sleep
+
+from pyspark.sql.functions import col, lit
+
+# COMMAND ----------
+
+dbutils.widgets.text("source", "", "Source (blank for all)")
+dbutils.widgets.text("table", "", "Table (blank for all)")
+dbutils.widgets.text("date_from", "", "Arrived from (yyyy-MM-dd)")
+dbutils.widgets.text("date_to", "", "Arrived before (yyyy-MM-dd)")
+dbutils.widgets.text("max_workers", "8", "Tables run at once")
+dbutils.widgets.text("max_retries", "2", "Retries per file")
+dbutils.widgets.text("timeout_seconds", "600", "Timeout per file (seconds)")
+
+source = dbutils.widgets.get("source").strip()
+table = dbutils.widgets.get("table").strip()
+date_from = dbutils.widgets.get("date_from").strip()
+date_to = dbutils.widgets.get("date_to").strip()
+max_workers = int(dbutils.widgets.get("max_workers"))
+max_retries = int(dbutils.widgets.get("max_retries"))
+timeout_seconds = int(dbutils.widgets.get("timeout_seconds"))
+
+pipeline_notebook = "/Shared/Ingenii Engineering/data_pipeline"
+summary_path = "/mnt/orchestration/reingestion_runs"
+summary_schema = \
+    "run_started TIMESTAMP, source STRING, table STRING, file_name STRING, " \
+    "increment INT, status STRING, attempts INT, seconds DOUBLE, error STRING"
+
+# Seconds to wait before the first retry, doubled for each retry after
+backoff_seconds = 30
+
+# COMMAND ----------
+
+incomplete = spark.table("orchestration.import_file") \
+    .where(col("date_completed").isNull())
+if source:
+    incomplete = incomplete.where(col("source") == source)
+if table:
+    incomplete = incomplete.where(col("table") == table)
+if date_from:
+    incomplete = incomplete.where(col("date_new") >= lit(date_from))
+if date_to:
+    incomplete = incomplete.where(col("date_new") < lit(date_to))
+
+# Each table's files in the order they arrived
+table_files = {}
+for row in incomplete \
+        .select("source", "table", "file_name", "increment", "date_new") \
+        .orderBy("date_new", "file_name", "increment").collect():
+    table_files.setdefault((row.source, row.table), []).append(row)
+
+if not table_files:
+    dbutils.notebook.exit("No incomplete files match the filters")
+
+print(f"Re-ingesting {sum(len(files) for files in table_files.values())} "
+      f"files across {len(table_files)} tables")
+
+# COMMAND ----------
+
+
+def reingest_file(row) -> tuple:
+    """
+    Run the data pipeline for a single file, retrying with a backoff
+
+    Parameters
+    ----------
+    row : Row
+        The import_file entry
+
+    Returns
+    -------
+    tuple
+        The status, number of attempts, seconds taken and last error
+    """
+
+    started = datetime.utcnow()
+    error = None
+    for attempt in range(max_retries + 1):
+        if attempt:
+            sleep(backoff_seconds * 2 ** (attempt - 1))
+        try:
+            dbutils.notebook.run(pipeline_notebook, timeout_seconds, {
+                "source": row.source,
+                "table": row.table,
+                "file_name": row.file_name,
+                "increment": str(row.increment),
+            })
+            error = None
+            break
+        except Exception as run_error:
+            error = str(run_error)
+
+    return (
+        "failed" if error else "completed",
+        attempt + 1,
+        (datetime.utcnow() - started).total_seconds(),
+        error,
+    )
+
+
+def reingest_table(files: list) -> list:
+    """
+    Re-ingest a table's files in order, stopping at the first file that
+    still fails after its retries
+
+    Parameters
+    ----------
+    files : list
+        The table's import_file entries, in the order they arrived
+
+    Returns
+    -------
+    list
+        A summary row for each file
+    """
+
+    results = []
+    failed = False
+    for row in files:
+        if failed:
+            status, attempts, seconds, error = \
+                "skipped", 0, 0.0, "An earlier file for this table failed"
+        else:
+            status, attempts, seconds, error = reingest_file(row)
+            failed = status == "failed"
+        results.append((
+            run_started, row.source, row.table, row.file_name,
+            row.increment, status, attempts, seconds, error
+        ))
+    return results
+
+
+# COMMAND ----------
+
+run_started = datetime.utcnow()
+with ThreadPoolExecutor(
+        max_workers=max(1, min(max_workers, len(table_files)))) as executor:
+    summary_rows = [
+        result
+        for results in executor.map(reingest_table, table_files.values())
+        for result in results
+    ]
+
+summary = spark.createDataFrame(summary_rows, summary_schema)
+summary.write.format("delta").mode("append").save(summary_path)
+
+display(summary.orderBy("status", "source", "table"))
+
+# COMMAND ----------
+
+n_failed = sum(1 for result in summary_rows if result[5] != "completed")
+if n_failed:
+    raise Exception(
+        f"{n_failed} of {len(summary_rows)} files were not re-ingested. "
+        f"See the summary above, or the table at {summary_path}"
+    )
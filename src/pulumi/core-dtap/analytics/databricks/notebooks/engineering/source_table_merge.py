@@ -0,0 +1,158 @@
+# Databricks notebook source
+
+# MAGIC %md
+# MAGIC ### Pruned merges into source tables
+# MAGIC Used by the `data_pipeline` notebook through `%run ./source_table_merge`.
+# MAGIC Tables whose schema has a `pruning` section are merged with a condition that only reads the partitions and rows the new file can match, so the merge cost follows the size of the file rather than the size of the table. For example:
+# MAGIC ```
+# MAGIC pruning:
+# MAGIC   merge_keys: [id, date]               # Required, the columns identifying a row
+# MAGIC   partition_columns: [date]            # Columns the source table is partitioned by
+# MAGIC   predicate: "target.date >= date_sub(current_date(), 30)"  # Any extra condition on the existing rows
+# MAGIC   zorder: true                         # Z-order the changed partitions by the merge keys
+# MAGIC ```
+# MAGIC Existing rows outside the `predicate` are never matched, so incoming rows for them are inserted rather than updated. Only use a predicate that every incoming update falls inside.
+# MAGIC
+# MAGIC `zorder` only applies to partitioned tables, where just the partitions the file touched are rewritten. Unpartitioned tables would be rewritten in full after every file, so are left to scheduled maintenance.
+
+# COMMAND ----------
+
+from functools import reduce
+from operator import and_
+
+from delta.tables import DeltaTable
+from pyspark.sql.functions import col, expr
+
+from ingenii_databricks.pipeline import add_to_source_table
+
+# COMMAND ----------
+
+
+def check_pruning_config(pruning: dict, columns: list) -> None:
+    """
+    Check that the pruning section of a table schema can be used
+
+    Parameters
+    ----------
+    pruning : dict
+        The pruning section of the table schema
+    columns : list
+        The column names of the file table
+
+    Raises
+    ------
+    Exception
+        If no merge keys are given, or any column is not in the file table
+    """
+
+    if not pruning.get("merge_keys"):
+        raise Exception("Pruned merges need at least one column in 'merge_keys'")
+
+    missing_columns = [
+        column
+        for column in pruning["merge_keys"] + pruning.get("partition_columns", [])
+        if column not in columns
+    ]
+    if missing_columns:
+        raise Exception(
+            f"Pruning columns {missing_columns} are not in the table columns "
+            f"{columns}"
+        )
+
+
+def add_to_pruned_source_table(spark, import_entry, table_schema: dict) -> None:
+    """
+    Merge the file table into the source table, only reading the partitions
+    and rows of the source table that the file can match
+
+    Parameters
+    ----------
+    spark : SparkSession
+        The Spark session
+    import_entry : ImportFileEntry
+        The orchestration entry for the file being ingested
+    table_schema : dict
+        The table schema, including the 'pruning' section
+    """
+
+    pruning = table_schema["pruning"]
+    merge_keys = pruning["merge_keys"]
+    partition_columns = pruning.get("partition_columns", [])
+
+    source_table_name = import_entry.get_full_table_name()
+    file_table = spark.table(import_entry.get_full_file_table_name())
+
+    check_pruning_config(pruning, file_table.columns)
+
+    # First file for this table, so create it the same way as any other
+    # source table, then lay it out by the partition columns while it only
+    # holds this file
+    if not spark.catalog._jcatalog.tableExists(source_table_name):
+        add_to_source_table(spark, import_entry, table_schema)
+        if partition_columns:
+            spark.table(source_table_name).write.format("delta") \
+                .mode("overwrite") \
+                .option("overwriteSchema", "true") \
+                .partitionBy(*partition_columns) \
+                .saveAsTable(source_table_name)
+        return
+
+    # Null-safe, so rows with a null merge key are updated rather than
+    # inserted again
+    conditions = [
+        col(f"target.`{key}`").eqNullSafe(col(f"batch.`{key}`"))
+        for key in merge_keys
+    ]
+
+    # Restrict the existing rows to the partitions this file has values for
+    partition_values = {}
+    if partition_columns:
+        partition_rows = \
+            file_table.select(*partition_columns).distinct().collect()
+        for column in partition_columns:
+            values = {row[column] for row in partition_rows}
+            partition_values[column] = values
+            condition = col(f"target.`{column}`").isin(
+                [value for value in values if value is not None])
+            if None in values:
+                condition = condition | col(f"target.`{column}`").isNull()
+            conditions.append(condition)
+
+    if pruning.get("predicate"):
+        conditions.append(expr(pruning["predicate"]))
+
+    DeltaTable.forName(spark, source_table_name).alias("target") \
+        .merge(file_table.alias("batch"), reduce(and_, conditions)) \
+        .whenMatchedUpdateAll() \
+        .whenNotMatchedInsertAll() \
+        .execute()
+
+    # Keep the merge keys clustered so the next merge reads fewer files
+    zorder_columns = [
+        key for key in merge_keys if key not in partition_columns
+    ]
+    # Only the partitions the file touched, and none if it was empty
+    touched_partitions = \
+        bool(partition_values) and all(partition_values.values())
+    if pruning.get("zorder", False) and zorder_columns and touched_partitions:
+        # OPTIMIZE can only filter on partition columns
+        optimize_filters = []
+        for column, values in partition_values.items():
+            column_filters = []
+            known_values = [value for value in values if value is not None]
+            if known_values:
+                column_filters.append(
+                    f"`{column}` IN ("
+                    + ", ".join(repr(str(value)) for value in known_values)
+                    + ")"
+                )
+            if None in values:
+                column_filters.append(f"`{column}` IS NULL")
+            optimize_filters.append(f"({' OR '.join(column_filters)})")
+
+        spark.sql(
+            f"OPTIMIZE {source_table_name} "
+            f"WHERE {' AND '.join(optimize_filters)} ZORDER BY ("
+            + ", ".join(f"`{column}`" for column in zorder_columns)
+            + ")"
+        )
@@ -0,0 +1,13 @@
+# Databricks notebook source
+
+# MAGIC %md
+# MAGIC ### To be run by the 'Update import file summary' job only.
+# MAGIC Brings the import file summary, and the ingestion timeouts Data Factory reads, up to date with `orchestration.import_file`. Only one run at a time, so updates never conflict with each other.
+
+# COMMAND ----------
+
+# MAGIC %run ./import_file_summary
+
+# COMMAND ----------
+
+update_import_file_summary()
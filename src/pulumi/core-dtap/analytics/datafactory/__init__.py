@@ -8,6 +8,7 @@ from . import orchestration
 from . import orchestration_linked_services
 from . import orchestration_datasets
 from . import orchestration_pipelines
+from . import orchestration_copy_pipelines
 from . import user_datafactories
 
 if datafactory_runtime_config["enabled"]:
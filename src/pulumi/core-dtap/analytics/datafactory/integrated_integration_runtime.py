@@ -1,11 +1,15 @@
 from base64 import b64encode
 from pulumi import ResourceOptions
 from pulumi_azure_native import containerservice, datafactory
-from pulumi_kubernetes import apps, core, meta
+import pulumi_azuread as azuread
+from pulumi_kubernetes import apiextensions, apps, core, meta
+
+from ingenii_azure_data_platform.iam import ServicePrincipalRoleAssignment
+from ingenii_azure_data_platform.utils import generate_resource_name
 
 from analytics.datafactory.user_datafactories import datafactory_resource_group, user_datafactories
 from platform_shared import datafactory_runtime_config, shared_kubernetes_provider
-from project_config import platform_config, platform_outputs
+from project_config import azure_client, platform_config, platform_outputs
 
 # ----------------------------------------------------------------------------------------------------------------------
 # DATA FACTORY -> INTEGRATED INTEGRATION RUNTIME
@@ -24,6 +28,72 @@ namespace = core.v1.Namespace(
 )
 overall_outputs["namespace"] = namespace.metadata.name
 
+# ----------------------------------------------------------------------------------------------------------------------
+# DATA FACTORY RUNTIME -> AUTOSCALING
+# ----------------------------------------------------------------------------------------------------------------------
+
+# Each runtime can run on up to 4 nodes. KEDA, deployed with the shared cluster, adds and removes nodes based on the
+# runtime's queue length and CPU usage, read from the Data Factory metrics in Azure Monitor
+autoscaling_config = datafactory_runtime_config.get("autoscaling", {})
+autoscaling_enabled = autoscaling_config.get("enabled", False)
+min_replicas = autoscaling_config.get("min_replicas", 1) if autoscaling_enabled else 1
+
+if autoscaling_enabled:
+    metrics_reader_sp_name = generate_resource_name(
+        resource_type="service_principal",
+        resource_name="adf-runtime-autoscaler",
+        platform_config=platform_config,
+    )
+    metrics_reader_sp_app = azuread.Application(
+        resource_name=metrics_reader_sp_name,
+        display_name=metrics_reader_sp_name,
+        identifier_uris=[f"api://{metrics_reader_sp_name}"],
+        owners=[azure_client.object_id],
+        opts=ResourceOptions(ignore_changes=["owners"]),
+    )
+    metrics_reader_sp = azuread.ServicePrincipal(
+        resource_name=metrics_reader_sp_name,
+        application_id=metrics_reader_sp_app.application_id,
+        app_role_assignment_required=False,
+        owners=[azure_client.object_id],
+    )
+    metrics_reader_sp_password = azuread.ServicePrincipalPassword(
+        resource_name=metrics_reader_sp_name,
+        service_principal_id=metrics_reader_sp.object_id,
+    )
+
+    metrics_reader_secret = core.v1.Secret(
+        resource_name=f"datafactory-runtime-autoscaler-{platform_config.stack}",
+        string_data={
+            "clientId": metrics_reader_sp_app.application_id,
+            "clientPassword": metrics_reader_sp_password.value,
+        },
+        metadata=meta.v1.ObjectMetaArgs(namespace=namespace.id),
+        opts=ResourceOptions(provider=shared_kubernetes_provider)
+    )
+
+    trigger_authentication = apiextensions.CustomResource(
+        resource_name=f"datafactory-runtime-autoscaler-{platform_config.stack}",
+        api_version="keda.sh/v1alpha1",
+        kind="TriggerAuthentication",
+        metadata=meta.v1.ObjectMetaArgs(namespace=namespace.id),
+        spec={
+            "secretTargetRef": [
+                {
+                    "parameter": "activeDirectoryClientId",
+                    "name": metrics_reader_secret.metadata.name,
+                    "key": "clientId",
+                },
+                {
+                    "parameter": "activeDirectoryClientPassword",
+                    "name": metrics_reader_secret.metadata.name,
+                    "key": "clientPassword",
+                },
+            ]
+        },
+        opts=ResourceOptions(provider=shared_kubernetes_provider)
+    )
+
 
 # A container per Data Factory
 for ref_key, datafactory_config in user_datafactories.items():
@@ -77,14 +147,21 @@ for ref_key, datafactory_config in user_datafactories.items():
     # DATA FACTORY RUNTIME -> RUNTIME CONTAINER
     # ----------------------------------------------------------------------------------------------------------------------
 
-    deployment = apps.v1.Deployment(
+    # A stateful set, so each pod registers with the runtime as a node with a stable name, and scaling down removes the
+    # most recently added node
+    runtime_name = f"datafactory-runtime-{ref_key}-{platform_config.stack}".replace("_", "-")
+    deployment = apps.v1.StatefulSet(
         resource_name=f"datafactory-runtime-deployment-{ref_key}-{platform_config.stack}",
         metadata=meta.v1.ObjectMetaArgs(
             labels=labels,
+            name=runtime_name,
             namespace=namespace.id
         ),
-        spec=apps.v1.DeploymentSpecArgs(
-            replicas=1,
+        spec=apps.v1.StatefulSetSpecArgs(
+            replicas=min_replicas,
+            service_name=runtime_name,
+            # Nodes are independent, so don't wait for each to be ready before starting the next
+            pod_management_policy="Parallel",
             selector=meta.v1.LabelSelectorArgs(
                 match_labels=labels,
             ),
@@ -98,8 +175,10 @@ for ref_key, datafactory_config in user_datafactories.items():
                         image=datafactory_runtime_config["image"],
                         env=[
                             core.v1.EnvVarArgs(
-                                name="NODE_NAME", 
-                                value=f"kubernetes_node_{ref_key}_{platform_config.stack}"
+                                name="NODE_NAME",
+                                value_from=core.v1.EnvVarSourceArgs(
+                                    field_ref=core.v1.ObjectFieldSelectorArgs(field_path="metadata.name")
+                                )
                             ),
                             core.v1.EnvVarArgs(
                                 name="AUTH_KEY",
@@ -124,12 +203,107 @@ for ref_key, datafactory_config in user_datafactories.items():
                             core.v1.ContainerPortArgs(container_port=port)
                             for port in (80, 8060)
                         ],
+                        # Requests let the cluster autoscaler add Windows nodes for new runtime nodes
+                        resources=core.v1.ResourceRequirementsArgs(
+                            requests=datafactory_runtime_config.get("resources", {}).get("requests"),
+                            limits=datafactory_runtime_config.get("resources", {}).get("limits"),
+                        ),
                     )],
                     node_selector={"OS": containerservice.OSType.WINDOWS},
+                    # Time for running jobs to finish before a node is removed. Left
+                    # at the Kubernetes default without autoscaling
+                    termination_grace_period_seconds=autoscaling_config.get("termination_grace_period", 600)
+                    if autoscaling_enabled else None,
                 ),
             ),
         ),
-        opts=ResourceOptions(provider=shared_kubernetes_provider, depends_on=[auth_key_secret])
+        opts=ResourceOptions(
+            provider=shared_kubernetes_provider,
+            depends_on=[auth_key_secret],
+            # Managed by the autoscaler
+            ignore_changes=["spec.replicas"] if autoscaling_enabled else [],
+        )
+    )
+
+    outputs["deployment"] = deployment.metadata.name
+
+    if not autoscaling_enabled:
+        continue
+
+    # ----------------------------------------------------------------------------------------------------------------------
+    # DATA FACTORY RUNTIME -> AUTOSCALING
+    # ----------------------------------------------------------------------------------------------------------------------
+
+    ServicePrincipalRoleAssignment(
+        principal_id=metrics_reader_sp.object_id,
+        principal_name="datafactory-runtime-autoscaler",
+        role_name="Monitoring Reader",
+        scope=datafactory_config["obj"].id,
+        scope_description=f"{ref_key}-datafactory",
+    )
+
+    def azure_monitor_trigger(metric_name, target_value, metric_type):
+        return {
+            "type": "azure-monitor",
+            "metricType": metric_type,
+            "metadata": {
+                "resourceURI": f"Microsoft.DataFactory/factories/{factory_name}",
+                "tenantId": azure_client.tenant_id,
+                "subscriptionId": azure_client.subscription_id,
+                "resourceGroupName": datafactory_resource_group.name,
+                "metricName": metric_name,
+                "metricFilter": "IntegrationRuntimeName eq 'IntegratedIntegrationRuntime'",
+                "metricAggregationType": "Average",
+                "metricAggregationInterval": "0:1:0",
+                "targetValue": str(target_value),
+            },
+            "authenticationRef": {"name": trigger_authentication.metadata["name"]},
+        }
+
+    scaled_object = apiextensions.CustomResource(
+        resource_name=f"datafactory-runtime-autoscaler-{ref_key}-{platform_config.stack}",
+        api_version="keda.sh/v1alpha1",
+        kind="ScaledObject",
+        metadata=meta.v1.ObjectMetaArgs(
+            labels=labels,
+            namespace=namespace.id
+        ),
+        spec={
+            "scaleTargetRef": {
+                "apiVersion": "apps/v1",
+                "kind": "StatefulSet",
+                "name": deployment.metadata.name,
+            },
+            "minReplicaCount": min_replicas,
+            "maxReplicaCount": autoscaling_config.get("max_replicas", 4),
+            "pollingInterval": autoscaling_config.get("polling_interval", 60),
+            "advanced": {
+                "horizontalPodAutoscalerConfig": {
+                    "behavior": {
+                        # Removing a node stops its jobs, so wait for the load to stay low
+                        "scaleDown": {
+                            "stabilizationWindowSeconds": autoscaling_config.get("scale_down_delay", 900),
+                            "policies": [{"type": "Pods", "value": 1, "periodSeconds": 300}],
+                        },
+                    },
+                },
+            },
+            "triggers": [
+                # Jobs waiting for a free slot on any node, per node
+                azure_monitor_trigger(
+                    "IntegrationRuntimeQueueLength",
+                    autoscaling_config.get("queue_length_target", 2),
+                    "AverageValue",
+                ),
+                # Average CPU across the nodes, as a measure of the concurrent jobs running
+                azure_monitor_trigger(
+                    "IntegrationRuntimeCpuPercentage",
+                    autoscaling_config.get("cpu_percentage_target", 70),
+                    "Value",
+                ),
+            ],
+        },
+        opts=ResourceOptions(provider=shared_kubernetes_provider, depends_on=[deployment])
     )
 
-    outputs["deployment"] = deployment.metadata.name
\ No newline at end of file
+    outputs["autoscaler"] = scaled_object.metadata["name"]
@@ -9,6 +9,7 @@ from ingenii_azure_data_platform.logs import log_diagnostic_settings
 from ingenii_azure_data_platform.orchestration import AdfSelfHostedIntegrationRuntime
 from ingenii_azure_data_platform.utils import generate_resource_name
 
+from analytics.datafactory.slo_alerts import create_pipeline_slo_alerts
 from logs import log_analytics_workspace
 from management import action_groups, resource_groups, user_groups
 from project_config import platform_config, platform_outputs, azure_client
@@ -135,6 +136,14 @@ if datafactory_config.get("pipeline_failure_action_groups"):
         window_size="PT15M"
     )
 
+# ----------------------------------------------------------------------------------------------------------------------
+# DATA FACTORY -> PIPELINE SLO ALERTS
+# ----------------------------------------------------------------------------------------------------------------------
+create_pipeline_slo_alerts(
+    "orchestration", datafactory.id, datafactory_resource_group.name,
+    datafactory_config.get("slo_alerts", [])
+)
+
 # ----------------------------------------------------------------------------------------------------------------------
 # DATA FACTORY -> LOGGING
 # ----------------------------------------------------------------------------------------------------------------------
@@ -0,0 +1,351 @@
+from pulumi import ResourceOptions
+from pulumi_azure_native import datafactory as adf
+
+from analytics.datafactory.orchestration import datafactory, \
+    datafactory_config, datafactory_name
+from analytics.datafactory.orchestration_datasets import data_lake_folder
+from analytics.datafactory.orchestration_linked_services import \
+    credentials_store_linked_service, datalake_linked_service
+from analytics.datafactory.orchestration_pipelines import minutes_to_string
+from management import resource_groups
+
+# ----------------------------------------------------------------------------------------------------------------------
+# DATA FACTORY -> RAW COPY PIPELINES
+# ----------------------------------------------------------------------------------------------------------------------
+
+# Each configured table gets a pipeline copying its files into the raw
+# container at <source>/<table>, where the 'Raw file created' trigger picks
+# them up for ingestion. Tables with a start_time are copied on a tumbling
+# window, each run only copying the files modified within its window. Runs
+# without a window, such as backfills, copy every matching file
+
+copy_sources_config = datafactory_config.get("copy_sources", {})
+
+
+def key_vault_secret(secret_name):
+    return adf.AzureKeyVaultSecretReferenceArgs(
+        type="AzureKeyVaultSecret",
+        secret_name=secret_name,
+        store=adf.LinkedServiceReferenceArgs(
+            reference_name=credentials_store_linked_service.name,
+            type="LinkedServiceReference",
+        ),
+    )
+
+
+def runtime_reference(source_config):
+    """ Runtime to copy with. Without one, the Azure AutoResolve runtime is used """
+    if not source_config.get("integration_runtime"):
+        return None
+    return adf.IntegrationRuntimeReferenceArgs(
+        reference_name=source_config["integration_runtime"],
+        type="IntegrationRuntimeReference",
+    )
+
+
+def create_source_linked_service(source_name, source_config):
+    connect_via = runtime_reference(source_config)
+    password = key_vault_secret(source_config["password_secret_name"]) \
+        if source_config.get("password_secret_name") else None
+
+    if source_config["type"] == "sftp":
+        # The server's host key is checked unless validation is explicitly skipped
+        skip_host_key_validation = source_config.get("skip_host_key_validation", False)
+        if not skip_host_key_validation and not source_config.get("host_key_fingerprint"):
+            raise Exception(
+                f"Copy source '{source_name}' needs a 'host_key_fingerprint' to validate the SFTP server with, "
+                f"or 'skip_host_key_validation' set to true"
+            )
+        properties = adf.SftpServerLinkedServiceArgs(
+            type="Sftp",
+            host=source_config["host"],
+            port=source_config.get("port", 22),
+            authentication_type="Basic",
+            user_name=source_config.get("username"),
+            password=password,
+            host_key_fingerprint=None if skip_host_key_validation else source_config["host_key_fingerprint"],
+            skip_host_key_validation=skip_host_key_validation,
+            connect_via=connect_via,
+            description="Managed by Ingenii Data Platform",
+        )
+    elif source_config["type"] == "s3":
+        properties = adf.AmazonS3LinkedServiceArgs(
+            type="AmazonS3",
+            access_key_id=source_config.get("username"),
+            secret_access_key=password,
+            connect_via=connect_via,
+            description="Managed by Ingenii Data Platform",
+        )
+    elif source_config["type"] == "http":
+        properties = adf.HttpServerLinkedServiceArgs(
+            type="HttpServer",
+            url=source_config["url"],
+            authentication_type="Basic" if password else "Anonymous",
+            user_name=source_config.get("username"),
+            password=password,
+            connect_via=connect_via,
+            description="Managed by Ingenii Data Platform",
+        )
+    else:
+        raise Exception(f"Copy source type not recognised: {source_config['type']}")
+
+    return adf.LinkedService(
+        resource_name=f"{datafactory_name}-link-to-copy-source-{source_name}",
+        factory_name=datafactory.name,
+        linked_service_name=f"Copy Source {source_name}",
+        properties=properties,
+        resource_group_name=resource_groups["infra"].name,
+    )
+
+
+def create_source_dataset(source_name, source_config, linked_service):
+    if source_config["type"] == "sftp":
+        location = adf.SftpLocationArgs(
+            type="SftpLocation",
+            folder_path=adf.ExpressionArgs(type="Expression", value="@dataset().Folder"),
+        )
+    elif source_config["type"] == "s3":
+        location = adf.AmazonS3LocationArgs(
+            type="AmazonS3Location",
+            bucket_name=source_config["bucket"],
+            folder_path=adf.ExpressionArgs(type="Expression", value="@dataset().Folder"),
+        )
+    else:
+        location = adf.HttpServerLocationArgs(
+            type="HttpServerLocation",
+            relative_url=adf.ExpressionArgs(
+                type="Expression", value="@concat(dataset().Folder, '/', dataset().FileName)"
+            ),
+        )
+
+    return adf.Dataset(
+        resource_name=f"{datafactory_name}-dataset-copy-source-{source_name}",
+        dataset_name=f"CopySource{''.join(part.title() for part in source_name.split('_'))}",
+        factory_name=datafactory.name,
+        properties=adf.BinaryDatasetArgs(
+            linked_service_name=adf.LinkedServiceReferenceArgs(
+                reference_name=linked_service.name,
+                type="LinkedServiceReference",
+            ),
+            location=location,
+            parameters={
+                "Folder": adf.ParameterSpecificationArgs(type="String"),
+                "FileName": adf.ParameterSpecificationArgs(type="String", default_value=""),
+            },
+            type="Binary",
+        ),
+        resource_group_name=resource_groups["infra"].name,
+    )
+
+
+def window_parameter(parameter_name):
+    """ The window parameter, or null to not filter on it """
+    return adf.ExpressionArgs(
+        type="Expression",
+        value=f"@if(empty(pipeline().parameters.{parameter_name}), null, "
+              f"pipeline().parameters.{parameter_name})",
+    )
+
+
+def read_settings(source_config, file_list_path=None):
+    """ How the files are listed and read from the source """
+    max_connections = source_config.get("max_concurrent_connections")
+    file_name = adf.ExpressionArgs(type="Expression", value="@pipeline().parameters.fileName")
+
+    # Listed files are copied whenever they were modified
+    modified_start = None if file_list_path else window_parameter("windowStart")
+    modified_end = None if file_list_path else window_parameter("windowEnd")
+
+    if source_config["type"] == "sftp":
+        return adf.SftpReadSettingsArgs(
+            type="SftpReadSettings",
+            recursive=False,
+            wildcard_file_name=None if file_list_path else file_name,
+            file_list_path=file_list_path,
+            modified_datetime_start=modified_start,
+            modified_datetime_end=modified_end,
+            max_concurrent_connections=max_connections,
+        )
+    if source_config["type"] == "s3":
+        return adf.AmazonS3ReadSettingsArgs(
+            type="AmazonS3ReadSettings",
+            recursive=False,
+            wildcard_file_name=None if file_list_path else file_name,
+            file_list_path=file_list_path,
+            modified_datetime_start=modified_start,
+            modified_datetime_end=modified_end,
+            max_concurrent_connections=max_connections,
+        )
+    return adf.HttpReadSettingsArgs(
+        type="HttpReadSettings",
+        request_method="GET",
+        max_concurrent_connections=max_connections,
+    )
+
+
+def copy_activity(name, source_name, source_config, source_dataset, table_name,
+                  file_list_path=None, depends_on=None):
+    staging = source_config.get("staged", False)
+    return adf.CopyActivityArgs(
+        name=name,
+        type="Copy",
+        depends_on=depends_on or [],
+        inputs=[adf.DatasetReferenceArgs(
+            reference_name=source_dataset.name,
+            type="DatasetReference",
+            parameters={
+                "Folder": adf.ExpressionArgs(type="Expression", value="@pipeline().parameters.folder"),
+                "FileName": adf.ExpressionArgs(type="Expression", value="@pipeline().parameters.fileName"),
+            },
+        )],
+        outputs=[adf.DatasetReferenceArgs(
+            reference_name=data_lake_folder.name,
+            type="DatasetReference",
+            parameters={"Container": "raw", "Folder": f"{source_name}/{table_name}"},
+        )],
+        source=adf.BinarySourceArgs(
+            type="BinarySource",
+            store_settings=read_settings(source_config, file_list_path),
+        ),
+        sink=adf.BinarySinkArgs(
+            type="BinarySink",
+            store_settings=adf.AzureBlobFSWriteSettingsArgs(
+                type="AzureBlobFSWriteSettings",
+                max_concurrent_connections=source_config.get("max_concurrent_connections"),
+            ),
+        ),
+        # Unset values are left for Data Factory to decide
+        parallel_copies=source_config.get("parallel_copies"),
+        # Only used by the Azure runtime. Self-hosted runtimes scale with their nodes
+        data_integration_units=None if source_config.get("integration_runtime")
+        else source_config.get("data_integration_units"),
+        enable_staging=staging,
+        staging_settings=adf.StagingSettingsArgs(
+            linked_service_name=adf.LinkedServiceReferenceArgs(
+                reference_name=datalake_linked_service.name,
+                type="LinkedServiceReference",
+            ),
+            path="utilities/copy-staging",
+        ) if staging else None,
+        policy=adf.ActivityPolicyArgs(
+            timeout=minutes_to_string(source_config.get("timeout", 120)),
+            retry=source_config.get("retry", 2),
+            retry_interval_in_seconds=60,
+            secure_output=False,
+            secure_input=False,
+        ),
+    )
+
+
+copy_pipelines = {}
+for source_name, source_config in copy_sources_config.items():
+    source_linked_service = create_source_linked_service(source_name, source_config)
+    source_dataset = create_source_dataset(source_name, source_config, source_linked_service)
+
+    for table_name, table_config in source_config["tables"].items():
+
+        # A single copy of every file matching the pattern...
+        activities = [
+            copy_activity(
+                "Copy files to raw", source_name, source_config, source_dataset, table_name
+            )
+        ]
+
+        # ...or, for backfills, a list of files is split into several file
+        # list files which are copied at the same time
+        if source_config["type"] != "http":
+            activities = [
+                adf.IfConditionActivityArgs(
+                    type="IfCondition",
+                    name="If file lists given",
+                    expression=adf.ExpressionArgs(
+                        type="Expression",
+                        value="@greater(length(pipeline().parameters.fileListPaths), 0)"
+                    ),
+                    if_false_activities=activities,
+                    if_true_activities=[
+                        adf.ForEachActivityArgs(
+                            name="For each file list",
+                            type="ForEach",
+                            is_sequential=False,
+                            batch_count=source_config.get("file_list_batch_count", 4),
+                            items=adf.ExpressionArgs(
+                                type="Expression",
+                                value="@pipeline().parameters.fileListPaths"
+                            ),
+                            activities=[
+                                copy_activity(
+                                    "Copy listed files to raw", source_name, source_config,
+                                    source_dataset, table_name,
+                                    file_list_path=adf.ExpressionArgs(type="Expression", value="@item()"),
+                                )
+                            ],
+                        )
+                    ],
+                )
+            ]
+
+        copy_pipelines[(source_name, table_name)] = adf.Pipeline(
+            resource_name=f"{datafactory_name}-copy-{source_name}-{table_name}".replace("_", "-"),
+            factory_name=datafactory.name,
+            pipeline_name=f"Copy {source_name} {table_name} to raw",
+            description="Managed by Ingenii Data Platform",
+            parameters={
+                "folder": adf.ParameterSpecificationArgs(
+                    type="String", default_value=table_config["folder_path"]
+                ),
+                "fileName": adf.ParameterSpecificationArgs(
+                    type="String",
+                    default_value=table_config.get(
+                        "file_name", "" if source_config["type"] == "http" else "*"
+                    ),
+                ),
+                # Paths of text files listing the files to copy, relative to the folder
+                "fileListPaths": adf.ParameterSpecificationArgs(
+                    type="Array", default_value=[]
+                ),
+                # Only copy files modified from the start and before the end,
+                # if set. ISO 8601, e.g. 2023-01-01T00:00:00Z
+                "windowStart": adf.ParameterSpecificationArgs(type="String", default_value=""),
+                "windowEnd": adf.ParameterSpecificationArgs(type="String", default_value=""),
+            },
+            activities=activities,
+            policy=adf.PipelinePolicyArgs(),
+            annotations=["Created by Ingenii"],
+            opts=ResourceOptions(ignore_changes=["annotations"]),
+            resource_group_name=resource_groups["infra"].name,
+        )
+
+        # HTTP sources are a single file, without modified times to filter on
+        if table_config.get("start_time") and source_config["type"] != "http":
+            adf.Trigger(
+                resource_name=f"{datafactory_name}-copy-{source_name}-{table_name}".replace("_", "-"),
+                factory_name=datafactory.name,
+                trigger_name=f"Copy {source_name} {table_name}",
+                properties=adf.TumblingWindowTriggerArgs(
+                    type="TumblingWindowTrigger",
+                    frequency=adf.TumblingWindowFrequency.MINUTE,
+                    interval=table_config.get("window_minutes", 60),
+                    start_time=table_config["start_time"],
+                    # Wait for files still being written at the end of the window
+                    delay=minutes_to_string(table_config.get("delay_minutes", 5)),
+                    max_concurrency=1,
+                    retry_policy=adf.RetryPolicyArgs(
+                        count=source_config.get("retry", 2),
+                        interval_in_seconds=300,
+                    ),
+                    pipeline=adf.TriggerPipelineReferenceArgs(
+                        pipeline_reference=adf.PipelineReferenceArgs(
+                            reference_name=copy_pipelines[(source_name, table_name)].name,
+                            type="PipelineReference",
+                        ),
+                        parameters={
+                            "windowStart": "@trigger().outputs.windowStartTime",
+                            "windowEnd": "@trigger().outputs.windowEndTime",
+                        },
+                    ),
+                    annotations=["Created by Ingenii"],
+                ),
+                opts=ResourceOptions(ignore_changes=["properties.annotations"]),
+                resource_group_name=resource_groups["infra"].name,
+            )
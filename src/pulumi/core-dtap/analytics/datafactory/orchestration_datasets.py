@@ -31,4 +31,38 @@ data_lake_folder = adf.Dataset(
         type="AzureBlob",
     ),
     resource_group_name=datafactory_resource_group.name
+)
+
+data_lake_json_file = adf.Dataset(
+    resource_name=f"{datafactory_name}-dataset-datalake-json-file",
+    dataset_name="DataLakeJsonFile",
+    factory_name=datafactory_name,
+    properties=adf.JsonDatasetArgs(
+        linked_service_name=adf.LinkedServiceReferenceArgs(
+            reference_name=datalake_linked_service.name,
+            type="LinkedServiceReference",
+        ),
+        location=adf.AzureBlobFSLocationArgs(
+            type="AzureBlobFSLocation",
+            file_system=adf.ExpressionArgs(
+                type="Expression",
+                value="@dataset().Container"
+            ),
+            folder_path=adf.ExpressionArgs(
+                type="Expression",
+                value="@dataset().Folder"
+            ),
+            file_name=adf.ExpressionArgs(
+                type="Expression",
+                value="@dataset().FileName"
+            ),
+        ),
+        parameters={
+            "Container": adf.ParameterSpecificationArgs(type="String"),
+            "Folder": adf.ParameterSpecificationArgs(type="String"),
+            "FileName": adf.ParameterSpecificationArgs(type="String"),
+        },
+        type="Json",
+    ),
+    resource_group_name=datafactory_resource_group.name
 )
\ No newline at end of file
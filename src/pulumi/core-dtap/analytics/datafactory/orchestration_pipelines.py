@@ -1,11 +1,16 @@
-from pulumi import ResourceOptions
-from pulumi_azure_native import datafactory as adf
+from pulumi import Output, ResourceOptions
+from pulumi_azure_native import datafactory as adf, operationalinsights
 
+from ingenii_azure_data_platform.iam import ServicePrincipalRoleAssignment
+
+from analytics.databricks.hive_metastore import hive_metastore_config
 from analytics.datafactory.orchestration import datafactory, \
-    datafactory_config, datafactory_name
-from analytics.datafactory.orchestration_datasets import data_lake_folder
+    datafactory_config, datafactory_name, outputs
+from analytics.datafactory.orchestration_datasets import data_lake_folder, \
+    data_lake_json_file
 from analytics.datafactory.orchestration_linked_services import databricks_analytics_compute_linked_service, \
     databricks_engineering_compute_linked_service, datalake_linked_service
+from logs import log_analytics_workspace
 from management import resource_groups
 from storage.datalake import datalake
 
@@ -17,12 +22,358 @@ def minutes_to_string(n_mins):
     n_hrs, n_mins = n_mins // hr, n_mins % hr
     return f"{str(n_days)}.{str(n_hrs).zfill(2)}:{str(n_mins).zfill(2)}:00"
 
+default_policy = adf.ActivityPolicyArgs(
+    timeout=minutes_to_string(1),
+    retry=3,
+    retry_interval_in_seconds=30,
+    secure_output=False,
+    secure_input=False,
+)
+
+def depends_successful(*activity_names):
+    return [
+        adf.ActivityDependencyArgs(
+            activity=activity_name,
+            dependency_conditions=[adf.DependencyCondition.SUCCEEDED]
+        )
+        for activity_name in activity_names
+    ]
+
 # ----------------------------------------------------------------------------------------------------------------------
 # DATA FACTORY -> INGESTION PIPELINE AND TRIGGER
 # ----------------------------------------------------------------------------------------------------------------------
 
 ingestion_policy = datafactory_config.get("ingestion_policy", {})
 
+# Paths ingested in batches on a tumbling window, rather than one run per file
+micro_batch_config = datafactory_config.get("micro_batch_ingestion", [])
+micro_batch_paths = [
+    f"raw/{path_config['source']}/{path_config['table']}"
+    for path_config in micro_batch_config
+]
+
+# Each table's timeout can be a multiple of its p99 ingestion time, which the
+# import file summary keeps up to date. Tables without any history, or any
+# failure to read the timeouts, use the static timeout
+adaptive_timeout_config = ingestion_policy.get("adaptive_timeout", {})
+ingestion_timeouts_folder = "ingestion_timeouts"
+ingestion_timeout = minutes_to_string(ingestion_policy.get("timeout", 20))
+timeout_activities, timeout_dependencies = [], []
+
+if adaptive_timeout_config.get("enabled"):
+    p99_seconds = "coalesce(activity('Get ingestion timeouts').output?.firstRow?" \
+                  "[pipeline().parameters.filePath], 0)"
+    timeout_minutes = \
+        f"min(max(add(div(mul({p99_seconds}, {adaptive_timeout_config.get('p99_multiplier', 3)}), 60), 1), " \
+        f"{adaptive_timeout_config.get('min_minutes', 5)}), {adaptive_timeout_config.get('max_minutes', 120)})"
+    ingestion_timeout = {
+        "value": f"@if(equals({p99_seconds}, 0), '{ingestion_timeout}', concat('0.', "
+                 f"formatNumber(div({timeout_minutes}, 60), '00'), ':', "
+                 f"formatNumber(mod({timeout_minutes}, 60), '00'), ':00'))",
+        "type": "Expression",
+    }
+    timeout_activities = [
+        adf.LookupActivityArgs(
+            type="Lookup",
+            name="Get ingestion timeouts",
+            dataset=adf.DatasetReferenceArgs(
+                reference_name=data_lake_json_file.name,
+                type="DatasetReference",
+                parameters={
+                    "Container": "orchestration",
+                    "Folder": ingestion_timeouts_folder,
+                    "FileName": "timeouts.json",
+                }
+            ),
+            source=adf.JsonSourceArgs(
+                type="JsonSource",
+                store_settings=adf.AzureBlobFSReadSettingsArgs(
+                    type="AzureBlobFSReadSettings"
+                ),
+            ),
+            first_row_only=True,
+            policy=default_policy,
+        )
+    ]
+    timeout_dependencies = [
+        adf.ActivityDependencyArgs(
+            activity="Get ingestion timeouts",
+            dependency_conditions=[adf.DependencyCondition.COMPLETED]
+        )
+    ]
+
+# The same settings for the notebook ingesting batches of files, which retries
+# each file with an exponential backoff
+batch_ingestion_parameters = {
+    "timeout_seconds": str(ingestion_policy.get("timeout", 20) * 60),
+    "max_retries": str(ingestion_policy.get("retry", 0)),
+    "backoff_seconds": str(ingestion_policy.get("retry_interval", 30)),
+    "p99_multiplier": str(adaptive_timeout_config.get("p99_multiplier", 3))
+    if adaptive_timeout_config.get("enabled") else "0",
+    "min_timeout_minutes": str(adaptive_timeout_config.get("min_minutes", 5)),
+    "max_timeout_minutes": str(adaptive_timeout_config.get("max_minutes", 120)),
+}
+
+
+def ingest_file_notebook_activity(depends_on):
+    return adf.DatabricksNotebookActivityArgs(
+        name="Trigger ingest file notebook",
+        notebook_path="/Shared/Ingenii Engineering/data_pipeline",
+        type="DatabricksNotebook",
+        linked_service_name=adf.LinkedServiceReferenceArgs(
+            reference_name=databricks_engineering_compute_linked_service.name,
+            type="LinkedServiceReference",
+        ),
+        depends_on=depends_on,
+        base_parameters={
+            "file_path": {
+                "value": "@pipeline().parameters.filePath",
+                "type": "Expression",
+            },
+            "file_name": {
+                "value": "@pipeline().parameters.fileName",
+                "type": "Expression",
+            },
+            "increment": "0",
+        },
+        policy=adf.ActivityPolicyArgs(
+            timeout=ingestion_timeout,
+            retry=ingestion_policy.get("retry", 0),
+            retry_interval_in_seconds=ingestion_policy.get("retry_interval", 30),
+            secure_output=False,
+            secure_input=False,
+        ),
+        user_properties=[],
+    )
+
+
+ingest_file_activity = ingest_file_notebook_activity(depends_on=[])
+
+# The event trigger can't exclude paths, so files for micro-batch paths are
+# skipped before any Databricks activity is started
+micro_batch_path_list = ", ".join(f"'{path}'" for path in micro_batch_paths)
+is_micro_batch_path = \
+    f"contains(createArray({micro_batch_path_list}), pipeline().parameters.filePath)"
+
+ingestion_activities = [ingest_file_notebook_activity(depends_on=timeout_dependencies)]
+if micro_batch_paths:
+    ingestion_activities = [
+        adf.IfConditionActivityArgs(
+            type="IfCondition",
+            name="If not a micro-batch path",
+            depends_on=timeout_dependencies,
+            expression=adf.ExpressionArgs(
+                type="Expression",
+                value=f"@not({is_micro_batch_path})"
+            ),
+            if_true_activities=[ingest_file_activity],
+        )
+    ]
+
+# ----------------------------------------------------------------------------------------------------------------------
+# DATA FACTORY -> INGESTION PIPELINE AND TRIGGER -> BACKPRESSURE
+# ----------------------------------------------------------------------------------------------------------------------
+
+# The depth and age of the ingestion pipeline's queue come from the factory's
+# pipeline run logs. When the queue is too deep or too old, new files are
+# deferred to a marker in the orchestration container rather than queued, and
+# scheduled drain runs of the ingestion pipeline ingest them in batches. Once
+# a table has deferred files, its later files are deferred too, and draining
+# in the ingestion pipeline means only one run writes at a time, so each
+# table's files are still ingested in the order they arrived
+backpressure_config = datafactory_config.get("ingestion_backpressure", {})
+deferred_files_folder = "deferred_files"
+
+ingestion_queue_query = datafactory.id.apply(lambda factory_id: f"""ADFPipelineRun
+| where TimeGenerated > ago(1d)
+| where _ResourceId =~ '{factory_id}' and PipelineName == 'Trigger ingest file notebook'
+| summarize arg_max(TimeGenerated, Status), QueuedAt = min(TimeGenerated) by RunId
+| where Status == 'Queued'
+| summarize Depth = count(), Oldest = min(QueuedAt)
+| project Depth, OldestAgeMinutes = iff(isnull(Oldest), 0, datetime_diff('minute', now(), Oldest))""")
+
+# Available in the workspace as IngestionQueue, for queries and workbooks
+operationalinsights.SavedSearch(
+    resource_name=f"{datafactory_name}-ingestion-queue",
+    saved_search_id=f"{datafactory_name}-ingestion-queue",
+    category="Ingenii Data Platform",
+    display_name="Ingestion queue",
+    function_alias="IngestionQueue",
+    query=ingestion_queue_query,
+    resource_group_name=resource_groups["security"].name,
+    workspace_name=log_analytics_workspace.name,
+)
+outputs["ingestion_queue"] = {
+    "log_analytics_function": "IngestionQueue",
+    "backpressure_enabled": bool(backpressure_config.get("enabled")),
+}
+
+if backpressure_config.get("enabled"):
+    defer_depth = backpressure_config.get("defer_depth", 50)
+    defer_age_minutes = backpressure_config.get("defer_age_minutes", 60)
+    outputs["ingestion_queue"].update({
+        "defer_depth": defer_depth,
+        "defer_age_minutes": defer_age_minutes,
+        "deferred_files_path": f"orchestration/{deferred_files_folder}",
+    })
+
+    ServicePrincipalRoleAssignment(
+        role_name="Log Analytics Reader",
+        principal_id=datafactory.identity.principal_id,
+        principal_name="orchestration-datafactory-identity",
+        scope=log_analytics_workspace.id,
+        scope_description="log-analytics-workspace",
+    )
+
+    # Files are ingested as normal when the queue can't be read
+    queue_row = "activity('Get ingestion queue').output?.tables?[0]?.rows?[0]"
+    is_backed_up = f"or(greaterOrEquals(coalesce({queue_row}?[0], 0), {defer_depth}), " \
+                   f"greaterOrEquals(coalesce({queue_row}?[1], 0), {defer_age_minutes}))"
+    # Markers are kept in a folder for each source and table
+    table_deferred_files_folder = \
+        f"concat('{deferred_files_folder}/', replace(pipeline().parameters.filePath, 'raw/', ''))"
+    has_deferred_files = \
+        "greater(length(coalesce(activity('List deferred files').output?.childItems, json('[]'))), 0)"
+    route = f"if(or({has_deferred_files}, {is_backed_up}), 'defer', 'ingest')"
+    if micro_batch_paths:
+        route = f"if({is_micro_batch_path}, 'micro_batch', {route})"
+    route = f"if(pipeline().parameters.drainDeferredFiles, if({has_deferred_files}, 'drain', 'no_deferred_files'), {route})"
+
+    def save_ingestion_queue_activity(name):
+        """ Save the latest reading of the queue, for the engineering dashboard """
+        return adf.WebActivityArgs(
+            type="WebActivity",
+            name=name,
+            method=adf.WebActivityMethod.PUT,
+            url=Output.concat(datalake.primary_endpoints.blob, "orchestration/ingestion_queue.json"),
+            headers={
+                "x-ms-blob-type": "BlockBlob",
+                "x-ms-version": "2021-08-06",
+                "Content-Type": "application/json",
+            },
+            body={
+                "value": "@json(concat("
+                         "'{\"depth\": ', string(coalesce(" + queue_row + "?[0], 0)), "
+                         "', \"oldest_age_minutes\": ', string(coalesce(" + queue_row + "?[1], 0)), "
+                         "', \"date_read\": \"', utcNow(), '\"}'))",
+                "type": "Expression",
+            },
+            authentication=adf.WebActivityAuthenticationArgs(
+                type="MSI", resource="https://storage.azure.com"
+            ),
+            policy=default_policy,
+        )
+
+    ingestion_activities = [
+        adf.WebActivityArgs(
+            type="WebActivity",
+            name="Get ingestion queue",
+            method=adf.WebActivityMethod.POST,
+            url=Output.concat(
+                "https://api.loganalytics.io/v1/workspaces/",
+                log_analytics_workspace.customer_id, "/query"
+            ),
+            body={"query": "IngestionQueue"},
+            authentication=adf.WebActivityAuthenticationArgs(
+                type="MSI", resource="https://api.loganalytics.io"
+            ),
+            policy=default_policy,
+        ),
+        # This table's deferred files, or for a drain, any source's
+        adf.GetMetadataActivityArgs(
+            type="GetMetadata",
+            name="List deferred files",
+            dataset=adf.DatasetReferenceArgs(
+                reference_name=data_lake_folder.name,
+                type="DatasetReference",
+                parameters={
+                    "Container": "orchestration",
+                    "Folder": {
+                        "value": f"@if(pipeline().parameters.drainDeferredFiles, "
+                                 f"'{deferred_files_folder}', {table_deferred_files_folder})",
+                        "type": "Expression",
+                    },
+                }
+            ),
+            field_list=["exists", "childItems"],
+            format_settings=adf.BinaryReadSettingsArgs(
+                type="BinaryReadSettings"
+            ),
+            policy=default_policy,
+            store_settings=adf.AzureBlobFSReadSettingsArgs(
+                type="AzureBlobFSReadSettings",
+                enable_partition_discovery=False
+            )
+        ),
+        adf.SwitchActivityArgs(
+            type="Switch",
+            name="Ingest or defer file",
+            depends_on=[
+                adf.ActivityDependencyArgs(
+                    activity=activity_name,
+                    dependency_conditions=[adf.DependencyCondition.COMPLETED]
+                )
+                for activity_name in ("Get ingestion queue", "List deferred files")
+            ] + timeout_dependencies,
+            on=adf.ExpressionArgs(type="Expression", value=f"@{route}"),
+            cases=[
+                adf.SwitchCaseArgs(value="ingest", activities=[ingest_file_activity]),
+                adf.SwitchCaseArgs(value="defer", activities=[
+                    # The marker holds this run's parameters
+                    adf.WebActivityArgs(
+                        type="WebActivity",
+                        name="Defer file",
+                        method=adf.WebActivityMethod.PUT,
+                        url={
+                            "value": Output.concat(
+                                "@concat('", datalake.primary_endpoints.blob, "orchestration/', ",
+                                table_deferred_files_folder, ", '/', pipeline().RunId, '.json')"
+                            ),
+                            "type": "Expression",
+                        },
+                        headers={
+                            "x-ms-blob-type": "BlockBlob",
+                            "x-ms-version": "2021-08-06",
+                            "Content-Type": "application/json",
+                        },
+                        body={"value": "@pipeline().parameters", "type": "Expression"},
+                        authentication=adf.WebActivityAuthenticationArgs(
+                            type="MSI", resource="https://storage.azure.com"
+                        ),
+                        policy=default_policy,
+                    ),
+                ]),
+                adf.SwitchCaseArgs(value="drain", activities=[
+                    save_ingestion_queue_activity("Save ingestion queue"),
+                    adf.DatabricksNotebookActivityArgs(
+                        name="Trigger ingest deferred files notebook",
+                        notebook_path="/Shared/Ingenii Engineering/ingest_deferred_files",
+                        type="DatabricksNotebook",
+                        linked_service_name=adf.LinkedServiceReferenceArgs(
+                            reference_name=databricks_engineering_compute_linked_service.name,
+                            type="LinkedServiceReference",
+                        ),
+                        base_parameters={
+                            "deferred_files_path": f"/mnt/orchestration/{deferred_files_folder}",
+                            **batch_ingestion_parameters,
+                        },
+                        policy=adf.ActivityPolicyArgs(
+                            timeout=minutes_to_string(backpressure_config.get("drain_timeout", 240)),
+                            retry=0,
+                            retry_interval_in_seconds=30,
+                            secure_output=False,
+                            secure_input=False,
+                        ),
+                    ),
+                ]),
+                adf.SwitchCaseArgs(value="no_deferred_files", activities=[
+                    save_ingestion_queue_activity("Save ingestion queue without deferred files"),
+                ]),
+            ],
+            default_activities=[],
+        ),
+    ]
+
 databricks_file_ingestion_pipeline = adf.Pipeline(
     resource_name=f"{datafactory_name}-raw-databricks-file-ingestion",
     factory_name=datafactory.name,
@@ -32,38 +383,10 @@ databricks_file_ingestion_pipeline = adf.Pipeline(
     parameters={
         "fileName": adf.ParameterSpecificationArgs(type="String"),
         "filePath": adf.ParameterSpecificationArgs(type="String"),
+        # Set by the drain trigger, to ingest the deferred files
+        "drainDeferredFiles": adf.ParameterSpecificationArgs(type="Bool", default_value=False),
     },
-    activities=[
-        adf.DatabricksNotebookActivityArgs(
-            name="Trigger ingest file notebook",
-            notebook_path="/Shared/Ingenii Engineering/data_pipeline",
-            type="DatabricksNotebook",
-            linked_service_name=adf.LinkedServiceReferenceArgs(
-                reference_name=databricks_engineering_compute_linked_service.name,
-                type="LinkedServiceReference",
-            ),
-            depends_on=[],
-            base_parameters={
-                "file_path": {
-                    "value": "@pipeline().parameters.filePath",
-                    "type": "Expression",
-                },
-                "file_name": {
-                    "value": "@pipeline().parameters.fileName",
-                    "type": "Expression",
-                },
-                "increment": "0",
-            },
-            policy=adf.ActivityPolicyArgs(
-                timeout=minutes_to_string(ingestion_policy.get("timeout", 20)),
-                retry=ingestion_policy.get("retry", 0),
-                retry_interval_in_seconds=ingestion_policy.get("retry_interval", 30),
-                secure_output=False,
-                secure_input=False,
-            ),
-            user_properties=[],
-        )
-    ],
+    activities=timeout_activities + ingestion_activities,
     policy=adf.PipelinePolicyArgs(),
     annotations=["Created by Ingenii"],
     opts=ResourceOptions(ignore_changes=["annotations"]),
@@ -98,28 +421,233 @@ databricks_file_ingestion_trigger = adf.Trigger(
     resource_group_name=resource_groups["infra"].name,
 )
 
+# Drains are queued behind the files already waiting, so don't overlap with
+# any other ingestion
+if backpressure_config.get("enabled"):
+    adf.Trigger(
+        resource_name=f"{datafactory_name}-drain-deferred-files",
+        factory_name=datafactory.name,
+        trigger_name="Drain deferred files",
+        properties=adf.ScheduleTriggerArgs(
+            type="ScheduleTrigger",
+            recurrence=adf.ScheduleTriggerRecurrenceArgs(
+                frequency=adf.RecurrenceFrequency.MINUTE,
+                interval=backpressure_config.get("drain_interval_minutes", 15),
+                time_zone="UTC",
+                start_time="2021-01-01T00:00:00Z",
+            ),
+            pipelines=[
+                adf.TriggerPipelineReferenceArgs(
+                    pipeline_reference=adf.PipelineReferenceArgs(
+                        reference_name=databricks_file_ingestion_pipeline.name,
+                        type="PipelineReference",
+                    ),
+                    parameters={"fileName": "", "filePath": "", "drainDeferredFiles": True},
+                )
+            ],
+            annotations=["Created by Ingenii"],
+        ),
+        opts=ResourceOptions(ignore_changes=["properties.annotations"]),
+        resource_group_name=resource_groups["infra"].name,
+    )
+
+# ----------------------------------------------------------------------------------------------------------------------
+# DATA FACTORY -> MICRO-BATCH INGESTION
+# ----------------------------------------------------------------------------------------------------------------------
+
+# Each window lists the files that landed during it and ingests them all in a
+# single notebook run. Windows since the start time are run, so setting an
+# earlier start time backfills, and empty windows never start Databricks. The
+# file list is saved to the orchestration container, as it can be more than
+# the 10,000 bytes notebook parameters are limited to
+window_files_folder = "micro_batch/window_files"
+micro_batch_pipelines = {}
+for path_config in micro_batch_config:
+    source_name, table_name = path_config["source"], path_config["table"]
+    resource_suffix = f"micro-batch-{source_name}-{table_name}".replace("_", "-")
+
+    micro_batch_pipelines[(source_name, table_name)] = adf.Pipeline(
+        resource_name=f"{datafactory_name}-{resource_suffix}",
+        factory_name=datafactory.name,
+        pipeline_name=f"Micro-batch ingest {source_name} {table_name}",
+        description="Managed by Ingenii Data Platform",
+        parameters={
+            "windowStart": adf.ParameterSpecificationArgs(type="String"),
+            "windowEnd": adf.ParameterSpecificationArgs(type="String"),
+        },
+        activities=[
+            adf.GetMetadataActivityArgs(
+                type="GetMetadata",
+                name="List window files",
+                dataset=adf.DatasetReferenceArgs(
+                    reference_name=data_lake_folder.name,
+                    type="DatasetReference",
+                    parameters={"Container": "raw", "Folder": f"{source_name}/{table_name}"}
+                ),
+                field_list=["childItems"],
+                format_settings=adf.BinaryReadSettingsArgs(
+                    type="BinaryReadSettings"
+                ),
+                policy=default_policy,
+                store_settings=adf.AzureBlobFSReadSettingsArgs(
+                    type="AzureBlobFSReadSettings",
+                    enable_partition_discovery=False,
+                    modified_datetime_start=adf.ExpressionArgs(
+                        type="Expression",
+                        value="@pipeline().parameters.windowStart"
+                    ),
+                    modified_datetime_end=adf.ExpressionArgs(
+                        type="Expression",
+                        value="@pipeline().parameters.windowEnd"
+                    ),
+                )
+            ),
+            adf.FilterActivityArgs(
+                type="Filter",
+                name="Find only window files",
+                depends_on=depends_successful("List window files"),
+                items=adf.ExpressionArgs(
+                    type="Expression",
+                    value="@activity('List window files').output.childItems"
+                ),
+                condition=adf.ExpressionArgs(
+                    type="Expression",
+                    value="@equals(item().type, 'File')"
+                )
+            ),
+            adf.IfConditionActivityArgs(
+                type="IfCondition",
+                name="If files in window",
+                depends_on=depends_successful("Find only window files"),
+                expression=adf.ExpressionArgs(
+                    type="Expression",
+                    value="@greater(length(activity('Find only window files').output.Value), 0)"
+                ),
+                if_true_activities=[
+                    adf.WebActivityArgs(
+                        type="WebActivity",
+                        name="Save window files",
+                        method=adf.WebActivityMethod.PUT,
+                        url={
+                            "value": Output.concat(
+                                "@concat('", datalake.primary_endpoints.blob,
+                                f"orchestration/{window_files_folder}/', pipeline().RunId, '.json')"
+                            ),
+                            "type": "Expression",
+                        },
+                        headers={
+                            "x-ms-blob-type": "BlockBlob",
+                            "x-ms-version": "2021-08-06",
+                            "Content-Type": "application/json",
+                        },
+                        body={
+                            "value": "@string(activity('Find only window files').output.Value)",
+                            "type": "Expression",
+                        },
+                        authentication=adf.WebActivityAuthenticationArgs(
+                            type="MSI", resource="https://storage.azure.com"
+                        ),
+                        policy=default_policy,
+                    ),
+                    adf.DatabricksNotebookActivityArgs(
+                        name="Trigger ingest file batch notebook",
+                        notebook_path="/Shared/Ingenii Engineering/ingest_file_batch",
+                        type="DatabricksNotebook",
+                        depends_on=depends_successful("Save window files"),
+                        linked_service_name=adf.LinkedServiceReferenceArgs(
+                            reference_name=databricks_engineering_compute_linked_service.name,
+                            type="LinkedServiceReference",
+                        ),
+                        base_parameters={
+                            "source": source_name,
+                            "table": table_name,
+                            "files_path": {
+                                "value": f"@concat('/mnt/orchestration/{window_files_folder}/', "
+                                         f"pipeline().RunId, '.json')",
+                                "type": "Expression",
+                            },
+                            "window_start": {
+                                "value": "@pipeline().parameters.windowStart",
+                                "type": "Expression",
+                            },
+                            **batch_ingestion_parameters,
+                        },
+                        policy=adf.ActivityPolicyArgs(
+                            timeout=minutes_to_string(path_config.get("timeout", 120)),
+                            retry=0,
+                            retry_interval_in_seconds=30,
+                            secure_output=False,
+                            secure_input=False,
+                        ),
+                    )
+                ]
+            ),
+        ],
+        policy=adf.PipelinePolicyArgs(),
+        annotations=["Created by Ingenii"],
+        opts=ResourceOptions(ignore_changes=["annotations"]),
+        resource_group_name=resource_groups["infra"].name,
+    )
+
+    adf.Trigger(
+        resource_name=f"{datafactory_name}-{resource_suffix}",
+        factory_name=datafactory.name,
+        trigger_name=f"Micro-batch {source_name} {table_name}",
+        properties=adf.TumblingWindowTriggerArgs(
+            type="TumblingWindowTrigger",
+            frequency=adf.TumblingWindowFrequency.MINUTE,
+            interval=path_config.get("window_minutes", 15),
+            start_time=path_config["start_time"],
+            # Wait for files still being written at the end of the window
+            delay=minutes_to_string(path_config.get("delay_minutes", 1)),
+            # Windows run one at a time by default, so files are ingested in order
+            max_concurrency=path_config.get("max_concurrency", 1),
+            retry_policy=adf.RetryPolicyArgs(
+                count=path_config.get("retry", 2),
+                interval_in_seconds=path_config.get("retry_interval", 300),
+            ),
+            pipeline=adf.TriggerPipelineReferenceArgs(
+                pipeline_reference=adf.PipelineReferenceArgs(
+                    reference_name=micro_batch_pipelines[(source_name, table_name)].name,
+                    type="PipelineReference",
+                ),
+                parameters={
+                    "windowStart": "@trigger().outputs.windowStartTime",
+                    "windowEnd": "@trigger().outputs.windowEndTime",
+                },
+            ),
+            annotations=["Created by Ingenii"],
+        ),
+        opts=ResourceOptions(ignore_changes=["properties.annotations"]),
+        resource_group_name=resource_groups["infra"].name,
+    )
+
 # ----------------------------------------------------------------------------------------------------------------------
 # DATA FACTORY -> WORKSPACE SYNCING
 # ----------------------------------------------------------------------------------------------------------------------
 
 containers = ["models", "snapshots", "source"]
+workspace_sync_config = datafactory_config.get("workspace_sync", {})
 
-default_policy = adf.ActivityPolicyArgs(
-    timeout=minutes_to_string(1),
-    retry=3,
-    retry_interval_in_seconds=30,
-    secure_output=False,
-    secure_input=False,
-)
+# Each sync only lists the table folders created since the last successful
+# sync started, with an hour's overlap, so its cost follows the number of new
+# tables rather than the size of the lake. The time is kept in the utilities
+# container, and the first sync lists every table folder
+last_sync_path = "utilities/catalog_sync/last_sync.json"
+last_sync_start = "addToTime(coalesce(activity('Get last sync').output?.date_synced, " \
+                  "'1970-01-01T00:00:00Z'), -1, 'Hour')"
 
-def depends_successful(*activity_names):
-    return [
-        adf.ActivityDependencyArgs(
-            activity=activity_name,
-            dependency_conditions=[adf.DependencyCondition.SUCCEEDED]
-        )
-        for activity_name in activity_names
-    ]
+get_last_sync_activity = adf.WebActivityArgs(
+    type="WebActivity",
+    name="Get last sync",
+    method=adf.WebActivityMethod.GET,
+    url=Output.concat(datalake.primary_endpoints.blob, last_sync_path),
+    headers={"x-ms-version": "2021-08-06"},
+    authentication=adf.WebActivityAuthenticationArgs(
+        type="MSI", resource="https://storage.azure.com"
+    ),
+    policy=default_policy,
+)
 
 def per_container_activities(container_name):
     return [
@@ -127,6 +655,13 @@ def per_container_activities(container_name):
             type="GetMetadata",
             name=f"Get {container_name} top-level folders",
             description=None,
+            # Not found before the first sync
+            depends_on=[
+                adf.ActivityDependencyArgs(
+                    activity="Get last sync",
+                    dependency_conditions=[adf.DependencyCondition.COMPLETED]
+                )
+            ],
             dataset=adf.DatasetReferenceArgs(
                 reference_name=data_lake_folder.name,
                 type="DatasetReference",
@@ -176,8 +711,8 @@ def per_container_activities(container_name):
                         type="AzureBlobFSReadSettings",
                         enable_partition_discovery=False,
                         modified_datetime_start=adf.ExpressionArgs(
-                                type="Expression",
-                                value="@addToTime(utcNow(), -3, 'Day')"
+                            type="Expression",
+                            value=f"@{last_sync_start}"
                         )
                     )
                 ),
@@ -205,66 +740,112 @@ def per_container_activities(container_name):
                         value=f"@greater(length(activity('Find only {container_name} table folders').output.Value), 0)"
                     ),
                     if_true_activities=[
-                        adf.SetVariableActivityArgs(
-                            type="SetVariable",
-                            name=f"Set found {container_name} folders temp",
+                        # Append is safe to use in parallel iterations, unlike Set
+                        adf.AppendVariableActivityArgs(
+                            type="AppendVariable",
+                            name=f"Add found {container_name} folders",
                             description=None,
-                            variable_name=f"{container_name}TablesTemp",
+                            variable_name="tableDetails",
                             value=adf.ExpressionArgs(
                                 type="Expression",
-                                value=f"@union(variables('{container_name}Tables'), array(concat('/mnt/{container_name}/', item().Name, '|', join(activity('Find only {container_name} table folders').output.Value, ';'))))"
-                            )
-                        ),
-                        adf.SetVariableActivityArgs(
-                            type="SetVariable",
-                            name=f"Set found {container_name} folders",
-                            description=None,
-                            depends_on=depends_successful(f"Set found {container_name} folders temp"),
-                            variable_name=f"{container_name}Tables",
-                            value=adf.ExpressionArgs(
-                                type="Expression",
-                                value=f"@variables('{container_name}TablesTemp')"
+                                value=f"@concat('/mnt/{container_name}/', item().Name, '|', join(activity('Find only {container_name} table folders').output.Value, ';'))"
                             )
                         ),
                     ]
                 )
             ]
         ),
-        adf.ForEachActivityArgs(
-            name=f"For each new {container_name} schema",
-            type="ForEach",
-            depends_on=depends_successful(f"Find new {container_name} table folders"),
-            is_sequential=True,
-            items=adf.ExpressionArgs(
-                type="Expression",
-                value=f"@variables('{container_name}Tables')"
+    ]
+
+# All schemas are checked in a single notebook run, rather than one run per schema. The
+# table details are saved to the utilities container, which the Analytics workspace mounts,
+# as they can be more than the 10,000 bytes notebook parameters are limited to
+table_details_folder = "catalog_sync/table_details"
+check_tables_activities = [
+    adf.IfConditionActivityArgs(
+        type="IfCondition",
+        name="If new tables",
+        description=None,
+        depends_on=depends_successful(*[
+            f"Find new {container} table folders" for container in containers
+        ]),
+        expression=adf.ExpressionArgs(
+            type="Expression",
+            value="@greater(length(variables('tableDetails')), 0)"
+        ),
+        if_true_activities=[
+            adf.WebActivityArgs(
+                type="WebActivity",
+                name="Save table details",
+                method=adf.WebActivityMethod.PUT,
+                url={
+                    "value": Output.concat(
+                        "@concat('", datalake.primary_endpoints.blob,
+                        f"utilities/{table_details_folder}/', pipeline().RunId, '.json')"
+                    ),
+                    "type": "Expression",
+                },
+                headers={
+                    "x-ms-blob-type": "BlockBlob",
+                    "x-ms-version": "2021-08-06",
+                    "Content-Type": "application/json",
+                },
+                body={"value": "@string(variables('tableDetails'))", "type": "Expression"},
+                authentication=adf.WebActivityAuthenticationArgs(
+                    type="MSI", resource="https://storage.azure.com"
+                ),
+                policy=default_policy,
             ),
-            activities=[
-                adf.DatabricksNotebookActivityArgs(
-                    name=f"Check {container_name} tables exist in Analytics workspace",
-                    notebook_path="/Shared/Ingenii Engineering/check_tables_exist_adf",
-                    type="DatabricksNotebook",
-                    base_parameters={
-                        "table_details": {
-                            "value": "@item()",
-                            "type": "Expression",
-                        },
+            adf.DatabricksNotebookActivityArgs(
+                name="Check tables exist in Analytics workspace",
+                notebook_path="/Shared/Ingenii Engineering/check_tables_exist_adf",
+                type="DatabricksNotebook",
+                depends_on=depends_successful("Save table details"),
+                base_parameters={
+                    "table_details_path": {
+                        "value": f"@concat('/mnt/utilities/{table_details_folder}/', pipeline().RunId, '.json')",
+                        "type": "Expression",
                     },
-                    linked_service_name=adf.LinkedServiceReferenceArgs(
-                        reference_name=databricks_analytics_compute_linked_service.name,
-                        type="LinkedServiceReference",
-                    ),
-                    policy=adf.ActivityPolicyArgs(
-                        timeout=minutes_to_string(20),
-                        retry=0,
-                        retry_interval_in_seconds=30,
-                        secure_output=False,
-                        secure_input=False,
-                    ),
-                )
-            ]
-        )
-    ]
+                    "auto_register": str(
+                        workspace_sync_config.get("auto_register", False)
+                    ).lower(),
+                },
+                linked_service_name=adf.LinkedServiceReferenceArgs(
+                    reference_name=databricks_analytics_compute_linked_service.name,
+                    type="LinkedServiceReference",
+                ),
+                policy=adf.ActivityPolicyArgs(
+                    timeout=minutes_to_string(20),
+                    retry=0,
+                    retry_interval_in_seconds=30,
+                    secure_output=False,
+                    secure_input=False,
+                ),
+            )
+        ]
+    ),
+    # Only once every new table has been checked
+    adf.WebActivityArgs(
+        type="WebActivity",
+        name="Save last sync",
+        depends_on=depends_successful("If new tables"),
+        method=adf.WebActivityMethod.PUT,
+        url=Output.concat(datalake.primary_endpoints.blob, last_sync_path),
+        headers={
+            "x-ms-blob-type": "BlockBlob",
+            "x-ms-version": "2021-08-06",
+            "Content-Type": "application/json",
+        },
+        body={
+            "value": "@json(concat('{\"date_synced\": \"', pipeline().TriggerTime, '\"}'))",
+            "type": "Expression",
+        },
+        authentication=adf.WebActivityAuthenticationArgs(
+            type="MSI", resource="https://storage.azure.com"
+        ),
+        policy=default_policy,
+    ),
+]
 
 databricks_workspace_syncing_pipeline = adf.Pipeline(
     resource_name=f"{datafactory_name}-databricks-workspace-syncing",
@@ -272,20 +853,13 @@ databricks_workspace_syncing_pipeline = adf.Pipeline(
     pipeline_name="Sync workspaces for new tables",
     description="Managed by Ingenii Data Platform",
     concurrency=1,
-    activities=[
+    activities=[get_last_sync_activity] + [
         per_container_activity
         for container in containers
         for per_container_activity in per_container_activities(container)
-    ],
+    ] + check_tables_activities,
     variables={
-        **{
-            f"{container}Tables": adf.VariableSpecificationArgs(type=adf.VariableType.ARRAY)
-            for container in containers
-        },
-        **{
-            f"{container}TablesTemp": adf.VariableSpecificationArgs(type=adf.VariableType.ARRAY)
-            for container in containers
-        }
+        "tableDetails": adf.VariableSpecificationArgs(type=adf.VariableType.ARRAY),
     },
     policy=adf.PipelinePolicyArgs(),
     annotations=["Created by Ingenii"],
@@ -293,31 +867,34 @@ databricks_workspace_syncing_pipeline = adf.Pipeline(
     resource_group_name=resource_groups["infra"].name,
 )
 
-databricks_sync_workspaces_trigger = adf.Trigger(
-    resource_name=f"{datafactory_name}-databricks-workspace-syncing",
-    factory_name=datafactory.name,
-    trigger_name="Daily sync",
-    properties=adf.ScheduleTriggerArgs(
-        type="ScheduleTrigger",
-        description=None,
-        recurrence=adf.ScheduleTriggerRecurrenceArgs(
-            frequency=adf.RecurrenceFrequency.DAY,
-            interval=1,
-            time_zone="UTC",
-            start_time="2021-01-01T00:00:00Z",
-            schedule=adf.RecurrenceScheduleArgs(hours=[0], minutes=[0])
+# With a shared metastore, tables are available in both workspaces as soon as
+# they are created, so there is nothing to sync
+if not hive_metastore_config.get("enabled"):
+    databricks_sync_workspaces_trigger = adf.Trigger(
+        resource_name=f"{datafactory_name}-databricks-workspace-syncing",
+        factory_name=datafactory.name,
+        trigger_name="Daily sync",
+        properties=adf.ScheduleTriggerArgs(
+            type="ScheduleTrigger",
+            description=None,
+            recurrence=adf.ScheduleTriggerRecurrenceArgs(
+                frequency=adf.RecurrenceFrequency.DAY,
+                interval=1,
+                time_zone="UTC",
+                start_time="2021-01-01T00:00:00Z",
+                schedule=adf.RecurrenceScheduleArgs(hours=[0], minutes=[0])
+            ),
+            pipelines=[
+                adf.TriggerPipelineReferenceArgs(
+                    pipeline_reference=adf.PipelineReferenceArgs(
+                        reference_name=databricks_workspace_syncing_pipeline.name,
+                        type="PipelineReference",
+                    ),
+                    parameters={},
+                )
+            ],
+            annotations=["Created by Ingenii"],
         ),
-        pipelines=[
-            adf.TriggerPipelineReferenceArgs(
-                pipeline_reference=adf.PipelineReferenceArgs(
-                    reference_name=databricks_workspace_syncing_pipeline.name,
-                    type="PipelineReference",
-                ),
-                parameters={},
-            )
-        ],
-        annotations=["Created by Ingenii"],
-    ),
-    opts=ResourceOptions(ignore_changes=["properties.annotations"]),
-    resource_group_name=resource_groups["infra"].name,
-)
\ No newline at end of file
+        opts=ResourceOptions(ignore_changes=["properties.annotations"]),
+        resource_group_name=resource_groups["infra"].name,
+    )
\ No newline at end of file
@@ -0,0 +1,124 @@
+from pulumi_azure_native.insights import v20210801 as insights
+
+from ingenii_azure_data_platform.utils import generate_resource_name
+
+from logs import log_analytics_workspace
+from management import action_groups
+from project_config import platform_config
+
+# ----------------------------------------------------------------------------------------------------------------------
+# DATA FACTORY -> PIPELINE SLO ALERTS
+# ----------------------------------------------------------------------------------------------------------------------
+
+# Queries over the ADFPipelineRun table, which the factories' diagnostic settings send to the Log Analytics workspace.
+# Each returns a single AggregatedValue to compare with the threshold
+slo_queries = {
+    # Percentile of the run duration, in minutes
+    "duration": """ADFPipelineRun
+| where _ResourceId =~ '{factory_id}' and PipelineName == '{pipeline_name}'
+| where Status in ('Succeeded', 'Failed', 'Cancelled')
+| extend DurationMinutes = datetime_diff('second', End, Start) / 60.0
+| summarize AggregatedValue = percentile(DurationMinutes, {percentile})""",
+    # Percentile of the time between a run being queued and it starting, in minutes
+    "queue_time": """ADFPipelineRun
+| where _ResourceId =~ '{factory_id}' and PipelineName == '{pipeline_name}'
+| summarize Queued = minif(TimeGenerated, Status == 'Queued'), Started = minif(TimeGenerated, Status == 'InProgress') by RunId
+| where isnotnull(Queued) and isnotnull(Started)
+| extend WaitMinutes = datetime_diff('second', Started, Queued) / 60.0
+| summarize AggregatedValue = percentile(WaitMinutes, {percentile})""",
+    # Number of successful runs
+    "throughput": """ADFPipelineRun
+| where _ResourceId =~ '{factory_id}' and PipelineName == '{pipeline_name}'
+| where Status == 'Succeeded'
+| summarize AggregatedValue = count()""",
+    # Number of runs queued and not yet started
+    "queue_depth": """ADFPipelineRun
+| where _ResourceId =~ '{factory_id}' and PipelineName == '{pipeline_name}'
+| summarize arg_max(TimeGenerated, Status) by RunId
+| summarize AggregatedValue = countif(Status == 'Queued')""",
+}
+
+# The setting holding the threshold for each type, which the schema cannot require by type
+slo_threshold_settings = {
+    "duration": "threshold_minutes",
+    "queue_time": "threshold_minutes",
+    "throughput": "min_runs",
+    "queue_depth": "max_queued",
+}
+
+
+def minutes_to_duration(n_mins):
+    """ Take the number of minutes and return an ISO 8601 duration """
+    if n_mins % 60:
+        return f"PT{n_mins}M"
+    return f"PT{n_mins // 60}H"
+
+
+def create_pipeline_slo_alerts(factory_ref_key, factory_id, resource_group_name, slo_configs):
+    """ Create a scheduled query rule for each of a data factory's pipeline SLOs """
+    for slo_config in slo_configs:
+        slo_type = slo_config["type"]
+        window_minutes = slo_config.get("window_minutes", 60)
+
+        threshold_setting = slo_threshold_settings[slo_type]
+        threshold = slo_config.get(threshold_setting)
+        if threshold is None:
+            raise Exception(
+                f"Pipeline SLO alert '{slo_config['name']}' in the '{factory_ref_key}' data factory "
+                f"is of type '{slo_type}', so needs '{threshold_setting}' to be set"
+            )
+
+        query = factory_id.apply(lambda factory_id, slo_config=slo_config: slo_queries[slo_config["type"]].format(
+            factory_id=factory_id,
+            pipeline_name=slo_config["pipeline_name"].replace("'", "\\'"),
+            percentile=slo_config.get("percentile", 95),
+        ))
+
+        # Too few successful runs, too many waiting, or runs taking or
+        # waiting too long
+        if slo_type == "throughput":
+            operator = insights.ConditionOperator.LESS_THAN
+        else:
+            operator = insights.ConditionOperator.GREATER_THAN
+
+        insights.ScheduledQueryRule(
+            resource_name=generate_resource_name(
+                resource_type="scheduled_query_rule",
+                resource_name=f"datafactory_{factory_ref_key}_{slo_config['name']}",
+                platform_config=platform_config,
+            ),
+            rule_name=f"Pipeline SLO - {factory_ref_key} - {slo_config['name']}",
+            description=slo_config.get(
+                "description",
+                f"{slo_type.replace('_', ' ').title()} SLO for the '{slo_config['pipeline_name']}' pipeline",
+            ),
+            display_name=f"Pipeline SLO - {factory_ref_key} - {slo_config['name']}",
+            actions=insights.ActionsArgs(
+                action_groups=[
+                    action_groups[action_group].id
+                    for action_group in slo_config.get("action_groups", [])
+                ],
+            ),
+            auto_mitigate=True,
+            criteria=insights.ScheduledQueryRuleCriteriaArgs(
+                all_of=[insights.ConditionArgs(
+                    query=query,
+                    time_aggregation=insights.TimeAggregation.MAXIMUM,
+                    metric_measure_column="AggregatedValue",
+                    operator=operator,
+                    threshold=threshold,
+                    failing_periods=insights.ConditionFailingPeriodsArgs(
+                        number_of_evaluation_periods=1,
+                        min_failing_periods_to_alert=1,
+                    ),
+                )],
+            ),
+            enabled=slo_config.get("enabled", True),
+            evaluation_frequency=minutes_to_duration(slo_config.get("frequency_minutes", 15)),
+            window_size=minutes_to_duration(window_minutes),
+            location=platform_config.region.long_name,
+            resource_group_name=resource_group_name,
+            scopes=[log_analytics_workspace.id],
+            severity=slo_config.get("severity", 2),
+            tags=platform_config.tags,
+        )
@@ -12,6 +12,7 @@ from ingenii_azure_data_platform.orchestration import AdfSelfHostedIntegrationRu
 from ingenii_azure_data_platform.utils import generate_resource_name
 
 from analytics.databricks import engineering_workspace as databricks_engineering
+from analytics.datafactory.slo_alerts import create_pipeline_slo_alerts
 from logs import log_analytics_workspace
 from management import action_groups, resource_groups, user_groups
 
@@ -237,6 +238,14 @@ for ref_key, datafactory_config in user_datafactory_configs.items():
             window_size="PT15M",
         )
 
+    # ----------------------------------------------------------------------------------------------------------------------
+    # DATA FACTORY -> PIPELINE SLO ALERTS
+    # ----------------------------------------------------------------------------------------------------------------------
+    create_pipeline_slo_alerts(
+        ref_key, datafactory.id, datafactory_resource_group.name,
+        datafactory_config.get("slo_alerts", [])
+    )
+
     # ----------------------------------------------------------------------------------------------------------------------
     # DATA FACTORY -> LOGGING
     # ----------------------------------------------------------------------------------------------------------------------
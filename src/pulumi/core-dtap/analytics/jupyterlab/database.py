@@ -0,0 +1,130 @@
+from pulumi import Output, ResourceOptions
+import pulumi_azure_native as azure_native
+from pulumi_azure_native.dbforpostgresql import v20210601 as postgresql
+import pulumi_random
+
+from ingenii_azure_data_platform.utils import generate_resource_name, lock_resource
+
+from management import resource_groups
+from project_config import platform_config, SHARED_OUTPUTS
+from security import credentials_store
+
+# By default the hub keeps its state in SQLite on a persistent volume, which
+# only allows one write at a time. With many users spawning and reporting
+# activity at once, a PostgreSQL server keeps the hub's API responsive
+database_config = platform_config["analytics_services"].get("jupyterlab", {}).get("database", {})
+database_enabled = database_config.get("enabled", False)
+database_outputs = {}
+
+# ----------------------------------------------------------------------------------------------------------------------
+# JUPYTERLAB -> HUB DATABASE
+# ----------------------------------------------------------------------------------------------------------------------
+
+if database_enabled:
+    server_name = generate_resource_name(
+        resource_type="postgresql_server",
+        resource_name="jupyterhub",
+        platform_config=platform_config,
+    )
+    admin_username = database_config.get("admin_username", "jupyterhubadmin")
+    database_name = database_config.get("database_name", "jupyterhub")
+
+    admin_password = pulumi_random.RandomPassword(
+        resource_name=generate_resource_name(
+            resource_type="random_password",
+            resource_name="jupyterhub-database",
+            platform_config=platform_config,
+        ),
+        length=32,
+        min_lower=1,
+        min_numeric=1,
+        min_special=1,
+        min_upper=1,
+        # Kept out of the connection URL syntax
+        override_special="!$*-_=+",
+    ).result
+
+    # Save admin creds in the credentials store
+    azure_native.keyvault.Secret(
+        resource_name=f"{server_name}-admin-creds",
+        secret_name=f"{server_name}-admin-creds",
+        properties=azure_native.keyvault.SecretPropertiesArgs(
+            value=admin_password.apply(
+                lambda password: f"username: {admin_username}, password: {password}"
+            )
+        ),
+        resource_group_name=resource_groups["security"].name,
+        vault_name=credentials_store.key_vault.name,
+    )
+
+    server = postgresql.Server(
+        resource_name=server_name,
+        server_name=server_name,
+        administrator_login=admin_username,
+        administrator_login_password=admin_password,
+        backup=postgresql.BackupArgs(
+            backup_retention_days=database_config.get("backup_retention_days", 7),
+            geo_redundant_backup=postgresql.GeoRedundantBackupEnum.DISABLED,
+        ),
+        create_mode=postgresql.CreateMode.DEFAULT,
+        high_availability=postgresql.HighAvailabilityArgs(
+            mode=postgresql.HighAvailabilityMode.ZONE_REDUNDANT
+            if database_config.get("high_availability", False)
+            else postgresql.HighAvailabilityMode.DISABLED,
+        ),
+        location=platform_config.region.long_name,
+        resource_group_name=resource_groups["infra"].name,
+        sku=postgresql.SkuArgs(
+            name=database_config.get("sku_name", "Standard_B1ms"),
+            tier=database_config.get("sku_tier", "Burstable"),
+        ),
+        storage=postgresql.StorageArgs(
+            storage_size_gb=database_config.get("storage_size_gb", 32),
+        ),
+        tags=platform_config.tags,
+        version=database_config.get("version", "13"),
+        opts=ResourceOptions(
+            ignore_changes=["administratorLoginPassword"],
+            protect=platform_config.resource_protection,
+        ),
+    )
+    if platform_config.resource_protection:
+        lock_resource(server_name, server.id)
+
+    database = postgresql.Database(
+        resource_name=f"{server_name}-{database_name}",
+        database_name=database_name,
+        charset="UTF8",
+        collation="en_US.utf8",
+        resource_group_name=resource_groups["infra"].name,
+        server_name=server.name,
+        opts=ResourceOptions(protect=platform_config.resource_protection),
+    )
+
+    # The hub runs in the shared cluster, whose traffic leaves through the
+    # shared NAT gateway. Only that address can reach the server
+    postgresql.FirewallRule(
+        resource_name=f"{server_name}-shared-cluster",
+        firewall_rule_name="shared-cluster",
+        start_ip_address=SHARED_OUTPUTS.get(
+            "network", "nat", "public_ip_address", preview="0.0.0.0"
+        ),
+        end_ip_address=SHARED_OUTPUTS.get(
+            "network", "nat", "public_ip_address", preview="0.0.0.0"
+        ),
+        resource_group_name=resource_groups["infra"].name,
+        server_name=server.name,
+    )
+
+    database_outputs.update({
+        "server_name": server.name,
+        "database_name": database.name,
+    })
+
+    # The password is given to the hub separately, as PGPASSWORD
+    database_url = Output.concat(
+        "postgresql://", admin_username, "@", server.fully_qualified_domain_name,
+        ":5432/", database.name, "?sslmode=require",
+    )
+else:
+    admin_password, database_url = None, None
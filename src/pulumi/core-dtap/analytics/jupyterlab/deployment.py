@@ -1,14 +1,23 @@
+from base64 import b64encode
+from hashlib import md5, sha256
+import json
 from os import getcwd, environ
 from pulumi import FileAsset, Output, ResourceOptions, \
-    ResourceTransformationArgs, ResourceTransformationResult
+    ResourceTransformationArgs, ResourceTransformationResult, StringAsset
 import pulumi_azuread as azuread
+import pulumi_databricks as databricks
 from pulumi_azure_native import containerservice, network, storage
 from pulumi_kubernetes import batch, core, helm, meta
 
 from ingenii_azure_data_platform.databricks import create_cluster
+from ingenii_azure_data_platform.kubernetes import jupyterlab_profile_label, \
+    jupyterlab_user_taint, spot_taint
 from ingenii_azure_data_platform.utils import generate_resource_name
 
-from analytics.databricks.analytics_workspace import databricks_provider, workspace
+from analytics.databricks.analytics_workspace import databricks_provider, \
+    instance_pools, workspace
+from analytics.jupyterlab.database import admin_password as database_password, \
+    database_config, database_outputs, database_url
 from analytics.kubernetes.storage import add_storage_account_secret, \
     kubernetes_storage_account, \
     kubernetes_storage_account_resource_group, \
@@ -136,6 +145,102 @@ namespace = core.v1.Namespace(
 
 node_selector = {"OS": containerservice.OSType.LINUX}
 
+# User pods, and the image pullers preparing their nodes, can be kept to the
+# node pool with these labels
+single_user_node_selector = {
+    **env_jupyterlab_config.get("node_selector", {}),
+    **node_selector,
+}
+image_puller_config = env_jupyterlab_config.get("image_puller", {})
+
+# Placeholder pods hold room for this many users. A real user's pod preempts a
+# placeholder straight away, and the pending placeholder makes the cluster
+# autoscaler add a node in the background. The placeholders' priority is kept
+# at -10, as the autoscaler ignores pods with a lower priority
+scheduling_config = env_jupyterlab_config.get("scheduling", {})
+placeholder_users = scheduling_config.get("placeholder_users", 0)
+placeholder_resources = {
+    "requests": {
+        resource: scheduling_config[f"placeholder_{resource}"]
+        for resource in ("cpu", "memory")
+        if scheduling_config.get(f"placeholder_{resource}")
+    }
+}
+
+#----------------------------------------------------------------------------------------------------------------------
+# JUPYTERLAB -> PROFILES
+#----------------------------------------------------------------------------------------------------------------------
+
+# Users choose a profile when starting their server, each with its own
+# resources and, if it has a node pool, its own nodes. Profiles are set in the
+# shared configuration, as the shared cluster creates their node pools
+profiles_config = jupyterlab_config.get("profiles", {})
+
+
+def taint_to_toleration(taint):
+    key, value_effect = taint.split("=")
+    value, effect = value_effect.split(":")
+    return {"key": key, "operator": "Equal", "value": value, "effect": effect}
+
+
+def memory_in_gb(memory):
+    """ Take a Kubernetes memory quantity, e.g. 512M or 4Gi, and return the number of GB """
+    units = {"K": 1e-6, "M": 1e-3, "G": 1, "T": 1e3}
+    number, unit = memory.rstrip("i")[:-1], memory.rstrip("i")[-1]
+    return float(number) * units[unit.upper()]
+
+
+def create_profile(profile_slug, profile_config):
+    """ Create a KubeSpawner profile from the profile's configuration """
+    override = {
+        setting: profile_config[config_key]
+        for setting, config_key in {
+            "cpu_guarantee": "cpu_guarantee",
+            "cpu_limit": "cpu_limit",
+            "mem_guarantee": "memory_guarantee",
+            "mem_limit": "memory_limit",
+        }.items()
+        if profile_config.get(config_key) is not None
+    }
+    if profile_config.get("image"):
+        override["image"] = f"{profile_config['image']['name']}:{profile_config['image']['tag']}"
+
+    pool_config = profile_config.get("node_pool")
+    if pool_config:
+        # Only the profile's label, as the environment's node_selector labels
+        # aren't on the profile's pool unless it is configured with them
+        override["node_selector"] = {
+            **node_selector,
+            jupyterlab_profile_label: profile_slug,
+        }
+        # Replaces the chart's tolerations, so includes the user taint
+        override["tolerations"] = [taint_to_toleration(jupyterlab_user_taint)]
+        if pool_config.get("spot", {}).get("enabled"):
+            override["tolerations"].append(taint_to_toleration(spot_taint))
+            # Use spot nodes when they're available
+            override["node_affinity_preferred"] = [{
+                "weight": 100,
+                "preference": {"matchExpressions": [{
+                    "key": "kubernetes.azure.com/scalesetpriority",
+                    "operator": "In",
+                    "values": ["spot"],
+                }]},
+            }]
+
+    return {
+        "display_name": profile_config.get("display_name", profile_slug),
+        "slug": profile_slug,
+        "description": profile_config.get("description", ""),
+        "default": profile_config.get("default", False),
+        "kubespawner_override": override,
+    }
+
+
+profile_list = [
+    create_profile(profile_slug, profile_config)
+    for profile_slug, profile_config in profiles_config.items()
+]
+
 #----------------------------------------------------------------------------------------------------------------------
 # JUPYTERLAB -> DATABRICKS CONNECT
 #----------------------------------------------------------------------------------------------------------------------
@@ -144,9 +249,12 @@ databricks_connect = any([
     jupyterlab_config.get("databricks_connect", {}).get("enabled", False),
     env_jupyterlab_config.get("databricks_connect", {}).get("enabled", False)
 ])
+databricks_connect_config = env_jupyterlab_config.get("databricks_connect", {})
 single_user_clusters = {}
+# User names the hub could see, to the key of their cluster
+single_user_cluster_keys = {}
 if databricks_connect:
-    for user in env_jupyterlab_config.get("databricks_connect", {}).get("users", []):
+    for user in databricks_connect_config.get("users", []):
 
         cluster = user.get("cluster", {})
 
@@ -162,6 +270,10 @@ if databricks_connect:
             )
 
         user_name = user["email_address"].split("@")[0]
+        single_user_cluster_keys.update({
+            user["email_address"].lower(): user_name,
+            user_name.lower(): user_name,
+        })
 
         single_user_clusters[user_name] = create_cluster(
             databricks_provider=databricks_provider,
@@ -186,8 +298,36 @@ if databricks_connect:
                 },
                 "spark_version": "10.4.x-scala2.12",
             },
+            # Pool-backed clusters start more quickly
+            instance_pools=instance_pools,
+        )
+
+# Start each user's cluster when their server spawns, and terminate it when
+# their server stops. The hub's application is added to the workspace to do so
+cluster_lifecycle = bool(single_user_clusters) and databricks_connect_config.get("start_on_spawn", True)
+if cluster_lifecycle:
+    hub_databricks_service_principal = databricks.ServicePrincipal(
+        resource_name=f"{resource_name}-hub",
+        application_id=auth_application.application_id,
+        display_name=f"JupyterHub - {platform_config.stack}",
+        opts=ResourceOptions(provider=databricks_provider),
+    )
+    for user_name, cluster in single_user_clusters.items():
+        databricks.Permissions(
+            resource_name=f"{resource_name}-singleuser-{user_name}-hub",
+            cluster_id=cluster.cluster_id,
+            access_controls=[
+                databricks.PermissionsAccessControlArgs(
+                    permission_level="CAN_RESTART",
+                    service_principal_name=hub_databricks_service_principal.application_id,
+                )
+            ],
+            opts=ResourceOptions(provider=databricks_provider),
         )
 
+    with open("analytics/jupyterlab/hub/databricks_clusters.py") as clusters_file:
+        databricks_clusters_script = clusters_file.read()
+
 #----------------------------------------------------------------------------------------------------------------------
 # JUPYTERLAB -> STARTUP SCRIPTS
 #----------------------------------------------------------------------------------------------------------------------
@@ -229,8 +369,14 @@ startup_blob_container = storage.BlobContainer(
     ),
 )
 
+# Each file's base64 MD5 hash, as the file share records it
+startup_manifest = {}
+
 def upload_startup_file(title, file_name):
-    file_asset = FileAsset(f"analytics/jupyterlab/files/{file_name}")
+    file_path = f"analytics/jupyterlab/files/{file_name}"
+    with open(file_path, "rb") as startup_file:
+        startup_manifest[file_name] = b64encode(md5(startup_file.read()).digest()).decode()
+    file_asset = FileAsset(file_path)
     return storage.Blob(
         resource_name=generate_resource_name(
             resource_type="storage_blob",
@@ -247,7 +393,9 @@ def upload_startup_file(title, file_name):
 
 install_packages_blob = upload_startup_file(
     "README", "README")
-startup_files = [install_packages_blob]
+startup_hooks_blob = upload_startup_file(
+    "startup_hooks", "00_startup_hooks.py")
+startup_files = [install_packages_blob, startup_hooks_blob]
 if databricks_connect:
     databricks_connect_blob = upload_startup_file(
         "databricks_connect", "10_databricks_connect.py")
@@ -258,7 +406,31 @@ if quantum_workspace_config["enabled"]:
         "quantum_examples", "10_quantum.py")
     startup_files.append(quantum_examples_blob)
 
-# Move files to be mounted
+# The job only copies files whose hash in the manifest differs from the
+# share's copy, and removes files no longer in the manifest
+startup_manifest_content = json.dumps(startup_manifest, sort_keys=True)
+startup_manifest_name = "manifest.json"
+startup_manifest_blob = storage.Blob(
+    resource_name=generate_resource_name(
+        resource_type="storage_blob",
+        resource_name="startup_manifest",
+        platform_config=platform_config,
+    ),
+    account_name=kubernetes_storage_account.name,
+    blob_name=startup_manifest_name,
+    container_name=startup_name,
+    resource_group_name=kubernetes_storage_account_resource_group,
+    source=StringAsset(startup_manifest_content),
+    opts=ResourceOptions(depends_on=[startup_blob_container]),
+)
+
+# Pin the image so nodes only pull it once
+blob_to_share_image = "ingeniisolutions/utility-blob-to-share:0.2.0"
+if env_jupyterlab_config.get("blob_to_share_image_digest"):
+    blob_to_share_image += "@" + env_jupyterlab_config["blob_to_share_image_digest"]
+
+# Move files to be mounted. The job's name includes the manifest's hash, so
+# it's only replaced, and so only runs, when a file has changed
 storage_account_secret = add_storage_account_secret(namespace.id)
 to_file_share_job = batch.v1.Job(
     resource_name=generate_resource_name(
@@ -271,7 +443,7 @@ to_file_share_job = batch.v1.Job(
             spec=core.v1.PodSpecArgs(
                 containers=[core.v1.ContainerArgs(
                     name="blob-to-share",
-                    image="ingeniisolutions/utility-blob-to-share:0.1.0",
+                    image=blob_to_share_image,
                     env=[
                         core.v1.EnvVarArgs(
                             name=k, value_from=core.v1.EnvVarSourceArgs(
@@ -290,9 +462,10 @@ to_file_share_job = batch.v1.Job(
                         for k, v in {
                             "CONTAINER_NAME": startup_blob_container.name,
                             "SHARE_NAME": startup_file_share.name,
+                            "MANIFEST_NAME": startup_manifest_name,
                         }.items()
                     ],
-                    image_pull_policy="Always",
+                    image_pull_policy="IfNotPresent",
                 )],
                 node_selector=node_selector,
                 restart_policy="Never",
@@ -301,21 +474,40 @@ to_file_share_job = batch.v1.Job(
         backoff_limit=4,
     ),
     metadata=meta.v1.ObjectMetaArgs(
-        labels={
-            # Record MD5 hashes to prompt recreation of job on file changes
-            f"MD5_{idx}": startup_file.content_md5.apply(
-                lambda md5: "".join([char for char in md5 if char.isalnum()])
-            )
-            for idx, startup_file in enumerate(startup_files)
-        },
+        name=f"startup-blob-to-share-{sha256(startup_manifest_content.encode()).hexdigest()[:10]}",
         namespace=namespace.id,
     ),
     opts=ResourceOptions(
-        depends_on=[storage_account_secret] + startup_files,
+        depends_on=[storage_account_secret, startup_manifest_blob] + startup_files,
         provider=shared_kubernetes_provider,
     ),
 )
 
+#----------------------------------------------------------------------------------------------------------------------
+# JUPYTERLAB -> IDLE CULLING
+#----------------------------------------------------------------------------------------------------------------------
+
+# Stops servers that are idle or too old, so their nodes can be scaled down.
+# Profiles can have their own limits, and servers with a kernel still
+# executing are left running
+culling_config = env_jupyterlab_config.get("culling", {})
+with open("analytics/jupyterlab/hub/idle_culler.py") as culler_file:
+    culler_script = culler_file.read()
+culler_script_path = "/usr/local/etc/jupyterhub/idle_culler.py"
+culler_metrics_port = 9101
+
+#----------------------------------------------------------------------------------------------------------------------
+# JUPYTERLAB -> METRICS
+#----------------------------------------------------------------------------------------------------------------------
+
+# The hub pod is annotated for Container Insights to scrape, into the shared
+# Log Analytics workspace, where the shared stack's workbook charts them. A pod
+# has a single scrape endpoint, so the culler serves the hub's metrics
+# alongside its own, using its token. With culling disabled, the culler is
+# still run to serve the metrics, so the hub's stay authenticated
+metrics_config = jupyterlab_config.get("metrics", {})
+metrics_port, metrics_path = culler_metrics_port, "/metrics"
+
 #----------------------------------------------------------------------------------------------------------------------
 # JUPYTERLAB -> CHART AND DEPLOYMENT
 #----------------------------------------------------------------------------------------------------------------------
@@ -344,12 +536,25 @@ def create_chart_values(kwargs):
             "extraConfig":{
                 "add-jupyterlab": "c.Spawner.cmd=['jupyter-labhub']",
             },
+            "extraFiles": {},
             "nodeSelector": node_selector
         },
+        # Pull the single user images onto each user node before it's needed:
+        # the hook on every upgrade, and the continuous puller when a node is
+        # added. Both pull the main image, every profile's image and any extras
         "prePuller": {
             "hook": {
+                "enabled": image_puller_config.get("hook", True),
+                "pullOnlyOnChanges": True,
                 "nodeSelector": node_selector
-            }
+            },
+            "continuous": {
+                "enabled": image_puller_config.get("continuous", True),
+            },
+            "pullProfileListImages": True,
+            "extraImages": image_puller_config.get("extra_images", {}),
+            # So profiles' spot nodes are prepared too
+            "extraTolerations": [taint_to_toleration(spot_taint)],
         },
         "proxy": {
             "chp": {
@@ -363,13 +568,29 @@ def create_chart_values(kwargs):
             }
         },
         "scheduling": {
+            # Packs users onto the fewest nodes, so empty nodes can be removed
             "userScheduler": {
+                "enabled": scheduling_config.get("user_scheduler", True),
                 "nodeSelector": node_selector
-            }
+            },
+            "podPriority": {
+                "enabled": placeholder_users > 0,
+            },
+            "userPlaceholder": {
+                "enabled": placeholder_users > 0,
+                "replicas": placeholder_users,
+                # Without any set, each placeholder reserves a user's guarantees
+                "resources": placeholder_resources if placeholder_resources["requests"] else {},
+            },
+        },
+        # Replaced by the platform's own culler
+        "cull": {
+            "enabled": False,
         },
         "singleuser": {
             "extraEnv": {},
-            "nodeSelector": node_selector,
+            "nodeSelector": single_user_node_selector,
+            "profileList": profile_list,
             "storage": {
                 "extraVolumes": [
                     {
@@ -397,6 +618,108 @@ def create_chart_values(kwargs):
             "letsencrypt": {"contactEmail": contact_email,},
         }
 
+    culler_command = ["python3", culler_script_path, "--metrics-port", str(culler_metrics_port)]
+    if culling_config.get("enabled", True):
+        culler_settings = {
+            "timeout": culling_config.get("timeout", 3600),
+            "every": culling_config.get("every", 600),
+            "max_age": culling_config.get("max_age", 0),
+            "concurrency": culling_config.get("concurrency", 10),
+            "exempt_users": culling_config.get("exempt_users", []),
+            "exempt_busy_kernels": culling_config.get("exempt_busy_kernels", True),
+            "profiles": {
+                profile_slug: dict(profile_culling_config)
+                for profile_slug, profile_culling_config in culling_config.get("profiles", {}).items()
+            },
+            # With HTTPS, the public service only redirects to HTTPS
+            "proxy_url": "http://proxy-http:8000" if hostname else "http://proxy-public",
+        }
+        # Each server reserves its memory guarantee, so culling it frees that
+        # share of a node
+        if culling_config.get("node_memory_gb"):
+            culler_settings["node_fraction"] = \
+                culling_config.get("user_memory_guarantee_gb", 1) / culling_config["node_memory_gb"]
+        # Profiles on their own node pools reserve a share of those nodes
+        for profile_slug, profile_config in profiles_config.items():
+            node_memory_gb = profile_config.get("node_pool", {}).get("node_memory_gb")
+            if node_memory_gb and profile_config.get("memory_guarantee"):
+                culler_settings["profiles"].setdefault(profile_slug, {})["node_fraction"] = \
+                    memory_in_gb(profile_config["memory_guarantee"]) / node_memory_gb
+
+        culler_command += ["--config", json.dumps(culler_settings)]
+    else:
+        culler_command.append("--metrics-only")
+
+    if metrics_config.get("enabled", True):
+        culler_command.append("--hub-metrics")
+
+    if culling_config.get("enabled", True) or metrics_config.get("enabled", True):
+        values["hub"]["extraFiles"]["idle-culler"] = {
+            "mountPath": culler_script_path,
+            "stringData": culler_script,
+        }
+        values["hub"]["extraConfig"]["idle-culler"] = \
+            "c.JupyterHub.services.append(" \
+            f"{{'name': 'idle-culler', 'admin': True, 'command': {culler_command!r}}})"
+
+    if metrics_config.get("enabled", True):
+        values["hub"]["annotations"] = {
+            "prometheus.io/scrape": "true",
+            "prometheus.io/port": str(metrics_port),
+            "prometheus.io/path": metrics_path,
+        }
+        # The agent scraping the pod runs in kube-system
+        values["hub"]["networkPolicy"] = {
+            "ingress": [{
+                "from": [{"namespaceSelector": {"matchLabels": {"kubernetes.io/metadata.name": "kube-system"}}}],
+                "ports": [{"port": metrics_port}],
+            }],
+        }
+
+    if kwargs["database_url"]:
+        values["hub"]["db"] = {
+            "type": "postgres",
+            "url": kwargs["database_url"],
+            "password": kwargs["database_password"],
+            # Keep the schema up to date with the hub's version
+            "upgrade": True,
+        }
+        # The hub is a single process, so only needs a few connections
+        values["hub"]["extraConfig"]["database-pool"] = \
+            "c.JupyterHub.db_kwargs = " + repr({
+                "pool_size": database_config.get("pool_size", 5),
+                "max_overflow": database_config.get("max_overflow", 10),
+                "pool_pre_ping": True,
+                "pool_recycle": 1800,
+            })
+
+    if cluster_lifecycle:
+        values["custom"] = {
+            "databricks_clusters": {
+                "workspace_url": kwargs["databricks_url"],
+                "tenant_id": azure_client.tenant_id,
+                "client_id": auth_application.application_id,
+                "clusters": {
+                    key: kwargs["single_user_cluster_ids"][user_name]
+                    for key, user_name in single_user_cluster_keys.items()
+                },
+                "terminate_on_stop": databricks_connect_config.get("terminate_on_stop", True),
+            },
+        }
+        values["hub"]["extraFiles"]["databricks-clusters"] = {
+            "mountPath": "/usr/local/etc/jupyterhub/databricks_clusters.py",
+            "stringData": databricks_clusters_script,
+        }
+        values["hub"]["extraConfig"]["databricks-clusters"] = "\n".join([
+            "from databricks_clusters import DatabricksClusters",
+            "databricks_clusters = DatabricksClusters(",
+            "    get_config('custom.databricks_clusters'),",
+            "    get_config('hub.config.AzureAdOAuthenticator.client_secret'),",
+            ")",
+            "c.Spawner.pre_spawn_hook = databricks_clusters.pre_spawn_hook",
+            "c.Spawner.post_stop_hook = databricks_clusters.post_stop_hook",
+        ])
+
     custom_extensions = ""
     if databricks_connect:
         # Need to check the Databricks version (9.1)
@@ -429,6 +752,10 @@ chart_values = Output.all(
     record_set=record_set,
     databricks_url=workspace.workspace_url, databricks_id=workspace.workspace_id,
     quantum_workspace_name=quantum_outputs.get("workspace", {}).get("name"),
+    database_url=database_url, database_password=database_password,
+    single_user_cluster_ids=Output.all(**{
+        user_name: cluster.cluster_id for user_name, cluster in single_user_clusters.items()
+    }) if cluster_lifecycle else None,
 ).apply(create_chart_values)
 
 def remove_compat(args: ResourceTransformationArgs):
@@ -479,6 +806,7 @@ jupyterlab = helm.v3.Release(
 #     repository_opts=helm.v3.RepositoryOptsArgs(repo="https://jupyterhub.github.io/helm-chart/"),
 
 outputs.update({
+    "database": database_outputs,
     "id": jupyterlab.id,
     "name": jupyterlab.name,
     "namespace": jupyterlab.namespace,
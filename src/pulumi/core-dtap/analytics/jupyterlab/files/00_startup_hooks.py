@@ -0,0 +1,52 @@
+from os import environ, listdir, makedirs, path
+
+# Records the version of each hook's package last copied into the home
+# directory. The home directory is on a network share, so checking a single
+# marker is much quicker than checking every file each time a kernel starts
+_startup_hooks_folder = path.join(environ["HOME"], ".ingenii", "startup_hooks")
+
+
+def _copy_package_files(hook_name, distribution, resources_package, folder_name):
+    """
+    Copy the notebooks and scripts in a package's resources into a folder in
+    the home directory, once for each version of the package. Files already
+    in the folder are left as they are, so users' changes are kept
+
+    Parameters
+    ----------
+    hook_name : str
+        Name of the marker file for this hook
+    distribution : str
+        The installed distribution, whose version decides whether to copy
+    resources_package : str
+        The package containing the files to copy
+    folder_name : str
+        The folder in the home directory to copy into
+    """
+    from importlib.metadata import version
+
+    package_version = version(distribution)
+    marker_path = path.join(_startup_hooks_folder, hook_name)
+    if path.exists(marker_path):
+        with open(marker_path) as marker_file:
+            if marker_file.read() == package_version:
+                return
+
+    import importlib_resources
+
+    folder = path.join(environ["HOME"], folder_name)
+    makedirs(folder, exist_ok=True)
+    # A single listing, rather than checking each file
+    existing_files = set(listdir(folder))
+
+    for resource in importlib_resources.files(resources_package).iterdir():
+        if not resource.name.endswith((".py", ".ipynb")):
+            continue
+        if resource.name in existing_files:
+            continue
+        with open(path.join(folder, resource.name), "w") as new_file:
+            new_file.write(resource.read_text())
+
+    makedirs(_startup_hooks_folder, exist_ok=True)
+    with open(marker_path, "w") as marker_file:
+        marker_file.write(package_version)
@@ -1,22 +1,7 @@
-import importlib_resources
-from os import environ, mkdir, path
-
-examples_folder = environ["HOME"] + "/databricks_connect"
-
-# Check if we need to create the 'quantum_examples' folder
-if not path.isdir(examples_folder):
-    mkdir(examples_folder)
-
-# Check each file in the examples folder
-for example in importlib_resources.files("ingenii_databricks_connect.notebooks").iterdir():
-    if not (example.name.endswith(".py") or example.name.endswith(".ipynb")):
-        continue
-
-    new_file = f"{examples_folder}/{example.name}"
-
-    # Don't overwrite the file if it already exists
-    if path.exists(new_file):
-        continue
-
-    with open(new_file, "w") as example_file:
-        example_file.write(example.open().read())
+# Defined in 00_startup_hooks.py
+_copy_package_files(
+    hook_name="databricks_connect",
+    distribution="ingenii_databricks_connect",
+    resources_package="ingenii_databricks_connect.notebooks",
+    folder_name="databricks_connect",
+)
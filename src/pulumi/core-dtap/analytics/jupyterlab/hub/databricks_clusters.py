@@ -0,0 +1,99 @@
+"""
+Loaded by the hub's configuration, to tie each user's Databricks Connect
+cluster to their JupyterLab server.
+
+When a server spawns, its user's cluster is started, so it's warm by the
+time of their first Spark call, and its ID is given to the server. When the
+user's last server stops, the cluster is terminated rather than left until
+it auto-terminates.
+
+The hub calls Databricks as its own Azure AD application, which is added to
+the workspace and can restart each user's cluster.
+"""
+
+import json
+from time import time
+from urllib.parse import urlencode
+
+from tornado.httpclient import AsyncHTTPClient, HTTPClientError, HTTPRequest
+
+# The Azure Databricks application
+DATABRICKS_RESOURCE_ID = "2ff814a6-3304-4ab8-85cb-cd0e6f879c1d"
+
+
+class DatabricksClusters:
+    def __init__(self, settings, client_secret):
+        self.workspace_url = settings["workspace_url"]
+        self.tenant_id = settings["tenant_id"]
+        self.client_id = settings["client_id"]
+        self.client_secret = client_secret
+        # Keyed by both the user's email address and its local part, in lower case
+        self.clusters = settings["clusters"]
+        self.terminate_on_stop = settings.get("terminate_on_stop", True)
+
+        self.client = AsyncHTTPClient()
+        self._token, self._expires_on = None, 0
+
+    def cluster_id(self, user_name):
+        user_name = user_name.lower()
+        return self.clusters.get(user_name) or self.clusters.get(user_name.split("@")[0])
+
+    async def get_token(self):
+        """ An AAD token for Databricks, reused until shortly before it expires """
+        if self._token and time() < self._expires_on - 300:
+            return self._token
+
+        response = await self.client.fetch(HTTPRequest(
+            url=f"https://login.microsoftonline.com/{self.tenant_id}/oauth2/v2.0/token",
+            method="POST",
+            body=urlencode({
+                "grant_type": "client_credentials",
+                "client_id": self.client_id,
+                "client_secret": self.client_secret,
+                "scope": f"{DATABRICKS_RESOURCE_ID}/.default",
+            }),
+        ))
+        token = json.loads(response.body)
+        self._token, self._expires_on = token["access_token"], time() + int(token["expires_in"])
+        return self._token
+
+    async def call_cluster_api(self, action, cluster_id):
+        await self.client.fetch(HTTPRequest(
+            url=f"https://{self.workspace_url}/api/2.0/clusters/{action}",
+            method="POST",
+            headers={"Authorization": f"Bearer {await self.get_token()}"},
+            body=json.dumps({"cluster_id": cluster_id}),
+        ))
+
+    async def pre_spawn_hook(self, spawner):
+        cluster_id = self.cluster_id(spawner.user.name)
+        if not cluster_id:
+            return
+
+        spawner.environment["DATABRICKS_CLUSTER_ID"] = cluster_id
+        try:
+            await self.call_cluster_api("start", cluster_id)
+            spawner.log.info(f"Starting Databricks cluster {cluster_id} for {spawner.user.name}")
+        except HTTPClientError as error:
+            # Including when the cluster is already running or starting
+            spawner.log.info(f"Databricks cluster {cluster_id} for {spawner.user.name} not started: {error}")
+        except Exception as error:
+            # The server can still start, and the cluster with the first Spark call
+            spawner.log.warning(f"Unable to start Databricks cluster {cluster_id}: {error}")
+
+    async def post_stop_hook(self, spawner):
+        cluster_id = self.cluster_id(spawner.user.name)
+        if not cluster_id or not self.terminate_on_stop:
+            return
+
+        # The user's other servers may still be using the cluster
+        if any(other.active for other in spawner.user.spawners.values() if other is not spawner):
+            return
+
+        try:
+            # 'delete' terminates the cluster, keeping its configuration
+            await self.call_cluster_api("delete", cluster_id)
+            spawner.log.info(f"Terminating Databricks cluster {cluster_id} for {spawner.user.name}")
+        except Exception as error:
+            # Left to auto-terminate
+            spawner.log.warning(f"Unable to terminate Databricks cluster {cluster_id}: {error}")
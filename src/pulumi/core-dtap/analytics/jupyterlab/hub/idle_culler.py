@@ -0,0 +1,229 @@
+"""
+Idle culler run by JupyterHub as a managed service, in place of the chart's
+jupyterhub-idle-culler so that profiles can have their own limits.
+
+Every cycle, each running server is stopped if it has been idle for longer
+than its profile's timeout, or has been running for longer than its
+profile's maximum age. Servers of exempt users, and servers with a kernel
+still executing, are left running.
+
+Metrics are served for Prometheus, including an estimate of the node-hours
+reclaimed: for every culled server, the share of a node it had reserved for
+each hour until its user starts a server again. The hub's own metrics can be
+served alongside them, so the hub pod has a single endpoint to scrape, and
+with culling disabled only the metrics are served.
+"""
+
+import asyncio
+import json
+import logging
+from argparse import ArgumentParser
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os import environ
+from threading import Thread
+from urllib.parse import quote
+from urllib.request import Request, urlopen
+
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, generate_latest
+from tornado.httpclient import AsyncHTTPClient, HTTPClientError, HTTPRequest
+
+logger = logging.getLogger("idle-culler")
+
+# Without the default process metrics, which the hub's metrics already include
+registry = CollectorRegistry()
+
+culled_servers = Counter(
+    "ingenii_culler_culled_servers",
+    "Servers stopped by the idle culler",
+    ["profile", "reason"],
+    registry=registry,
+)
+reclaimed_node_hours = Counter(
+    "ingenii_culler_reclaimed_node_hours",
+    "Node-hours reserved by culled servers, until their users start again",
+    ["profile"],
+    registry=registry,
+)
+running_servers = Gauge(
+    "ingenii_culler_running_servers",
+    "Servers running at the last cycle",
+    ["profile"],
+    registry=registry,
+)
+exempt_servers = Gauge(
+    "ingenii_culler_exempt_servers",
+    "Servers past their limits, but left running at the last cycle",
+    ["reason"],
+    registry=registry,
+)
+
+
+def parse_date(date_string):
+    if not date_string:
+        return None
+    return datetime.fromisoformat(date_string.replace("Z", "+00:00"))
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """ Serves the culler's metrics, followed by the hub's if hub_metrics_url is set """
+    hub_metrics_url = None
+
+    def do_GET(self):
+        body = generate_latest(registry)
+        if self.hub_metrics_url:
+            try:
+                request = Request(self.hub_metrics_url, headers={
+                    "Authorization": f"token {environ['JUPYTERHUB_API_TOKEN']}"})
+                with urlopen(request, timeout=10) as response:
+                    body += response.read()
+            except Exception as error:
+                logger.warning(f"Unable to read the hub's metrics: {error}")
+
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE_LATEST)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Not every scrape
+        pass
+
+
+def serve_metrics(port, hub_metrics=False):
+    if hub_metrics:
+        # e.g. http://hub:8081/hub/api -> http://hub:8081/hub/metrics
+        MetricsHandler.hub_metrics_url = \
+            environ["JUPYTERHUB_API_URL"].rstrip("/").rsplit("/", 1)[0] + "/metrics"
+    server = ThreadingHTTPServer(("", port), MetricsHandler)
+    thread = Thread(target=server.serve_forever, name="metrics", daemon=True)
+    thread.start()
+    return thread
+
+
+class IdleCuller:
+    def __init__(self, config):
+        self.config = config
+        self.hub_api_url = environ["JUPYTERHUB_API_URL"].rstrip("/")
+        # User servers are reached through the proxy
+        self.proxy_url = config["proxy_url"].rstrip("/")
+        self.headers = {"Authorization": f"token {environ['JUPYTERHUB_API_TOKEN']}"}
+        self.client = AsyncHTTPClient()
+        self.semaphore = asyncio.Semaphore(config.get("concurrency", 10))
+        # Culled users, and the share of a node their server reserved
+        self.culled_users = {}
+
+    def profile_config(self, profile):
+        return {
+            "timeout": self.config.get("timeout", 3600),
+            "max_age": self.config.get("max_age", 0),
+            "node_fraction": self.config.get("node_fraction", 0),
+            **self.config.get("profiles", {}).get(profile, {}),
+        }
+
+    async def fetch(self, url, method="GET"):
+        async with self.semaphore:
+            response = await self.client.fetch(HTTPRequest(
+                url=url, method=method, headers=self.headers,
+                allow_nonstandard_methods=True,
+            ))
+        return json.loads(response.body) if response.body else None
+
+    async def has_busy_kernel(self, server):
+        """ Whether any kernel on the server is still executing """
+        try:
+            kernels = await self.fetch(f"{self.proxy_url}{server['url']}api/kernels")
+        except HTTPClientError as error:
+            logger.warning(f"Unable to list kernels at {server['url']}: {error}")
+            return False
+        return any(kernel.get("execution_state") == "busy" for kernel in kernels)
+
+    async def check_server(self, user, server_name, server, now):
+        """ Stop the server if it's over its limits. Returns the reason, if stopped """
+
+        profile = (server.get("user_options") or {}).get("profile", "default")
+        limits = self.profile_config(profile)
+
+        last_activity = parse_date(server.get("last_activity")) or parse_date(server["started"])
+        idle_seconds = (now - last_activity).total_seconds()
+        age_seconds = (now - parse_date(server["started"])).total_seconds()
+
+        if limits["max_age"] and age_seconds > limits["max_age"]:
+            reason = "max_age"
+        elif limits["timeout"] and idle_seconds > limits["timeout"]:
+            reason = "idle"
+        else:
+            return None
+
+        if user["name"] in self.config.get("exempt_users", []):
+            exempt_servers.labels(reason="user").inc()
+            return None
+        if self.config.get("exempt_busy_kernels", True) and await self.has_busy_kernel(server):
+            exempt_servers.labels(reason="busy_kernel").inc()
+            return None
+
+        logger.info(
+            f"Stopping server '{server_name}' of {user['name']}, profile {profile}: "
+            f"{reason}, idle for {idle_seconds:.0f}s, running for {age_seconds:.0f}s"
+        )
+        server_path = f"/users/{quote(user['name'])}/server" if not server_name \
+            else f"/users/{quote(user['name'])}/servers/{quote(server_name)}"
+        await self.fetch(f"{self.hub_api_url}{server_path}", method="DELETE")
+
+        culled_servers.labels(profile=profile, reason=reason).inc()
+        self.culled_users[user["name"]] = (profile, limits["node_fraction"])
+        return reason
+
+    async def cull(self):
+        now = datetime.now(timezone.utc)
+        users = await self.fetch(f"{self.hub_api_url}/users?state=ready")
+
+        running_servers.clear()
+        exempt_servers.clear()
+        checks = []
+        for user in users:
+            for server_name, server in user.get("servers", {}).items():
+                if not server.get("ready"):
+                    continue
+                profile = (server.get("user_options") or {}).get("profile", "default")
+                running_servers.labels(profile=profile).inc()
+                checks.append(self.check_server(user, server_name, server, now))
+
+        # Capacity stays reclaimed until the user starts a server again
+        active_users = {user["name"] for user in users if user.get("servers")}
+        every_hours = self.config.get("every", 600) / 3600
+        for user_name, (profile, node_fraction) in list(self.culled_users.items()):
+            if user_name in active_users:
+                del self.culled_users[user_name]
+            elif node_fraction:
+                reclaimed_node_hours.labels(profile=profile).inc(every_hours * node_fraction)
+
+        results = await asyncio.gather(*checks, return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                logger.error(f"Unable to check a server: {result}")
+
+    async def run(self):
+        while True:
+            try:
+                await self.cull()
+            except Exception as error:
+                logger.error(f"Cull cycle failed: {error}")
+            await asyncio.sleep(self.config.get("every", 600))
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--config", default="{}", help="Culling settings, as JSON")
+    parser.add_argument("--metrics-port", type=int, default=9101)
+    parser.add_argument("--hub-metrics", action="store_true", help="Also serve the hub's metrics")
+    parser.add_argument("--metrics-only", action="store_true", help="Serve the metrics without culling")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    metrics_thread = serve_metrics(args.metrics_port, hub_metrics=args.hub_metrics)
+    if args.metrics_only:
+        metrics_thread.join()
+    else:
+        asyncio.run(IdleCuller(json.loads(args.config)).run())
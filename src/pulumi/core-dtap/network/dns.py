@@ -100,6 +100,40 @@ if platform_config.resource_protection:
         "privatelink-vaultcore-azure-net-link", key_vault_private_dns_zone_link.id
     )
 
+# ----------------------------------------------------------------------------------------------------------------------
+# SQL SERVER PRIVATE DNS ZONE
+# ----------------------------------------------------------------------------------------------------------------------
+
+# Only needed for the Databricks Hive metastore
+if platform_config["analytics_services"]["databricks"].get("hive_metastore", {}).get("enabled"):
+    sql_server_private_dns_zone = net.PrivateZone(
+        resource_name="privatelink-database-windows-net",
+        location="Global",
+        private_zone_name="privatelink.database.windows.net",
+        resource_group_name=resource_groups["infra"].name,
+        tags=platform_config.tags,
+    )
+    if platform_config.resource_protection:
+        lock_resource("privatelink-database-windows-net", sql_server_private_dns_zone.id)
+
+    sql_server_private_dns_zone_link = net.VirtualNetworkLink(
+        resource_name="privatelink-database-windows-net",
+        virtual_network_link_name=vnet.name,
+        location="Global",
+        private_zone_name=sql_server_private_dns_zone.name,
+        registration_enabled=False,
+        resource_group_name=resource_groups["infra"].name,
+        tags=platform_config.tags,
+        virtual_network=net.SubResourceArgs(
+            id=vnet.id,
+        ),
+    )
+    if platform_config.resource_protection:
+        lock_resource("privatelink-database-windows-net-link", sql_server_private_dns_zone_link.id)
+else:
+    sql_server_private_dns_zone = None
+    sql_server_private_dns_zone_link = None
+
 # ----------------------------------------------------------------------------------------------------------------------
 # CONTAINER REGISTRY PRIVATE DNS ZONE
 # ----------------------------------------------------------------------------------------------------------------------
@@ -3,3 +3,5 @@ from project_config import platform_outputs
 
 # Load sub-modules
 from . import cluster
+from . import keda
+from . import monitoring
@@ -1,11 +1,13 @@
 from base64 import b64decode
+from hashlib import md5
 from pulumi import ResourceOptions
 import pulumi_random
 from pulumi_azure_native import containerservice
 from pulumi_kubernetes import Provider as KubernetesProvider
 
 from ingenii_azure_data_platform.iam import GroupRoleAssignment
-from ingenii_azure_data_platform.kubernetes import get_cluster_config
+from ingenii_azure_data_platform.kubernetes import get_cluster_config, \
+    jupyterlab_profile_label, jupyterlab_user_taint, spot_taint
 from ingenii_azure_data_platform.utils import generate_resource_name, lock_resource
 
 from logs import log_analytics_workspace
@@ -70,6 +72,18 @@ if cluster_config["enabled"]:
             enabled=True,
         )
 
+    # How quickly the autoscaling pools add and remove nodes. Unset values use the AKS defaults
+    auto_scaler_profile_config = shared_cluster_config.get("autoscaler_profile", {})
+    auto_scaler_profile = containerservice.ManagedClusterPropertiesAutoScalerProfileArgs(
+        expander=auto_scaler_profile_config.get("expander"),
+        max_graceful_termination_sec=auto_scaler_profile_config.get("max_graceful_termination_sec"),
+        scale_down_delay_after_add=auto_scaler_profile_config.get("scale_down_delay_after_add"),
+        scale_down_unneeded_time=auto_scaler_profile_config.get("scale_down_unneeded_time"),
+        scale_down_utilization_threshold=auto_scaler_profile_config.get("scale_down_utilization_threshold"),
+        scan_interval=auto_scaler_profile_config.get("scan_interval"),
+        skip_nodes_with_local_storage=auto_scaler_profile_config.get("skip_nodes_with_local_storage"),
+    ) if auto_scaler_profile_config else None
+
     kubernetes_cluster = containerservice.ManagedCluster(
         resource_name=generate_resource_name(
             resource_type="kubernetes_cluster",
@@ -82,6 +96,7 @@ if cluster_config["enabled"]:
             managed=True,
         ),
         addon_profiles=add_ons if add_ons else None,
+        auto_scaler_profile=auto_scaler_profile,
         agent_pool_profiles=[
             # At minimum, the cluster requires a system Linux pool
             containerservice.ManagedClusterAgentPoolProfileArgs(
@@ -226,6 +241,76 @@ if cluster_config["enabled"]:
             opts=ResourceOptions(ignore_changes=ignore_changes),
         )
 
+    # ----------------------------------------------------------------------------------------------------------------------
+    # SHARED KUBERNETES CLUSTER -> JUPYTERLAB PROFILE POOLS
+    # ----------------------------------------------------------------------------------------------------------------------
+
+    # Each JupyterLab profile can have its own autoscaling pool, with a VM size
+    # to suit its users, and optionally a spot pool which its users prefer.
+    # The pools are tainted so only user pods are placed on them
+    jupyterlab_config = cluster_config["configs"]["jupyterlab"]
+    jupyterlab_profiles = jupyterlab_config.get("profiles", {}) if jupyterlab_config["enabled"] else {}
+
+    profile_pool_names = {}
+    for profile_slug, profile_config in jupyterlab_profiles.items():
+        pool = profile_config.get("node_pool")
+        if not pool:
+            continue
+
+        # Linux pool names are at most 12 lowercase letters and numbers. Slugs
+        # can share a prefix, so default names end with a hash of the slug
+        pool_name = pool.get("name", "".join([
+            "jl",
+            "".join(char for char in profile_slug.lower() if char.isalnum())[:6],
+            md5(profile_slug.encode()).hexdigest()[:4],
+        ]))
+        profile_pools = [(pool_name[:12], pool, False)]
+        if pool.get("spot", {}).get("enabled"):
+            profile_pools.append((pool_name[:10] + "sp", pool["spot"], True))
+
+        for agent_pool_name, _, _ in profile_pools:
+            if agent_pool_name in profile_pool_names:
+                raise Exception(
+                    f"JupyterLab profiles '{profile_pool_names[agent_pool_name]}' and '{profile_slug}' both have "
+                    f"the node pool name '{agent_pool_name}'. Set a different 'node_pool.name' for one of them"
+                )
+            profile_pool_names[agent_pool_name] = profile_slug
+
+        for agent_pool_name, scaling_config, spot in profile_pools:
+            min_count = scaling_config.get("min_count", 0)
+            containerservice.AgentPool(
+                resource_name=generate_resource_name(
+                    resource_type="kubernetes_agent_pool",
+                    resource_name=agent_pool_name,
+                    platform_config=platform_config,
+                ),
+                agent_pool_name=agent_pool_name,
+                availability_zones=pool.get("availability_zones", ["1"]),
+                count=min_count,
+                enable_auto_scaling=True,
+                max_count=scaling_config.get("max_count", 1),
+                min_count=min_count,
+                mode=containerservice.AgentPoolMode.USER,
+                node_labels={
+                    **pool.get("labels", {}),
+                    jupyterlab_profile_label: profile_slug,
+                    "OS": containerservice.OSType.LINUX,
+                },
+                node_taints=[jupyterlab_user_taint, spot_taint] if spot else [jupyterlab_user_taint],
+                os_type=containerservice.OSType.LINUX,
+                resource_group_name=cluster_resource_group_name,
+                resource_name_=kubernetes_cluster.name,
+                scale_set_eviction_policy=containerservice.ScaleSetEvictionPolicy.DELETE if spot else None,
+                scale_set_priority=containerservice.ScaleSetPriority.SPOT if spot else None,
+                # -1 pays up to the on-demand price
+                spot_max_price=scaling_config.get("max_price", -1) if spot else None,
+                tags=platform_config.tags,
+                type=containerservice.AgentPoolType.VIRTUAL_MACHINE_SCALE_SETS,
+                vm_size=pool["vm_size"],
+                vnet_subnet_id=hosted_services_subnet.id,
+                opts=ResourceOptions(ignore_changes=["count", "orchestratorVersion"]),
+            )
+
     # Check if any of the enabled features need Windows machines
     windows_pools = shared_cluster_config.get("windows_agent_pools", [])
     if cluster_config["windows"] and not windows_pools:
@@ -233,6 +318,10 @@ if cluster_config["enabled"]:
             "labels": {"addedBy": "platform"},
             "name": "win1"
         }]
+        # Room for the integrated runtimes to add nodes
+        runtime_autoscaling_config = cluster_config["configs"]["datafactory_runtime"].get("autoscaling", {})
+        if runtime_autoscaling_config.get("enabled"):
+            windows_pools[0]["max_count"] = runtime_autoscaling_config.get("max_nodes", 4)
 
     for idx, pool in enumerate(windows_pools):
         # Note: Windows pool names must be 6 characters or fewer: https://docs.microsoft.com/en-us/azure/aks/windows-container-cli#limitations
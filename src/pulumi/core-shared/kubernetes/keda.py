@@ -0,0 +1,34 @@
+from pulumi import ResourceOptions
+from pulumi_kubernetes import helm
+
+from kubernetes.cluster import cluster_config, shared_kubernetes_provider
+from project_config import platform_outputs
+
+# ----------------------------------------------------------------------------------------------------------------------
+# SHARED KUBERNETES CLUSTER -> KEDA
+# ----------------------------------------------------------------------------------------------------------------------
+
+# Event-driven autoscaling, used to scale the integrated self-hosted integration runtimes in each stack
+runtime_config = cluster_config["configs"]["datafactory_runtime"]
+runtime_autoscaling_config = runtime_config.get("autoscaling", {})
+
+if runtime_config["enabled"] and runtime_autoscaling_config.get("enabled"):
+    keda = helm.v3.Release(
+        resource_name="shared-cluster-keda",
+        chart="keda",
+        repository_opts=helm.v3.RepositoryOptsArgs(repo="https://kedacore.github.io/charts"),
+        version=runtime_autoscaling_config.get("keda_version", "2.8.2"),
+        namespace="keda",
+        create_namespace=True,
+        description="KEDA Deployment",
+        timeout=600,
+        values={
+            "nodeSelector": {"OS": "Linux"},
+        },
+        opts=ResourceOptions(provider=shared_kubernetes_provider),
+    )
+
+    platform_outputs["analytics"]["shared_kubernetes_cluster"]["keda"] = {
+        "name": keda.name,
+        "namespace": keda.namespace,
+    }
@@ -0,0 +1,216 @@
+import json
+from pulumi import ResourceOptions
+import pulumi_random
+from pulumi_azure_native.insights import v20210801 as insights
+from pulumi_kubernetes import core, meta
+
+from ingenii_azure_data_platform.utils import generate_resource_name
+
+from kubernetes.cluster import cluster_config, shared_kubernetes_provider
+from logs import log_analytics_workspace
+from management import resource_groups
+from project_config import platform_config, platform_outputs
+
+# ----------------------------------------------------------------------------------------------------------------------
+# SHARED KUBERNETES CLUSTER -> PROMETHEUS SCRAPING
+# ----------------------------------------------------------------------------------------------------------------------
+
+# Container Insights scrapes pods annotated with prometheus.io/scrape, such as each environment's JupyterHub, into the
+# InsightsMetrics table of the Log Analytics workspace
+jupyterlab_config = cluster_config["configs"]["jupyterlab"]
+metrics_config = jupyterlab_config.get("metrics", {})
+
+if cluster_config["enabled"] \
+        and platform_config["shared_kubernetes_cluster"]["cluster"].get("oms_agent", True) \
+        and jupyterlab_config["enabled"] and metrics_config.get("enabled", True):
+
+    scrape_interval = metrics_config.get("scrape_interval", "1m")
+
+    # The agent reads its settings from this name
+    core.v1.ConfigMap(
+        resource_name=generate_resource_name(
+            resource_type="kubernetes_config_map",
+            resource_name="container_insights",
+            platform_config=platform_config,
+        ),
+        metadata=meta.v1.ObjectMetaArgs(
+            name="container-azm-ms-agentconfig",
+            namespace="kube-system",
+        ),
+        data={
+            "schema-version": "v1",
+            "config-version": "ver1",
+            "prometheus-data-collection-settings": "\n".join([
+                "[prometheus_data_collection_settings.cluster]",
+                f'    interval = "{scrape_interval}"',
+                "    monitor_kubernetes_pods = true",
+            ]),
+        },
+        opts=ResourceOptions(provider=shared_kubernetes_provider),
+    )
+
+    # ------------------------------------------------------------------------------------------------------------------
+    # SHARED KUBERNETES CLUSTER -> JUPYTERHUB WORKBOOK
+    # ------------------------------------------------------------------------------------------------------------------
+
+    # Each environment's hub is in its own namespace, chosen in the workbook
+    def metric_increases(*metric_names):
+        """ Query of how much each Prometheus counter increased since its last sample, allowing for restarts """
+        names = ", ".join(f'"{name}"' for name in metric_names)
+        return "\n".join([
+            "InsightsMetrics",
+            f'| where Namespace == "prometheus" and Name in ({names})',
+            "| extend Tags = todynamic(Tags)",
+            "| where tostring(Tags.namespace) == '{HubNamespace}'",
+            "| extend Series = strcat(Name, tostring(Tags))",
+            "| order by Series asc, TimeGenerated asc",
+            "| extend Increase = iff(Series == prev(Series), iff(Val >= prev(Val), Val - prev(Val), Val), 0.0)",
+        ])
+
+    def gauge(metric_name):
+        return "\n".join([
+            "InsightsMetrics",
+            f'| where Namespace == "prometheus" and Name == "{metric_name}"',
+            "| extend Tags = todynamic(Tags)",
+            "| where tostring(Tags.namespace) == '{HubNamespace}'",
+        ])
+
+    workbook_queries = {
+        # Percentiles are the upper bounds of the histogram's buckets
+        "spawn_duration": ("Server spawn duration (seconds)", "timechart", "\n".join([
+            "let buckets = " + metric_increases("jupyterhub_server_spawn_duration_seconds_bucket"),
+            "| where tostring(Tags.status) == 'success'",
+            "| extend le = iff(tostring(Tags.le) == '+Inf', real(+inf), todouble(Tags.le))",
+            "| summarize Spawns = sum(Increase) by TimeGenerated = bin(TimeGenerated, {TimeRange:grain}), le;",
+            "buckets",
+            "| join kind=inner (buckets | where isinf(le) | project TimeGenerated, Total = Spawns) on TimeGenerated",
+            "| where Total > 0",
+            "| summarize P50 = minif(le, Spawns >= 0.5 * Total), P90 = minif(le, Spawns >= 0.9 * Total),",
+            "    P99 = minif(le, Spawns >= 0.99 * Total) by TimeGenerated",
+            "| order by TimeGenerated asc",
+        ])),
+        "running_servers": ("Running servers", "timechart", "\n".join([
+            gauge("jupyterhub_running_servers"),
+            "| summarize Servers = max(Val) by bin(TimeGenerated, {TimeRange:grain})",
+        ])),
+        "running_servers_by_profile": ("Running servers by profile", "timechart", "\n".join([
+            gauge("ingenii_culler_running_servers"),
+            "| summarize Servers = max(Val) by bin(TimeGenerated, {TimeRange:grain}), Profile = tostring(Tags.profile)",
+        ])),
+        "culled_servers": ("Culled servers", "barchart", "\n".join([
+            metric_increases("ingenii_culler_culled_servers"),
+            "| summarize Culls = sum(Increase) by bin(TimeGenerated, {TimeRange:grain}),",
+            "    Reason = strcat(tostring(Tags.profile), ' - ', tostring(Tags.reason))",
+        ])),
+        "reclaimed_node_hours": ("Node-hours reclaimed by culling", "barchart", "\n".join([
+            metric_increases("ingenii_culler_reclaimed_node_hours"),
+            "| summarize NodeHours = sum(Increase) by bin(TimeGenerated, {TimeRange:grain}),",
+            "    Profile = tostring(Tags.profile)",
+        ])),
+        # How long the hub takes to check the proxy's routing table against its servers, and to add a route
+        "proxy_routes": ("Proxy route table sync (average seconds)", "timechart", "\n".join([
+            metric_increases(
+                "jupyterhub_check_routes_duration_seconds_sum", "jupyterhub_check_routes_duration_seconds_count",
+                "jupyterhub_proxy_add_duration_seconds_sum", "jupyterhub_proxy_add_duration_seconds_count",
+            ),
+            "| extend Metric = extract('^jupyterhub_(.*)_duration_seconds_(sum|count)$', 1, Name)",
+            "| summarize Seconds = sumif(Increase, Name endswith '_sum'), Events = sumif(Increase, Name endswith '_count')",
+            "    by bin(TimeGenerated, {TimeRange:grain}), Metric",
+            "| where Events > 0",
+            "| project TimeGenerated, Metric, AverageSeconds = Seconds / Events",
+        ])),
+    }
+
+    def create_workbook(workspace_id):
+        parameters = [
+            {
+                "name": "TimeRange",
+                "label": "Time range",
+                "type": 4,
+                "isRequired": True,
+                "value": {"durationMs": 86400000},
+                "typeSettings": {
+                    "selectableValues": [
+                        {"durationMs": 3600000},
+                        {"durationMs": 14400000},
+                        {"durationMs": 86400000},
+                        {"durationMs": 604800000},
+                        {"durationMs": 2592000000},
+                    ],
+                },
+            },
+            {
+                "name": "HubNamespace",
+                "label": "Environment",
+                "type": 2,
+                "isRequired": True,
+                "query": "\n".join([
+                    "InsightsMetrics",
+                    '| where Namespace == "prometheus" and Name == "jupyterhub_running_servers"',
+                    "| extend HubNamespace = tostring(todynamic(Tags).namespace)",
+                    "| distinct HubNamespace",
+                ]),
+                "typeSettings": {"selectFirstItem": True},
+                "timeContextFromParameter": "TimeRange",
+                "queryType": 0,
+                "resourceType": "microsoft.operationalinsights/workspaces",
+            },
+        ]
+        items = [{
+            "type": 9,
+            "name": "parameters",
+            "content": {"version": "KqlParameterItem/1.0", "parameters": parameters},
+        }]
+        for name, (title, visualization, query) in workbook_queries.items():
+            items.append({
+                "type": 3,
+                "name": name,
+                "customWidth": "50",
+                "content": {
+                    "version": "KqlItem/1.0",
+                    "query": query,
+                    "size": 0,
+                    "title": title,
+                    "timeContextFromParameter": "TimeRange",
+                    "queryType": 0,
+                    "resourceType": "microsoft.operationalinsights/workspaces",
+                    "visualization": visualization,
+                },
+            })
+
+        return json.dumps({
+            "version": "Notebook/1.0",
+            "items": items,
+            "isLocked": False,
+            "fallbackResourceIds": [workspace_id],
+        })
+
+    # Workbooks are named with a GUID
+    workbook_id = pulumi_random.RandomUuid(
+        resource_name=generate_resource_name(
+            resource_type="random_uuid",
+            resource_name="jupyterhub_workbook",
+            platform_config=platform_config,
+        ),
+    )
+    workbook = insights.Workbook(
+        resource_name=generate_resource_name(
+            resource_type="workbook",
+            resource_name="jupyterhub",
+            platform_config=platform_config,
+        ),
+        category="workbook",
+        display_name="JupyterHub",
+        kind="shared",
+        location=platform_config.region.long_name,
+        resource_group_name=resource_groups["security"].name,
+        resource_name_=workbook_id.result,
+        serialized_data=log_analytics_workspace.id.apply(create_workbook),
+        source_id=log_analytics_workspace.id,
+        tags=platform_config.tags,
+    )
+
+    platform_outputs["analytics"]["shared_kubernetes_cluster"]["jupyterlab_metrics"] = {
+        "scrape_interval": scrape_interval,
+        "workbook_id": workbook.id,
+    }
@@ -5,6 +5,13 @@ config_os = {
     "jupyterlab": containerservice.OSType.LINUX,
 }
 
+# Nodes in a JupyterLab profile's pools have this label, with the profile's slug
+jupyterlab_profile_label = "jupyterlab-profile"
+# Taint of nodes only for JupyterLab users, which the chart's user pods tolerate
+jupyterlab_user_taint = "hub.jupyter.org/dedicated=user:NoSchedule"
+# Taint AKS gives nodes in spot pools
+spot_taint = "kubernetes.azure.com/scalesetpriority=spot:NoSchedule"
+
 def get_cluster_config(platform_config):
     """ Given the platform config, find the Kubernetes cluster details """
     configs = {
@@ -49,6 +49,7 @@ def generate_resource_name(
         "dns_zone": "dz",
         "kubernetes_agent_pool": "kap",
         "kubernetes_cluster": "kc",
+        "kubernetes_config_map": "kcm",
         "kubernetes_job": "kj",
         "kubernetes_persistent_volume": "kpv",
         "log_analytics_workspace": "law",
@@ -61,8 +62,10 @@ def generate_resource_name(
         "quantum_workspace": "qw",
         "random_password": "rp",
         "random_string": "rs",
+        "random_uuid": "ru",
         "resource_group": "rg",
         "route_table": "rt",
+        "scheduled_query_rule": "sqr",
         "service_principal": "sp",
         "static_site": "sts",
         "static_site_custom_domain": "stscd",
@@ -74,6 +77,7 @@ def generate_resource_name(
         "user_assigned_managed_identity": "uami",
         "virtual_machine_scale_set": "vmss",
         "virtual_network": "vnet",
+        "workbook": "wb",
     }
 
     resource_type = resource_type.lower()
@@ -99,6 +103,18 @@ def generate_resource_name(
         # adp-tst-eus-kv-cred-ixk1
         return f"{prefix}-{stack}-{region_short_name}-kv-{resource_name}-{unique_id}"
 
+    # SQL Server
+    elif resource_type == "sql_server":
+        # Example:
+        # adp-tst-eus-sql-metastore-ixk1
+        return f"{prefix}-{stack}-{region_short_name}-sql-{resource_name}-{unique_id}"
+
+    # PostgreSQL Server
+    elif resource_type == "postgresql_server":
+        # Example:
+        # adp-tst-eus-psql-jupyterhub-ixk1
+        return f"{prefix}-{stack}-{region_short_name}-psql-{resource_name}-{unique_id}"
+
     # Data Factory
     elif resource_type == "datafactory":
         if use_legacy_naming: